@@ -0,0 +1,336 @@
+"""Measure what auditing costs per migration step.
+
+Generates revision graphs of several shapes and sizes, upgrades them from
+base to heads with and without an :class:`.Auditor` on SQLite (in memory
+and in a file), and reports, per step:
+
+* the overhead of auditing on a full upgrade, online and offline (``--sql``);
+* the time spent in ``Auditor.listen``, ``Auditor.make_row`` and the table
+  creation check.
+
+Run it from the repository root, with the package installed (e.g. ``pip
+install -e .``)::
+
+    python benchmarks/bench_overhead.py --output before.json
+    # ... change things ...
+    python benchmarks/bench_overhead.py --output after.json \\
+        --compare before.json
+
+With ``--compare``, each measurement is shown next to the baseline, and the
+exit status is 1 if any got slower by more than ``--threshold``. Timings are
+the best of ``--repeat`` runs, so results are comparable from one commit to
+the next on the same machine.
+"""
+from __future__ import print_function
+
+import argparse
+import contextlib
+import functools
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import alembic
+import sqlalchemy
+from alembic.operations import Operations
+from alembic.runtime.migration import MigrationContext
+from alembic.script import ScriptDirectory
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+
+import audit_alembic
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+_template = '''revision = %r
+down_revision = %r
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    pass
+
+
+def downgrade():
+    pass
+'''
+
+
+def chain(n):
+    """A straight line of ``n`` revisions."""
+    revs = ['r%05d' % i for i in range(n)]
+    return list(zip(revs, [None] + revs[:-1]))
+
+
+def branched(n, width=4):
+    """``width`` branches of equal length off a common root."""
+    graph = [('root', None)]
+    length = max((n - 1) // width, 1)
+    for b in range(width):
+        down = 'root'
+        for i in range(length):
+            rev = 'b%d_%05d' % (b, i)
+            graph.append((rev, down))
+            down = rev
+    return graph
+
+
+def merges(n):
+    """Diamonds: each level forks in two, then merges, 3 revisions per
+    level."""
+    graph = [('m00000', None)]
+    for i in range(1, max(n // 3, 1) + 1):
+        down = 'm%05d' % (i - 1)
+        graph.append(('a%05d' % i, down))
+        graph.append(('b%05d' % i, down))
+        graph.append(('m%05d' % i, ('a%05d' % i, 'b%05d' % i)))
+    return graph
+
+
+shapes = {'chain': chain, 'branched': branched, 'merges': merges}
+
+
+def write_scripts(directory, graph):
+    versions = os.path.join(directory, 'versions')
+    os.makedirs(versions)
+    for rev, down in graph:
+        with open(os.path.join(versions, '%s.py' % rev), 'w') as f:
+            f.write(_template % (rev, down))
+    return ScriptDirectory(directory)
+
+
+class Timer(object):
+    """Wraps a method of an object, adding up the time spent in it."""
+
+    def __init__(self, obj, name):
+        self.calls = 0
+        self.seconds = 0.0
+        fn = getattr(obj, name)
+
+        @functools.wraps(fn)
+        def timed(*args, **kw):
+            started = _clock()
+            try:
+                return fn(*args, **kw)
+            finally:
+                self.seconds += _clock() - started
+                self.calls += 1
+
+        setattr(obj, name, timed)
+
+    @property
+    def micros(self):
+        return 1e6 * self.seconds / self.calls if self.calls else None
+
+
+def upgrade(script, auditor=None, url=None, as_sql=False):
+    """Upgrade a new database to heads; return the number of steps and the
+    seconds taken."""
+    steps = []
+    opts = {
+        'fn': lambda rev, context: script._upgrade_revs('heads', rev),
+        'script': script,
+        # one transaction, so that the file database does not sync at
+        # every statement and drown what we measure
+        'transactional_ddl': True,
+        'on_version_apply': (lambda **kw: steps.append(1),),
+    }
+    if auditor is not None:
+        opts['on_version_apply'] += (auditor.listen,)
+    if as_sql:
+        opts.update(as_sql=True, output_buffer=io.StringIO())
+        ctx = MigrationContext.configure(dialect_name='sqlite', opts=opts)
+        started = _clock()
+        _run(ctx, auditor)
+        return len(steps), _clock() - started
+    engine = create_engine(url, poolclass=StaticPool)
+    try:
+        with engine.connect() as conn:
+            ctx = MigrationContext.configure(connection=conn, opts=opts)
+            started = _clock()
+            _run(ctx, auditor)
+            return len(steps), _clock() - started
+    finally:
+        engine.dispose()
+
+
+def _run(ctx, auditor):
+    with Operations.context(ctx):
+        with ctx.begin_transaction():
+            if auditor is None:
+                ctx.run_migrations()
+            else:
+                with auditor.run(ctx):
+                    ctx.run_migrations()
+
+
+@contextlib.contextmanager
+def _database(workdir, backend):
+    if backend == 'memory':
+        yield 'sqlite://'
+        return
+    path = os.path.join(workdir, 'bench.db')
+    try:
+        yield 'sqlite:///%s' % path
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def measure(script, workdir, backend, repeat):
+    best = {}
+
+    def keep(name, value):
+        if value is not None and (name not in best or value < best[name]):
+            best[name] = value
+
+    for _ in range(repeat):
+        with _database(workdir, backend) as url:
+            steps, plain = upgrade(script, url=url)
+        auditor = audit_alembic.Auditor.create('bench')
+        timers = dict((name, Timer(auditor, name))
+                      for name in ('listen', 'make_row', '_ensure_table'))
+        with _database(workdir, backend) as url:
+            _, audited = upgrade(script, auditor, url=url)
+        keep('plain_s', plain)
+        keep('audited_s', audited)
+        keep('listen_us', timers['listen'].micros)
+        keep('make_row_us', timers['make_row'].micros)
+        keep('table_check_us', timers['_ensure_table'].micros)
+    best['steps'] = steps
+    best['overhead_us'] = 1e6 * (best['audited_s'] - best['plain_s']) / steps
+    return best
+
+
+def measure_offline(script, repeat):
+    plain = audited = None
+    for _ in range(repeat):
+        steps, seconds = upgrade(script, as_sql=True)
+        plain = min(plain or seconds, seconds)
+        _, seconds = upgrade(script, audit_alembic.Auditor.create('bench'),
+                             as_sql=True)
+        audited = min(audited or seconds, seconds)
+    return {'steps': steps, 'plain_s': plain, 'audited_s': audited,
+            'overhead_us': 1e6 * (audited - plain) / steps}
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes, shape_names, backends, repeat, log=print):
+    results = {}
+    workdir = tempfile.mkdtemp(prefix='audit-alembic-bench-')
+    try:
+        for shape in shape_names:
+            for size in sizes:
+                directory = os.path.join(workdir, '%s-%d' % (shape, size))
+                script = write_scripts(directory, shapes[shape](size))
+                # load the revision modules before timing anything
+                upgrade(script, url='sqlite://')
+                for backend in backends:
+                    key = '%s-%d/%s' % (shape, size, backend)
+                    results[key] = measure(script, workdir, backend, repeat)
+                    log(_format(key, results[key]))
+                key = '%s-%d/offline' % (shape, size)
+                results[key] = measure_offline(script, repeat)
+                log(_format(key, results[key]))
+    finally:
+        shutil.rmtree(workdir)
+    return {
+        'commit': _git_commit(),
+        'date': datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'sqlalchemy': sqlalchemy.__version__,
+        'alembic': alembic.__version__,
+        'results': results,
+    }
+
+
+_compared = ('overhead_us', 'listen_us', 'make_row_us', 'table_check_us')
+
+
+def _format(key, result):
+    return '%-24s %6d steps  %s' % (key, result['steps'], '  '.join(
+        '%s=%.1f' % (name, result[name])
+        for name in _compared if name in result))
+
+
+def compare(current, baseline, threshold, log=print):
+    """Print each measurement next to the baseline; return the keys of
+    those more than ``threshold`` slower."""
+    slower = []
+    for key in sorted(current['results']):
+        if key not in baseline['results']:
+            continue
+        now, then = current['results'][key], baseline['results'][key]
+        for name in _compared:
+            if now.get(name) is None or not then.get(name):
+                continue
+            ratio = now[name] / then[name]
+            flag = ''
+            # tiny overheads are all noise
+            if ratio > 1 + threshold and now[name] - then[name] > 1:
+                flag = '  SLOWER'
+                slower.append('%s %s' % (key, name))
+            log('%-24s %-15s %10.1f %10.1f %6.2fx%s' % (
+                key, name, then[name], now[name], ratio, flag))
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default='10,1000,10000',
+                        help='comma-separated numbers of revisions '
+                             '(default: %(default)s)')
+    parser.add_argument('--quick', action='store_true',
+                        help='same as --sizes 10,1000 --repeat 1')
+    parser.add_argument('--shapes', default=','.join(sorted(shapes)),
+                        help='comma-separated graph shapes among %s' %
+                             ', '.join(sorted(shapes)))
+    parser.add_argument('--backends', default='memory,file',
+                        help='comma-separated SQLite databases: memory, '
+                             'file (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per measurement, keeping the best')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='JSON results to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative slowdown flagged by --compare '
+                             '(default: %(default)s)')
+    args = parser.parse_args(argv)
+    sizes = [int(s) for s in args.sizes.split(',')]
+    repeat = args.repeat
+    if args.quick:
+        sizes, repeat = [10, 1000], 1
+    current = run(sizes, args.shapes.split(','), args.backends.split(','),
+                  repeat)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print('\ncompared with %s (%s)' % (baseline.get('commit'),
+                                           args.compare))
+        if compare(current, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -85,10 +85,12 @@ def read(*names, **kwargs):
         # eg:
         #   'rst': ['docutils>=0.11'],
         #   ':python_version=="2.6"': ['argparse'],
+        ':python_version=="2.7"': ['futures'],
+        'parquet': ['pyarrow'],
     },
     entry_points={
-        # 'console_scripts': [
-        #     'audit-alembic = audit_alembic.cli:main',
-        # ]
+        'console_scripts': [
+            'audit-alembic = audit_alembic.cli:main',
+        ]
     },
 )
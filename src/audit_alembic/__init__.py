@@ -1,6 +1,48 @@
 __version__ = "0.2.0"
 
+import sys
+
 from . import exc  # noqa: F401
-from .base import Auditor  # noqa: F401
-from .base import CommonColumnValues  # noqa: F401
-from .base import alembic_supports_callback  # noqa: F401
+from .compat import alembic_supports_callback  # noqa: F401
+from .compat import features  # noqa: F401
+
+# Names resolved on first access, so that importing the package from env.py
+# does not pull in SQLAlchemy until an Auditor is actually built.
+_lazy = {
+    'Auditor': 'base',
+    'CommonColumnValues': 'base',
+    'Memoized': 'base',
+    'memoize': 'base',
+    'StepMetric': 'base',
+    'base': None,
+    'cache': None,
+    'cli': None,
+    'current': None,
+    'dimensions': None,
+    'drift': None,
+    'export': None,
+    'fleet': None,
+    'metrics': None,
+    'predict': None,
+    'profiling': None,
+    'retention': None,
+    'sinks': None,
+    'verify': None,
+}
+
+
+def __getattr__(name):
+    if name not in _lazy:
+        raise AttributeError('module %r has no attribute %r'
+                             % (__name__, name))
+    from importlib import import_module
+    module = import_module('.' + (_lazy[name] or name), __name__)
+    value = module if _lazy[name] is None else getattr(module, name)
+    globals()[name] = value
+    return value
+
+
+if sys.version_info < (3, 7):  # pragma: no cover
+    # no module __getattr__ (PEP 562): import eagerly
+    for _name in _lazy:
+        __getattr__(_name)
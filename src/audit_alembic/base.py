@@ -1,28 +1,38 @@
+import collections
+import contextlib
 import functools
-import inspect
+import io
+import itertools
+import threading
+import time
 import warnings
+import weakref
 from datetime import datetime
 
-from alembic.operations import ops
 from sqlalchemy import CheckConstraint
 from sqlalchemy import Column
+from sqlalchemy import ForeignKey
+from sqlalchemy import Index
 from sqlalchemy import MetaData
 from sqlalchemy import Table
+from sqlalchemy import and_
+from sqlalchemy import event
+from sqlalchemy import select
 from sqlalchemy import types
+from sqlalchemy.engine import Connection
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.sql.expression import ClauseElement
 
 from . import exc
+from .cache import _persistent_key
+from .compat import alembic_supports_callback  # noqa: F401
 
-
-def alembic_supports_callback(configure_method=None):
-    """Inspect a method to tell whether it supports on_version_apply callback.
-
-    :meth:`.Auditor.setup` uses this essentially to ensure the correct version
-    of alembic is installed.
-    """
-    if configure_method is None:
-        from alembic import context
-        configure_method = context.configure
-    return 'on_version_apply' in inspect.getargspec(configure_method).args
+_clock = getattr(time, 'perf_counter', time.time)
+# weak references to runs, each detaching the run's event listeners once the
+# run is dropped
+_detachers = set()
+text_type = type(u'')
 
 
 class CommonColumnValues(object):
@@ -103,6 +113,390 @@ def old_alembic_version(step=None, separator='##', **_):
 ccv = CommonColumnValues()
 
 
+class Memoized(object):
+    """A column value callable whose result is reused within a scope.
+
+    Build instances with :func:`memoize`.
+    """
+
+    scopes = ('process', 'run', 'step')
+
+    def __init__(self, fn, scope='run'):
+        if not (scope in self.scopes or
+                isinstance(scope, (int, float)) and
+                not isinstance(scope, bool) and scope > 0):
+            raise exc.AuditConstructError('invalid memoization scope %r'
+                                          % (scope,))
+        if isinstance(fn, Memoized):
+            fn = fn.fn
+        # first, so that the attributes of a wrapped Memoized are not copied
+        functools.update_wrapper(self, fn)
+        self.fn = fn
+        self.scope = scope
+        self._lock = threading.Lock()
+        self._value = self._expires = None
+        self._runs = weakref.WeakKeyDictionary()
+
+    def _cached(self, ctx, key, now):
+        """Whether a value is held for this call, and that value."""
+        if self.scope == 'process':
+            return self._expires is not None, self._value
+        if self.scope in ('run', 'step'):
+            cached = self._runs.get(ctx) if ctx is not None else None
+            if cached is not None and cached[0] is key:
+                return True, cached[1]
+            return False, None
+        return self._expires is not None and now < self._expires, self._value
+
+    def _keep(self, ctx, key, now, value):
+        if self.scope == 'process':
+            self._value, self._expires = value, True
+        elif self.scope in ('run', 'step'):
+            if ctx is not None:
+                self._runs[ctx] = (key, value)
+        else:
+            self._value, self._expires = value, now + self.scope
+
+    def __call__(self, **kw):
+        ctx = kw.get('ctx')
+        key = kw.get('step') if self.scope == 'step' else None
+        now = _clock() if self.scope not in self.scopes else None
+        with self._lock:
+            found, value = self._cached(ctx, key, now)
+        if found:
+            return value
+        # computed without the lock, so that a slow callable does not hold up
+        # other threads; if one of them got there first, its value is kept
+        value = self.fn(**kw)
+        with self._lock:
+            found, cached = self._cached(ctx, key, now)
+            if found:
+                return cached
+            self._keep(ctx, key, now, value)
+        return value
+
+
+def memoize(fn, scope='run'):
+    """Reuse the result of a column value callable.
+
+    Useful for values that are expensive to compute and do not change from
+    one step to the next, such as a user version read from version control.
+
+    :param fn: a callable accepting the kwargs of alembic's on_version_apply
+        callback, as accepted for :paramref:`.Auditor.make_row` values.
+    :param scope: how long a result is reused:
+
+        * ``process``: computed once, for the life of the process.
+        * ``run``: once per migration context, i.e. per ``alembic`` command.
+        * ``step``: once per migration step, however many columns use it.
+        * a number: computed again once that many seconds have passed.
+    """
+    return Memoized(fn, scope)
+
+
+class StepMetric(object):
+    """A column value measured by the :class:`.Auditor` itself.
+
+    Use an instance as a value in :paramref:`.Auditor.make_row` or
+    :paramref:`.Auditor.create.extra_columns` to store a measurement taken
+    for each migration step. Available measurements:
+
+    * ``duration``: seconds elapsed since the step began, as a float. A step
+      begins when the previous step of the same run was recorded, or for the
+      first step, when :meth:`.Auditor.run` was entered; if there is no such
+      moment, the value is None. Time spent writing history rows, such as
+      buffered rows flushed at a commit, is left out.
+    * ``sql_statements``, ``sql_rows``, ``sql_time``: with
+      :paramref:`~.Auditor.instrument_sql`, the number of statements the
+      step executed, the number of rows they affected, and the seconds spent
+      in the database driver executing them. Like ``duration``, these cover
+      the first step of a run only within :meth:`.Auditor.run`.
+    * ``profile``, ``peak_memory``: with a :paramref:`~.Auditor.profiler`,
+      the step's profile and its peak traced memory; see
+      :class:`~audit_alembic.profiling.StepProfiler`. Steps are profiled only
+      within :meth:`.Auditor.run`.
+    * ``steps``: the number of steps the row stands for: 1, or more for a
+      range of stamps recorded by an auditor with
+      :paramref:`~.Auditor.compress_stamps`.
+
+    :param name: the name of the measurement.
+    """
+
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return 'StepMetric(%r)' % self.name
+
+
+@contextlib.contextmanager
+def _connect(bind):
+    """Yield a connection from an ``Engine``, or a ``Connection`` as is."""
+    if isinstance(bind, Connection):
+        yield bind
+    else:
+        with bind.connect() as conn:
+            yield conn
+
+
+def _script_directory(script):
+    """A ``ScriptDirectory``, given one, an alembic ``Config`` or the path
+    to an ``alembic.ini``."""
+    if hasattr(script, 'walk_revisions'):
+        return script
+    from alembic.config import Config
+    from alembic.script import ScriptDirectory
+    if not hasattr(script, 'get_main_option'):
+        script = Config(script)
+    return ScriptDirectory.from_config(script)
+
+
+def _pending_revisions(script, revision, current, downgrade=False):
+    """The ``Script`` of each step of migrating the ``ScriptDirectory``
+    ``script`` from the heads ``current`` to ``revision``, in the order
+    ``alembic upgrade`` (or ``downgrade``) would run them."""
+    revision_map = script.revision_map
+    if downgrade:
+        return list(revision_map.iterate_revisions(
+            current, revision, select_for_downgrade=True))
+    return list(reversed(list(revision_map.iterate_revisions(
+        revision, current, implicit_base=True))))
+
+
+def _row_size(row):
+    """Rough size in bytes of a row, used for buffer thresholds."""
+    size = 0
+    for val in row.values():
+        try:
+            size += len(val)
+        except TypeError:
+            size += 8
+    return size
+
+
+class _RowPlan(object):
+    """A ``make_row`` dict compiled once into constant, computed and
+    measured (:class:`.StepMetric`) columns.
+
+    :param table: the ``Table`` rows are destined for. Every key of
+        ``values`` must name one of its columns.
+    :param values: dict of column name to constant or callable value, as
+        accepted by :paramref:`.Auditor.make_row`.
+    :raise .AuditConstructError: if a key names no column of ``table``.
+    """
+
+    __slots__ = ('constants', 'computed', 'metrics')
+
+    def __init__(self, table, values):
+        unknown = sorted(k for k in values if k not in table.c)
+        if unknown:
+            raise exc.AuditConstructError('no column(s) %s in table %s' % (
+                ', '.join(unknown), table.name))
+        self.constants = dict((k, v) for k, v in values.items()
+                              if not (callable(v) or
+                                      isinstance(v, StepMetric)))
+        self.computed = tuple((k, v) for k, v in values.items()
+                              if callable(v))
+        self.metrics = tuple((k, v.name) for k, v in values.items()
+                             if isinstance(v, StepMetric))
+
+    def __call__(self, kw, metrics=None):
+        row = self.constants.copy()
+        for name, fn in self.computed:
+            row[name] = fn(**kw)
+        if self.metrics:
+            metrics = metrics or {}
+            for name, metric in self.metrics:
+                row[name] = metrics.get(metric)
+        return row
+
+
+class _Span(object):
+    """A ``MigrationInfo`` standing for a range of steps: that of the last
+    step, but with the source revisions of the first."""
+
+    def __init__(self, first, last):
+        self._first = first
+        self._last = last
+
+    @property
+    def source_revision_ids(self):
+        return self._first.source_revision_ids
+
+    def __getattr__(self, name):
+        return getattr(self._last, name)
+
+
+class _StampRange(object):
+    """Consecutive stamp steps of a run in one direction, pending until they
+    are recorded as one row.
+
+    :param ctx: the ``MigrationContext``.
+    :param kw: the on_version_apply kwargs of the first step.
+    :param metrics: the measurements of the first step.
+    """
+
+    def __init__(self, ctx, kw, metrics):
+        self.ctx = ctx
+        self.first = kw['step']
+        self.kw = kw
+        self.metrics = dict(metrics, steps=1)
+
+    def extends(self, step):
+        return step.is_stamp and step.is_upgrade == self.first.is_upgrade
+
+    def add(self, kw, metrics):
+        duration = self.metrics.get('duration')
+        if duration is not None and metrics.get('duration') is not None:
+            duration += metrics['duration']
+        self.kw = kw
+        self.metrics = dict(metrics, steps=self.metrics['steps'] + 1,
+                            duration=duration)
+
+    def step_kw(self):
+        """The kwargs to build the row with."""
+        return dict(self.kw, step=_Span(self.first, self.kw['step']))
+
+
+def _remove_listeners(listeners):
+    while listeners:
+        target, identifier, fn = listeners.pop()
+        if event.contains(target, identifier, fn):
+            event.remove(target, identifier, fn)
+
+
+class _Run(object):
+    """State kept by an :class:`.Auditor` for one migration run, that is for
+    one ``MigrationContext``.
+
+    :param impl: the context's ``DefaultImpl``, through which rows are
+        written. We hold this rather than the context itself so that the
+        context may be garbage collected once the run is over.
+    :param explicit: whether the run was opened by :meth:`.Auditor.run`, in
+        which case we can rely on it to flush at the end.
+
+    Buffered rows are held in :attr:`rows`; for an auditor with
+    :paramref:`~.Auditor.revisions`, each is a ``(row, revisions)`` pair.
+    """
+
+    def __init__(self, impl, explicit=False, profiler=None):
+        self.impl = impl
+        self.explicit = explicit
+        self.profiler = profiler
+        self.profiling = None
+        self.rows = []
+        self.nbytes = 0
+        self.step_started = None
+        self.metrics = {}
+        self.writing = False
+        self.sql = None
+        listeners = self._listeners = []
+
+        def detach(ref):
+            _detachers.discard(ref)
+            _remove_listeners(listeners)
+
+        _detachers.add(weakref.ref(self, detach))
+        self.revision_ids = {}
+        self.stamps = None
+        self.created_table = False
+        self.dimension_ids = collections.defaultdict(dict)
+        # set by a metrics Emitter
+        self.id = None
+        self.started_at = None
+        self.clock_started = None
+        self.steps = 0
+        # for a CurrentState: heads after the last row built, and those that
+        # arrived since the table was last written
+        self.heads = None
+        self.pending_heads = {}
+        if explicit:
+            self.begin_step()
+
+    def begin_step(self):
+        self.step_started = _clock()
+        if self.sql is not None:
+            self.sql = [0, 0, 0.0]
+        # without an explicit run we could not tell when to stop profiling
+        # after the last step
+        if self.profiler is not None and self.explicit:
+            self.profiling = self.profiler.start()
+
+    def end_step(self, step=None):
+        """Take measurements of the step just completed."""
+        if self.step_started is None:
+            duration = None
+        else:
+            duration = _clock() - self.step_started
+        self.metrics = {'duration': duration, 'steps': 1}
+        if self.sql is not None:
+            self.metrics.update(zip(
+                ('sql_statements', 'sql_rows', 'sql_time'), self.sql))
+        if self.profiler is not None:
+            self.metrics.update(self.profiler.stop(self.profiling, step))
+            self.profiling = None
+
+    def end(self):
+        """Release what was set up to measure steps."""
+        if self.profiling is not None:
+            self.profiler.cancel(self.profiling)
+            self.profiling = None
+        _remove_listeners(self._listeners)
+
+    def listen(self, target, identifier, fn):
+        """Attach an event listener until :meth:`end` is called or the run is
+        dropped, as implicit runs are along with their migration context.
+        ``fn`` should only hold a weak reference to the run."""
+        event.listen(target, identifier, fn)
+        self._listeners.append((target, identifier, fn))
+
+    def watch_sql(self, connection):
+        """Count statements, affected rows and time spent executing them on
+        ``connection``, leaving out the auditor's own writes."""
+        self.sql = [0, 0, 0.0]
+        started = []
+        ref = weakref.ref(self)
+
+        def before(conn, cursor, statement, parameters, context, many):
+            run = ref()
+            if run is not None and not run.writing:
+                started.append(_clock())
+
+        def after(conn, cursor, statement, parameters, context, many):
+            run = ref()
+            if run is not None and not run.writing and started:
+                run.sql[0] += 1
+                if cursor.rowcount > 0:
+                    run.sql[1] += cursor.rowcount
+                run.sql[2] += _clock() - started.pop()
+
+        self.listen(connection, 'before_cursor_execute', before)
+        self.listen(connection, 'after_cursor_execute', after)
+
+    def take(self):
+        rows, self.rows, self.nbytes = self.rows, [], 0
+        return rows
+
+    def discard(self):
+        """Forget rows and stamps not yet written."""
+        self.stamps = None
+        self.heads = None
+        self.pending_heads = {}
+        self.take()
+
+    @property
+    def in_transaction(self):
+        """Whether rows buffered now will be flushed at a commit."""
+        if self.impl.as_sql:
+            # offline, migrations are emitted within BEGIN/COMMIT exactly
+            # when the backend has transactional DDL
+            return self.impl.transactional_ddl
+        conn = self.impl.connection
+        return conn is not None and conn.in_transaction()
+
+
 class Auditor(object):
     """Watches Alembic operations, creates and populates a history table.
 
@@ -124,18 +518,162 @@ class Auditor(object):
         table. Otherwise, it must itself be a valid dict.
 
         A valid dict must provide keys corresponding to columns of
-        :paramref:`~.Auditor.table`. Each value must be a valid input for its
+        :paramref:`~.Auditor.table`; a dict given here is checked against the
+        table up front and compiled once, so that building a row needs no
+        further inspection. Each value must be a valid input for its
         corresponding column; it may also be callable, in which case it takes
         the kwargs provided by alembic's on_version_apply and returns valid
-        input for its corresponding column.
+        input for its corresponding column. A :class:`.StepMetric` value
+        stores a measurement taken by the auditor.
+    :param buffered: if true, rows are collected in memory and written with
+        a single multi-row insert per flush rather than one insert per
+        migration step. A flush happens when the migration transaction
+        commits, when a run opened with :meth:`.Auditor.run` ends, or when
+        one of the thresholds below is reached. Rows buffered while no
+        transaction is open and no run is open are written at once.
+    :param flush_rows: flush once this many rows are buffered. Implies
+        :paramref:`~.Auditor.buffered`.
+    :param flush_bytes: flush once the buffered rows hold roughly this many
+        bytes of data. Implies :paramref:`~.Auditor.buffered`.
+    :param table_cache: a :class:`~audit_alembic.cache.TableCache`. If
+        given, the table is created without first checking the database for
+        it when the cache already knows it exists.
+    :param sink: a :class:`~audit_alembic.sinks.Sink`. If given, rows are
+        handed to it instead of being inserted on the migration connection,
+        e.g. a :class:`~audit_alembic.sinks.ThreadedSink` writing them to
+        another database from a background thread.
+    :param instrument_sql: if true, count the statements each migration step
+        executes on the migration connection, the rows they affect and the
+        time spent executing them, for use as :class:`.StepMetric` values.
+        Has no effect in offline mode.
+    :param profiler: a :class:`~audit_alembic.profiling.StepProfiler`
+        profiling each step of a run opened with :meth:`.Auditor.run`, for
+        use as :class:`.StepMetric` values.
+    :param offline_output: a path or writable text file. In offline
+        (``--sql``) mode, the statements creating and populating the table are
+        written there rather than into the migration script.
+    :param roles: a dict telling the read APIs, such as :meth:`history`,
+        which column of :paramref:`~.Auditor.table` holds what. Keys are
+        ``id``, ``alembic_version``, ``prev_alembic_version``,
+        ``operation_type``, ``operation_direction``, ``user_version``,
+        ``changed_at``, ``duration`` and ``steps``; values are column names. By default
+        each role is filled by the column of the same name, if any.
+        :meth:`create` fills this in for the table it defines.
+    :param version_separator: the delimiter joining several revisions in the
+        ``alembic_version`` and ``prev_alembic_version`` columns.
+    :param revisions: a :class:`~audit_alembic.dimensions.RevisionLinks`.
+        If given, the revisions of each step are stored in its tables rather
+        than in columns of :paramref:`~.Auditor.table`. Each revision is
+        looked up or inserted once per run. Cannot be combined with a
+        :paramref:`~.Auditor.sink`.
+    :param dimensions: a dict of column name to
+        :class:`~audit_alembic.dimensions.Dimension`. The values built for
+        each such column are stored in the dimension's table, and the column
+        holds their ids. Each value is looked up or inserted once per run.
+        Cannot be combined with a :paramref:`~.Auditor.sink`.
+    :param compress_stamps: if true, consecutive stamp steps of a run in the
+        same direction are recorded as a single row, from the source
+        revisions of the first to the destination revisions of the last;
+        the ``steps`` :class:`.StepMetric` counts them. Migrations are still
+        recorded one row per step. The range ends with the transaction, or
+        with the :meth:`.Auditor.run` block; where there is neither, stamps
+        are recorded one row per step.
+    :param metrics: a list of :class:`~audit_alembic.metrics.Exporter`, such
+        as :class:`~audit_alembic.metrics.PrometheusTextfile`, given an event
+        for each step and for each run opened with :meth:`.Auditor.run`.
+        Events are exported from a background thread, by
+        :attr:`.Auditor.emitter`.
+    :param current_state: a :class:`~audit_alembic.current.CurrentState`,
+        whose table of the database's current heads is rewritten with each
+        write of rows. Cannot be combined with a
+        :paramref:`~.Auditor.sink`.
+
+    In offline mode, rows are rendered as INSERT statements in the script. A
+    buffered auditor renders each flush as a single multi-row INSERT (where
+    the dialect supports it): just before each COMMIT on backends with
+    transactional DDL, and otherwise when the :meth:`.Auditor.run` block
+    ends.
+
+    An auditor may be shared by threads migrating different databases at the
+    same time: all state kept for a run belongs to its ``MigrationContext``,
+    and whether the tables exist is tracked per database URL, under a lock.
+    The contract is:
+
+    * each ``MigrationContext`` is used by one thread at a time, as alembic
+      requires anyway;
+    * a given database is migrated by one thread at a time;
+    * values of :paramref:`~.Auditor.make_row` are safe to call from several
+      threads, as are :func:`.memoize` results and
+      :class:`.CommonColumnValues`;
+    * a :paramref:`~.Auditor.table_cache`, :paramref:`~.Auditor.sink` or
+      :paramref:`~.Auditor.offline_output` file may be shared; ``tracemalloc``
+      however traces the whole process, so the peak memory measured by a
+      :paramref:`~.Auditor.profiler` includes other threads' allocations.
+
+    Note that alembic's ``command`` functions and the ``alembic.context``
+    proxy are not thread-safe: concurrent runs must each configure their own
+    ``MigrationContext``.
     """
 
-    def __init__(self, table, make_row):
+    def __init__(self, table, make_row, buffered=False, flush_rows=None,
+                 flush_bytes=None, table_cache=None, sink=None,
+                 instrument_sql=False, profiler=None, offline_output=None,
+                 roles=None, version_separator='##', revisions=None,
+                 dimensions=None, compress_stamps=False, metrics=None,
+                 current_state=None):
         self.table = table
         if not (callable(make_row) or hasattr(make_row, 'items')):
             raise exc.AuditConstructError('invalid make_rows argument')
         self._make_row = make_row
-        self.created_table = False
+        self._plan = None if callable(make_row) else _RowPlan(table, make_row)
+        self.buffered = bool(buffered or flush_rows or flush_bytes)
+        self.flush_rows = flush_rows
+        self.flush_bytes = flush_bytes
+        self.table_cache = table_cache
+        self.sink = sink
+        self.instrument_sql = instrument_sql
+        self.profiler = profiler
+        self.offline_output = offline_output
+        self.roles = dict((role, role) for role in self.role_names
+                          if role in table.c)
+        self.roles.update(roles or {})
+        self.version_separator = version_separator
+        if (revisions is not None or dimensions) and sink is not None:
+            raise exc.AuditConstructError(
+                'a sink cannot write normalized values')
+        if current_state is not None and sink is not None:
+            raise exc.AuditConstructError(
+                'a sink cannot maintain the current state')
+        self.current_state = current_state
+        self.revisions = revisions
+        self.dimensions = dict(dimensions or {})
+        self.compress_stamps = compress_stamps
+        self.emitter = None
+        if metrics:
+            from .metrics import Emitter
+            self.emitter = Emitter(metrics)
+        self._runs = weakref.WeakKeyDictionary()
+        self._lock = threading.RLock()
+        # databases, by _database_key, on which the tables are known to exist
+        self._created = set()
+        self._creating = {}
+        # keys of engines of databases that live no longer than the engine
+        self._engines = weakref.WeakKeyDictionary()
+
+    role_names = ('id', 'alembic_version', 'prev_alembic_version',
+                  'operation_type', 'operation_direction', 'user_version',
+                  'changed_at', 'duration', 'steps')
+
+    def column(self, role):
+        """The column of :paramref:`~.Auditor.table` filling ``role``.
+
+        :raise .AuditRuntimeError: if no column fills it.
+        """
+        name = self.roles.get(role)
+        if name is None or name not in self.table.c:
+            raise exc.AuditRuntimeError('table %s has no %s column'
+                                        % (self.table.name, role))
+        return self.table.c[name]
 
     @staticmethod
     def version_warn(msg='null user version', stacklevel=2):
@@ -155,7 +693,18 @@ def create(cls,
                alembic_version_separator='##',
                alembic_version_column_name='alembic_version',
                prev_alembic_version_column_name='prev_alembic_version',
-               change_time_column_name='changed_at',):
+               change_time_column_name='changed_at',
+               duration_column_name=None,
+               sql_stats_column_prefix='sql_',
+               profile_column_name='profile',
+               peak_memory_column_name='peak_memory',
+               user_version_scope=None,
+               indexes=True,
+               normalize_revisions=False,
+               normalize_user_version=False,
+               step_count_column_name='steps',
+               current_state=False,
+               **kw):
         """Autocreate a history table.
 
         This table contains columns for:
@@ -190,6 +739,26 @@ def create(cls,
             If you pass ``None``, a warning will be raised.
 
         :param user_version_nullable: Suppresses the above-mentioned warning.
+        :param indexes: if true, the default, index the columns storing the
+            change time, the alembic version and the user version, which
+            :meth:`.Auditor.history` filters on. Note that indexes are created
+            along with the table only; add them to an existing table with a
+            migration of your own.
+        :param normalize_revisions: if true, store revisions once each in a
+            table of their own, named after the history table with the suffix
+            ``_revision``, and link each history row to its source and
+            destination revisions through a table with the suffix
+            ``_revision_link``. The alembic version columns are left out,
+            along with their names and separator. See
+            :mod:`audit_alembic.dimensions`.
+        :param normalize_user_version: if true, store each distinct user
+            version once in a table named after the history table with the
+            suffix ``_user_version``, the user version column holding its
+            integer id instead.
+        :param user_version_scope: if
+            :paramref:`~.Auditor.create.user_version` is callable, reuse its
+            result within this scope; see :func:`.memoize`. By default it is
+            called for every step.
         :param table_name: The name of the version history table.
         :param metadata: The SQLAlchemy MetaData object with which the table
             is to be created. If not provided, a new one will be created.
@@ -199,7 +768,9 @@ def create(cls,
             ``val`` is a value for it, expressed the same way as
             :paramref:`~.Auditor.create.user_version`: as a constant,
             type-appropriate value, or a function of kwargs returning such a
-            value.
+            value. An element may also be a 3-tuple ``(col, val, scope)``,
+            in which case the callable ``val`` is memoized with ``scope`` as
+            described in :func:`.memoize`.
         :param user_version_column_name: the name used for the column
             storing the value of :paramref:`~.Auditor.create.user_version`.
         :param user_version_type: the SQL type of
@@ -232,6 +803,30 @@ def create(cls,
             together with ``alembic_version_separator`` as the delimiter.
         :param change_time_column_name: the name of the column storing the
             time of this migration
+        :param duration_column_name: if given, add a column of this name
+            storing how long each migration step took, in seconds. See
+            :class:`.StepMetric` for when a step is considered to begin; in
+            short, wrap ``context.run_migrations()`` in :meth:`.Auditor.run`
+            to time the first step of each run as well.
+        :param sql_stats_column_prefix: if the auditor is created with
+            :paramref:`~.Auditor.instrument_sql`, columns ``statements``,
+            ``rows`` and ``time``, with this prefix, are added for the
+            corresponding :class:`.StepMetric` values.
+        :param profile_column_name: if the auditor is created with a
+            :paramref:`~.Auditor.profiler`, the name of the column storing
+            each step's profile: a compressed summary, or the name of the
+            file holding it if the profiler writes to a directory.
+        :param peak_memory_column_name: likewise, the name of the column
+            storing each step's peak memory, if the profiler traces memory.
+        :param step_count_column_name: if the auditor is created with
+            :paramref:`~.Auditor.compress_stamps`, the name of the column
+            storing how many steps each row stands for.
+        :param current_state: if true, also maintain a table of the current
+            heads of the database, named after the history table with the
+            suffix ``_current``. See :mod:`audit_alembic.current`.
+
+        Any further keyword arguments are passed on to the :class:`.Auditor`
+        constructor, e.g. :paramref:`~.Auditor.buffered`.
 
         """
         if not user_version_nullable:
@@ -245,53 +840,386 @@ def user_version(**kw):
                     if val is None:
                         cls.version_warn(stacklevel=1)
                     return val
+        if user_version_scope is not None and callable(user_version):
+            user_version = memoize(user_version, user_version_scope)
 
         if metadata is None:
             metadata = MetaData()
 
         alembic_version_type = types.String(255)
 
+        if normalize_user_version:
+            from .dimensions import Dimension
+            user_versions = Dimension.define(
+                '%s_user_version' % table_name, metadata, 'user_version',
+                user_version_type)
+            kw['dimensions'] = {user_version_column_name: user_versions}
+            user_version_column = Column(user_version_column_name,
+                                         types.Integer,
+                                         ForeignKey(user_versions.id))
+        else:
+            user_version_column = Column(user_version_column_name,
+                                         user_version_type)
+
         columns = [
             Column('id', types.BIGINT().with_variant(types.Integer, 'sqlite'),
                    primary_key=True),
-            Column(alembic_version_column_name, alembic_version_type),
-            Column(prev_alembic_version_column_name, alembic_version_type),
-            CheckConstraint(
-                'coalesce(%s, %s) IS NOT NULL' % (
-                    alembic_version_column_name,
-                    prev_alembic_version_column_name),
-                name='alembic_versions_nonnull'),
             Column(operation_column_name, types.String(32), nullable=False),
             Column(direction_column_name, types.String(32), nullable=False),
-            Column(user_version_column_name, user_version_type),
+            user_version_column,
             Column(change_time_column_name, types.DateTime())
         ]
-
-        def alembic_vers(f):
-            return functools.partial(f, separator=alembic_version_separator)
-
         col_vals = {
-            alembic_version_column_name: alembic_vers(ccv.new_alembic_version),
-            prev_alembic_version_column_name: alembic_vers(
-                ccv.old_alembic_version),
             operation_column_name: ccv.operation_type,
             direction_column_name: ccv.operation_direction,
             user_version_column_name: user_version,
             change_time_column_name: ccv.change_time,
         }
-        for col, val in extra_columns:
+        roles = {
+            'operation_type': operation_column_name,
+            'operation_direction': direction_column_name,
+            'user_version': user_version_column_name,
+            'changed_at': change_time_column_name,
+        }
+        indexed = [change_time_column_name, user_version_column_name]
+
+        if not normalize_revisions:
+            columns[1:1] = [
+                Column(alembic_version_column_name, alembic_version_type),
+                Column(prev_alembic_version_column_name,
+                       alembic_version_type),
+                CheckConstraint(
+                    'coalesce(%s, %s) IS NOT NULL' % (
+                        alembic_version_column_name,
+                        prev_alembic_version_column_name),
+                    name='alembic_versions_nonnull'),
+            ]
+
+            def alembic_vers(f):
+                return functools.partial(f,
+                                         separator=alembic_version_separator)
+
+            col_vals[alembic_version_column_name] = alembic_vers(
+                ccv.new_alembic_version)
+            col_vals[prev_alembic_version_column_name] = alembic_vers(
+                ccv.old_alembic_version)
+            roles['alembic_version'] = alembic_version_column_name
+            roles['prev_alembic_version'] = prev_alembic_version_column_name
+            indexed.insert(1, alembic_version_column_name)
+        if duration_column_name:
+            columns.append(Column(duration_column_name, types.Float()))
+            col_vals[duration_column_name] = StepMetric('duration')
+        if kw.get('instrument_sql'):
+            for metric, type_ in (('statements', types.Integer()),
+                                  ('rows', types.Integer()),
+                                  ('time', types.Float())):
+                name = sql_stats_column_prefix + metric
+                columns.append(Column(name, type_))
+                col_vals[name] = StepMetric('sql_' + metric)
+        if kw.get('compress_stamps'):
+            columns.append(Column(step_count_column_name, types.Integer(),
+                                  nullable=False, default=1))
+            col_vals[step_count_column_name] = StepMetric('steps')
+            roles['steps'] = step_count_column_name
+        profiler = kw.get('profiler')
+        if profiler is not None:
+            if profiler.cprofile:
+                columns.append(Column(
+                    profile_column_name,
+                    types.String(255) if profiler.directory
+                    else types.LargeBinary()))
+                col_vals[profile_column_name] = StepMetric('profile')
+            if profiler.memory:
+                columns.append(Column(peak_memory_column_name,
+                                      types.BigInteger()))
+                col_vals[peak_memory_column_name] = StepMetric('peak_memory')
+        for extra in extra_columns:
+            col, val = extra[:2]
+            if len(extra) > 2 and extra[2] is not None and callable(val):
+                val = memoize(val, extra[2])
             columns.append(col)
             if col.name in col_vals:
                 raise exc.AuditCreateError('value %s used twice' % col.name)
             col_vals[col.name] = val
 
-        auditor = cls(Table(table_name, metadata, *columns), col_vals)
+        if indexes:
+            for name in indexed:
+                columns.append(Index('ix_%s_%s' % (table_name, name), name))
+
+        if duration_column_name:
+            roles['duration'] = duration_column_name
+        kw['roles'] = roles
+        kw['version_separator'] = alembic_version_separator
+        table = Table(table_name, metadata, *columns)
+        if normalize_revisions:
+            from .dimensions import RevisionLinks
+            kw['revisions'] = RevisionLinks.define(table, metadata)
+        if current_state:
+            from .current import CurrentState
+            kw['current_state'] = CurrentState.define(
+                table, metadata, user_version_type=user_version_type)
+        auditor = cls(table, col_vals, **kw)
         return auditor
 
+    def history(self, bind, revision=None, prev_revision=None,
+                user_version=None, operation_type=None, direction=None,
+                since=None, until=None, after_id=None, limit=None,
+                newest_first=False, batch_size=1000):
+        """Iterate over rows of the history table, as dicts keyed by column
+        name. With :paramref:`~.Auditor.revisions`, the revisions of each
+        row are added under the keys ``alembic_version`` and
+        ``prev_alembic_version``, joined by
+        :paramref:`~.Auditor.version_separator`. Columns of
+        :paramref:`~.Auditor.dimensions` hold values rather than ids.
+
+        Rows are read in batches of ascending (or descending) id, each batch
+        picking up after the last id of the previous one, so that the cost
+        of a batch does not grow with how far iteration has gone. Each batch
+        is fetched whole before its rows are yielded, and no cursor is left
+        open between batches, so memory use is bounded by ``batch_size`` and
+        the connection may be used while iterating.
+
+        Examples::
+
+            # when did revision X land?
+            auditor.history(engine, revision=x, direction='up')
+            # what ran under release 1.2?
+            auditor.history(engine, user_version='1.2')
+            # the last 10 operations
+            auditor.history(engine, limit=10, newest_first=True)
+
+        :param bind: an ``Engine`` or ``Connection``.
+        :param revision: only rows whose alembic version is this; where a
+            step leaves several heads, give them joined by
+            :paramref:`~.Auditor.version_separator`. With
+            :paramref:`~.Auditor.revisions`, rows with this revision among
+            their destination revisions.
+        :param prev_revision: likewise, only rows whose previous alembic
+            version is this.
+        :param user_version: only rows with this user version.
+        :param operation_type: only rows of this type, e.g. ``migration``.
+        :param direction: only rows of this direction, ``up`` or ``down``.
+        :param since: only rows changed at or after this datetime.
+        :param until: only rows changed before this datetime.
+        :param after_id: resume iteration after the row with this id.
+        :param limit: stop after this many rows.
+        :param newest_first: iterate in descending order of id.
+        :param batch_size: how many rows to fetch per query.
+        """
+        clauses = []
+        id_col = self.column('id')
+        if self.revisions is not None:
+            for kind, value in (('destination', revision),
+                                ('source', prev_revision)):
+                if value is not None:
+                    clauses.append(self.revisions.having(id_col, value, kind))
+            revision = prev_revision = None
+        for role, value in (('alembic_version', revision),
+                            ('prev_alembic_version', prev_revision),
+                            ('user_version', user_version),
+                            ('operation_type', operation_type),
+                            ('operation_direction', direction)):
+            if value is not None:
+                column = self.column(role)
+                if column.key in self.dimensions:
+                    column = self.dimensions[column.key].value
+                clauses.append(column == value)
+        if since is not None:
+            clauses.append(self.column('changed_at') >= since)
+        if until is not None:
+            clauses.append(self.column('changed_at') < until)
+        with _connect(bind) as conn:
+            remaining = limit
+            while remaining is None or remaining > 0:
+                size = batch_size if remaining is None else min(batch_size,
+                                                                remaining)
+                where = list(clauses)
+                if after_id is not None:
+                    where.append(id_col < after_id if newest_first
+                                 else id_col > after_id)
+                q = self._select().where(and_(*where)).order_by(
+                    id_col.desc() if newest_first else id_col).limit(size)
+                rows = conn.execute(q).fetchall()
+                linked = {}
+                if self.revisions is not None and rows:
+                    linked = self.revisions.fetch(
+                        conn, [row[id_col] for row in rows])
+                for row in rows:
+                    found = dict(row)
+                    if self.revisions is not None:
+                        sources, destinations = linked[row[id_col]]
+                        found['prev_alembic_version'] = \
+                            self.version_separator.join(sources)
+                        found['alembic_version'] = \
+                            self.version_separator.join(destinations)
+                    yield found
+                if len(rows) < size:
+                    break
+                after_id = rows[-1][id_col]
+                if remaining is not None:
+                    remaining -= len(rows)
+
+    def durations(self, bind, revisions=None, direction='up', after_id=None,
+                  batch_size=1000):
+        """Iterate over the recorded durations of migration steps.
+
+        Only migrations (not stamps) with a duration are read. The revision
+        of a step is the one it applies, i.e. its destination when going
+        up, its source when going down. Rows are read in batches of
+        ascending id, like :meth:`history`.
+
+        :param bind: an ``Engine`` or ``Connection``.
+        :param revisions: if given, only steps applying one of these
+            revisions, looked up by index.
+        :param direction: ``up`` or ``down``.
+        :param after_id: only rows after the one with this id.
+        :param batch_size: how many rows to fetch per query.
+        :return: an iterator of ``(id, revision, duration)``.
+        """
+        source, id_col, revision, duration, where = \
+            self._durations_query(direction)
+        if revisions is None:
+            chunks = [None]
+        else:
+            revisions = sorted(set(revisions))
+            chunks = [revisions[i:i + 500]
+                      for i in range(0, len(revisions), 500)]
+        with _connect(bind) as conn:
+            for chunk in chunks:
+                clauses = list(where)
+                if chunk is not None:
+                    clauses.append(revision.in_(chunk))
+                last = after_id
+                while True:
+                    q = select([id_col, revision, duration]).select_from(
+                        source).where(and_(*clauses))
+                    if last is not None:
+                        q = q.where(id_col > last)
+                    rows = conn.execute(
+                        q.order_by(id_col).limit(batch_size)).fetchall()
+                    for row in rows:
+                        yield tuple(row)
+                    if len(rows) < batch_size:
+                        break
+                    last = rows[-1][0]
+
+    def _durations_query(self, direction):
+        """The source, id, revision and duration columns, and the criteria,
+        of the recorded durations of migration steps in ``direction``."""
+        # with dimensions, read their values from the joined select
+        source = self._select().alias() if self.dimensions else self.table
+        c = source.c
+        id_col = c[self.column('id').key]
+        duration = c[self.column('duration').key]
+        where = [c[self.column('operation_type').key] == 'migration',
+                 c[self.column('operation_direction').key] == direction,
+                 duration.isnot(None)]
+        if self.revisions is not None:
+            links = self.revisions.table
+            dimension = self.revisions.revisions
+            revision = dimension.value
+            source = source.join(links, links.c.history_id == id_col).join(
+                dimension.table, links.c.revision_id == dimension.id)
+            where.append(links.c.kind == ('destination' if direction == 'up'
+                                          else 'source'))
+        else:
+            revision = c[self.column('alembic_version' if direction == 'up'
+                                     else 'prev_alembic_version').key]
+        return source, id_col, revision, duration, where
+
+    def duration_percentiles(self, bind, revisions, fractions=(.5, .95),
+                             direction='up'):
+        """Summarize the recorded durations of migration steps applying each
+        of ``revisions``. Their durations are read in a single query per
+        500 revisions, sorted by the database, rather than the whole history.
+
+        Quantiles interpolate linearly between the closest ranks, with
+        :func:`~audit_alembic.predict.percentile`.
+
+        :param bind: an ``Engine`` or ``Connection``.
+        :param revisions: the revisions to summarize.
+        :param fractions: the quantiles to compute, e.g. ``.5`` for the
+            median.
+        :param direction: ``up`` or ``down``.
+        :return: a dict of revision to ``(count, quantiles)``, for the
+            revisions with at least one recorded duration.
+        """
+        from .predict import percentile
+        source, _, revision, duration, where = self._durations_query(
+            direction)
+        revisions = sorted(set(revisions))
+        found = {}
+        with _connect(bind) as conn:
+            for i in range(0, len(revisions), 500):
+                rows = conn.execute(
+                    select([revision, duration]).select_from(source)
+                    .where(and_(revision.in_(revisions[i:i + 500]), *where))
+                    .order_by(revision, duration))
+                for rev, group in itertools.groupby(rows, lambda r: r[0]):
+                    values = [r[1] for r in group]
+                    found[rev] = (len(values), [percentile(values, fraction)
+                                                for fraction in fractions])
+        return found
+
+    def verify(self, bind, script, graph=None, batch_size=1000):
+        """Check the history table against the revision graph of ``script``,
+        replaying its rows in order of id; see :mod:`audit_alembic.verify`.
+
+        Rows are read lazily as the result is iterated over, like
+        :meth:`history`, so the check takes a single pass over the table.
+
+        Example::
+
+            for issue in auditor.verify(engine, 'alembic.ini'):
+                print(issue.id, issue.kind, issue.message)
+
+        :param bind: an ``Engine`` or ``Connection``.
+        :param script: the ``ScriptDirectory`` of the migrations, or an alembic
+            ``Config`` or the path to an ``alembic.ini`` locating it.
+        :param graph: a :class:`~audit_alembic.verify.RevisionGraph` of
+            ``script``, to reuse across several checks.
+        :param batch_size: how many rows to fetch per query.
+        :return: a :class:`~audit_alembic.verify.Verification`, an iterator
+            of :class:`~audit_alembic.verify.Issue`.
+        """
+        from .verify import RevisionGraph
+        from .verify import Verification
+        if graph is None:
+            graph = RevisionGraph(_script_directory(script))
+        keys = {}
+        for role in ('id', 'alembic_version', 'prev_alembic_version',
+                     'operation_type', 'operation_direction'):
+            if self.revisions is not None and role.endswith('alembic_version'):
+                keys[role] = role
+            else:
+                keys[role] = self.column(role).key
+        if 'changed_at' in self.roles:
+            keys['changed_at'] = self.column('changed_at').key
+        return Verification(self.history(bind, batch_size=batch_size), graph,
+                            keys, self.version_separator)
+
+    def _select(self):
+        """Select the history table, with values of dimension columns in
+        place of their ids."""
+        if not self.dimensions:
+            return select([self.table])
+        joined = self.table
+        columns = []
+        for column in self.table.c:
+            dimension = self.dimensions.get(column.key)
+            if dimension is None:
+                columns.append(column)
+            else:
+                joined = joined.outerjoin(dimension.table,
+                                          column == dimension.id)
+                columns.append(dimension.value.label(column.key))
+        return select(columns).select_from(joined)
+
     def make_row(self, **kw):
-        make_row = self._make_row
-        if callable(make_row):
-            make_row = make_row(**kw)
+        if self._plan is not None:
+            run = self._runs.get(kw.get('ctx'))
+            return self._plan(kw, run.metrics if run is not None else None)
+        make_row = self._make_row(**kw)
         if not hasattr(make_row, 'items'):
             raise exc.AuditRuntimeError('make_row() should return a dict, '
                                         'instead got %r' % repr(make_row))
@@ -299,12 +1227,375 @@ def make_row(self, **kw):
                     for k, v in make_row.items()}
         return make_row
 
-    def listen(self, ctx=None, warn_user_version=True, **kw):
-        from alembic import op
-        if not self.created_table:
-            if ctx.as_sql:
-                op.invoke(ops.CreateTableOp.from_table(self.table))
+    def _get_run(self, ctx, explicit=False):
+        with self._lock:
+            run = self._runs.get(ctx)
+            if run is None:
+                run = self._runs[ctx] = _Run(ctx.impl, explicit,
+                                             self.profiler)
+                new = True
             else:
-                self.table.create(ctx.connection, checkfirst=True)
-            self.created_table = True
-        op.bulk_insert(self.table, [self.make_row(ctx=ctx, **kw)])
+                new = False
+        if new:
+            if self.emitter is not None:
+                self.emitter.begin(run)
+            holds = self.buffered or self.compress_stamps
+            if holds and ctx.as_sql:
+                self._watch_offline_transactions(ctx.impl, run)
+            elif holds:
+                self._watch_transactions(ctx.connection, run)
+            if self.instrument_sql and not ctx.as_sql:
+                run.watch_sql(ctx.connection)
+        elif explicit:
+            run.explicit = True
+            run.begin_step()
+        return run
+
+    def _watch_transactions(self, connection, run):
+        """Flush buffered rows just before the migration transaction commits,
+        and forget them if it rolls back. Commits issued in autocommit mode
+        are ignored; rows are not held across those."""
+        ref = weakref.ref(run)
+
+        def on_commit(conn):
+            run = ref()
+            if run is not None and conn.in_transaction():
+                self._flush_run(run)
+
+        def on_rollback(conn):
+            run = ref()
+            if run is not None and conn.in_transaction():
+                run.discard()
+
+        run.listen(connection, 'commit', on_commit)
+        run.listen(connection, 'rollback', on_rollback)
+
+    def _watch_offline_transactions(self, impl, run):
+        """Offline, render buffered rows just before each COMMIT. Alembic
+        offers no hook for this, so we wrap the impl's ``emit_commit``."""
+        emit_commit = impl.emit_commit
+
+        def flush_and_commit():
+            self._flush_run(run)
+            emit_commit()
+
+        impl.emit_commit = flush_and_commit
+
+    def _emit(self, impl, construct):
+        """Render a statement for an offline script: into the migration
+        script, or into :paramref:`~.Auditor.offline_output`."""
+        if self.offline_output is None:
+            impl._exec(construct)
+            return
+        sql = '%s%s\n\n' % (
+            text_type(construct.compile(dialect=impl.dialect)).strip(),
+            impl.command_terminator)
+        with self._lock:
+            if hasattr(self.offline_output, 'write'):
+                self.offline_output.write(sql)
+            else:
+                with io.open(self.offline_output, 'a',
+                             encoding='utf-8') as f:
+                    f.write(sql)
+
+    def _insert_offline(self, impl, rows):
+        """Render rows as one multi-row INSERT where the dialect allows it.
+        Values are inlined as literals, as ``op.bulk_insert`` does."""
+        from alembic.util.sqla_compat import _literal_bindparam
+        columns = self.table.c
+        groups = collections.OrderedDict()
+        for row in rows:
+            groups.setdefault(tuple(sorted(row)), []).append(dict(
+                (k, v if isinstance(v, ClauseElement) else
+                 _literal_bindparam(k, v, type_=columns[k].type))
+                for k, v in row.items()))
+        for group in groups.values():
+            if impl.dialect.supports_multivalues_insert:
+                self._emit(impl, self.table.insert().values(group))
+            else:
+                for row in group:
+                    self._emit(impl, self.table.insert().values(row))
+
+    @property
+    def created_table(self):
+        """Whether the tables were created, or found to exist, on any
+        database."""
+        return bool(self._created)
+
+    @property
+    def tables(self):
+        """All tables written by the auditor, in order of creation."""
+        before = [d.table for d in self.dimensions.values()]
+        after = []
+        if self.revisions is not None:
+            revisions_before, after = self.revisions.tables
+            before = before + revisions_before
+        if self.current_state is not None:
+            after = after + [self.current_state.table]
+        return before + [self.table] + after
+
+    def _ensure_table(self, run):
+        if run.created_table:
+            # a run writes to one database: look it up once
+            return
+        impl = run.impl
+        if impl.as_sql:
+            # each script creates the tables it writes to
+            for table in self.tables:
+                self._create_table(impl, table)
+            run.created_table = True
+            return
+        key = (self._database_key(impl.connection), self.table.schema or '')
+        if key not in self._created:
+            with self._lock:
+                lock = self._creating.setdefault(key, threading.Lock())
+            with lock:
+                if key not in self._created:
+                    for table in self.tables:
+                        self._create_table(impl, table)
+                    self._created.add(key)
+        run.created_table = True
+
+    def _database_key(self, connection):
+        """The key of ``connection``'s database: its URL, or for databases
+        that live no longer than their engine, such as in-memory SQLite
+        ones which share the URL ``sqlite://``, a token of the engine."""
+        engine = connection.engine
+        key = _persistent_key(engine.url)
+        if key is None:
+            with self._lock:
+                key = self._engines.get(engine)
+                if key is None:
+                    key = self._engines[engine] = object()
+        return key
+
+    def _create_table(self, impl, table):
+        if impl.as_sql and self.offline_output is not None:
+            self._emit(impl, CreateTable(table))
+            for index in table.indexes:
+                self._emit(impl, CreateIndex(index))
+        elif impl.as_sql:
+            impl.create_table(table)
+        elif self.table_cache is None:
+            table.create(impl.connection, checkfirst=True)
+        elif not self.table_cache.known(impl.connection, table):
+            table.create(impl.connection, checkfirst=True)
+            self.table_cache.add(impl.connection, table)
+
+    def _write(self, run, rows):
+        started = _clock()
+        try:
+            self._write_rows(run, rows)
+        finally:
+            # leave writing out of the step being timed: rows held until a
+            # commit, as with transaction_per_migration, are written once
+            # the next step has begun
+            if run.step_started is not None:
+                run.step_started += _clock() - started
+
+    def _write_rows(self, run, rows):
+        if self.sink is not None:
+            self.sink.write(self.table, rows)
+            return
+        run.writing = True
+        try:
+            self._ensure_table(run)
+            if self.dimensions and self.revisions is not None:
+                resolved = self._resolve(run, [row for row, _ in rows])
+                rows = list(zip(resolved, [revs for _, revs in rows]))
+            elif self.dimensions:
+                rows = self._resolve(run, rows)
+            if self.revisions is not None:
+                self._write_linked(run, rows)
+            elif rows and run.impl.as_sql:
+                self._insert_offline(run.impl, rows)
+            elif rows:
+                run.impl.bulk_insert(self.table, rows)
+            if self.current_state is not None and run.heads is not None:
+                self._write_current(run)
+        finally:
+            run.writing = False
+
+    def _write_current(self, run):
+        impl = run.impl
+        heads, pending = run.heads, run.pending_heads
+        run.heads, run.pending_heads = None, {}
+        for construct in self.current_state.statements(heads, pending,
+                                                       literal=impl.as_sql):
+            if impl.as_sql:
+                self._emit(impl, construct)
+            else:
+                impl._exec(construct)
+
+    def _resolve(self, run, rows):
+        """Replace values of dimension columns by their ids. Offline, ids
+        are unknown: values are inserted unless present, and ids looked up
+        by subqueries."""
+        impl = run.impl
+        rows = [dict(row) for row in rows]
+        for name, dimension in self.dimensions.items():
+            cache = run.dimension_ids[name]
+            values = set(row[name] for row in rows
+                         if row.get(name) is not None)
+            if impl.as_sql:
+                for value in values:
+                    if value not in cache:
+                        self._emit(impl, dimension.insert_missing(value))
+                        cache[value] = None
+                ids = dict((value, dimension.id_of(value))
+                           for value in values)
+            else:
+                ids = dimension.ids(impl.connection, values, cache)
+            for row in rows:
+                if row.get(name) is not None:
+                    row[name] = ids[row[name]]
+        return rows
+
+    def _write_linked(self, run, entries):
+        """Write ``(row, revisions)`` pairs one row at a time, as the id of
+        each row is needed to link it to its revisions. Online, the links of
+        all rows are then inserted at once."""
+        impl = run.impl
+        revisions = self.revisions
+        if impl.as_sql:
+            for row, revs in entries:
+                # ids cannot be read back: insert revisions unless present,
+                # then refer to them and to the new row by subqueries
+                for rev in revs[0] + revs[1]:
+                    if rev not in run.revision_ids:
+                        self._emit(impl,
+                                   revisions.revisions.insert_missing(rev))
+                        run.revision_ids[rev] = None
+                self._insert_offline(impl, [row])
+                for link in revisions.offline_links(self.table, revs):
+                    self._emit(impl, link)
+            return
+        linked = []
+        for row, revs in entries:
+            result = impl._exec(self.table.insert().values(row))
+            linked.append((result.inserted_primary_key[0], revs))
+        revisions.write(impl.connection, linked, run.revision_ids)
+
+    def _flush_run(self, run, stamps=True):
+        if stamps and run.stamps is not None:
+            self._close_stamps(run)
+        rows = run.take()
+        if rows:
+            self._write(run, rows)
+
+    def flush(self, ctx=None):
+        """Write any rows buffered for a migration context.
+
+        Only meaningful when :paramref:`~.Auditor.buffered` is set. Call it
+        inside the migration transaction, e.g. after
+        ``context.run_migrations()``, or use :meth:`.Auditor.run` instead.
+
+        :param ctx: a ``MigrationContext``; defaults to the one currently
+            configured in ``alembic.context``.
+        """
+        if ctx is None:
+            from alembic import context
+            ctx = context.get_context()
+        run = self._runs.get(ctx)
+        if run is not None:
+            self._flush_run(run)
+
+    @contextlib.contextmanager
+    def run(self, ctx=None):
+        """Context manager marking the extent of a migration run.
+
+        Wrap ``context.run_migrations()`` with it, inside the migration
+        transaction::
+
+            with context.begin_transaction():
+                with auditor.run():
+                    context.run_migrations()
+
+        Buffered rows are flushed when the block exits. If it exits with an
+        error on a backend with transactional DDL, the migration will be
+        rolled back, and so are the buffered rows.
+
+        :param ctx: a ``MigrationContext``; defaults to the one currently
+            configured in ``alembic.context``.
+        """
+        if ctx is None:
+            from alembic import context
+            ctx = context.get_context()
+        run = self._get_run(ctx, explicit=True)
+        status = 'failed'
+        try:
+            yield
+        except Exception:
+            if ctx.as_sql or not ctx.impl.transactional_ddl:
+                self._flush_run(run)
+            else:
+                run.discard()
+            raise
+        else:
+            self._flush_run(run)
+            status = 'ok'
+        finally:
+            run.end()
+            if self.emitter is not None:
+                self.emitter.end(run, status)
+            with self._lock:
+                self._runs.pop(ctx, None)
+
+    def listen(self, ctx=None, warn_user_version=True, **kw):
+        run = self._get_run(ctx)
+        step = kw.get('step')
+        run.end_step(step)
+        run.steps += 1
+        if self.emitter is not None:
+            self.emitter.step(run, step)
+        if self.compress_stamps:
+            if run.stamps is not None and not run.stamps.extends(step):
+                self._close_stamps(run)
+            if step.is_stamp and (run.explicit or run.in_transaction):
+                if run.stamps is None:
+                    run.stamps = _StampRange(ctx, kw, run.metrics)
+                else:
+                    run.stamps.add(kw, run.metrics)
+                run.begin_step()
+                return
+        self._record(run, self._build_row(run, ctx, kw))
+        run.begin_step()
+
+    def _build_row(self, run, ctx, kw):
+        row = self.make_row(ctx=ctx, **kw)
+        if self.current_state is not None:
+            step = kw['step']
+            values = dict((role, row.get(self.roles[role]))
+                          for role in self.current_state.roles
+                          if role in self.roles)
+            values['alembic_version'] = ccv.new_alembic_version(
+                step=step, separator=self.version_separator)
+            values['prev_alembic_version'] = ccv.old_alembic_version(
+                step=step, separator=self.version_separator)
+            run.heads = tuple(kw.get('heads') or ())
+            self.current_state.track(run.pending_heads, step, run.heads,
+                                     values)
+        if self.revisions is not None:
+            row = (row, self.revisions.of_step(kw['step']))
+        return row
+
+    def _close_stamps(self, run):
+        """Record the pending range of stamps as one row."""
+        stamps, run.stamps = run.stamps, None
+        metrics, run.metrics = run.metrics, stamps.metrics
+        try:
+            row = self._build_row(run, stamps.ctx, stamps.step_kw())
+        finally:
+            run.metrics = metrics
+        self._record(run, row)
+
+    def _record(self, run, row):
+        if not self.buffered:
+            self._write(run, [row])
+            return
+        run.rows.append(row)
+        run.nbytes += _row_size(row if self.revisions is None else row[0])
+        if ((self.flush_rows and len(run.rows) >= self.flush_rows) or
+                (self.flush_bytes and run.nbytes >= self.flush_bytes) or
+                not (run.explicit or run.in_transaction)):
+            self._flush_run(run, stamps=False)
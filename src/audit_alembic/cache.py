@@ -0,0 +1,188 @@
+"""Caches recording which history tables are known to exist.
+
+Without a cache, each new :class:`.Auditor` asks the database whether its
+table exists (``checkfirst``) before the first row is written. Given a
+:class:`TableCache`, the auditor skips that round trip for any table the
+cache has seen created before with an identical definition.
+"""
+import abc
+import hashlib
+import json
+import os
+import threading
+
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.schema import CreateTable
+
+from .compat import ABC
+
+_replace = getattr(os, 'replace', os.rename)
+
+
+def _url_key(url, **kw):
+    """Render an engine URL without its password, with the parts in ``kw``
+    replaced."""
+    kw.setdefault('database', url.database)
+    if hasattr(url, 'set'):
+        url = url.set(password=None, **kw)
+    else:
+        url = type(url)(url.drivername, username=url.username,
+                        host=url.host, port=url.port, query=url.query, **kw)
+    return str(url)
+
+
+def _persistent_key(url):
+    """Like :func:`_url_key`, but the same from any process and working
+    directory: relative SQLite paths are made absolute. None for databases
+    that do not outlive their connections, such as in-memory SQLite ones,
+    which no two engines share."""
+    if url.get_backend_name() != 'sqlite':
+        return _url_key(url)
+    database = url.database or ''
+    if database in ('', ':memory:') or database.startswith('file::memory:') \
+            or 'mode=memory' in database \
+            or (url.query or {}).get('mode') == 'memory':
+        return None
+    if database.startswith('file:'):
+        return _url_key(url)
+    return _url_key(url, database=os.path.abspath(database))
+
+
+def table_fingerprint(table, dialect):
+    """A digest of the DDL creating ``table`` and its indexes on ``dialect``.
+
+    Any change to the table definition that would change its DDL changes its
+    fingerprint.
+    """
+    ddl = [str(CreateTable(table).compile(dialect=dialect))]
+    ddl.extend(sorted(str(CreateIndex(index).compile(dialect=dialect))
+                      for index in table.indexes))
+    return hashlib.sha1('\n'.join(ddl).encode('utf-8')).hexdigest()
+
+
+class TableCache(ABC):
+    """Base class for table existence caches.
+
+    Entries are keyed by engine URL, schema and table name, and store the
+    :func:`table_fingerprint` of the table as it was created. A table is
+    known to exist only if its current fingerprint matches the stored one, so
+    changing the table definition invalidates the entry. SQLite paths are
+    keyed as absolute paths, and in-memory databases are never cached.
+
+    Subclasses implement :meth:`get` and :meth:`set`.
+    """
+
+    def key(self, connection, table):
+        """The key of ``table`` on ``connection``'s database, or None if
+        that database cannot be cached."""
+        url = _persistent_key(connection.engine.url)
+        if url is None:
+            return None
+        return '%s|%s|%s' % (url, table.schema or '', table.name)
+
+    @abc.abstractmethod
+    def get(self, key):
+        """Return the fingerprint stored for ``key``, or None."""
+
+    @abc.abstractmethod
+    def set(self, key, fingerprint):
+        """Store ``fingerprint`` for ``key``."""
+
+    def known(self, connection, table):
+        """Whether ``table`` is known to exist on ``connection``'s database
+        with its current definition."""
+        key = self.key(connection, table)
+        if key is None:
+            return False
+        return self.get(key) == table_fingerprint(table, connection.dialect)
+
+    def add(self, connection, table):
+        """Record that ``table`` exists on ``connection``'s database."""
+        key = self.key(connection, table)
+        if key is not None:
+            self.set(key, table_fingerprint(table, connection.dialect))
+
+
+class MemoryTableCache(TableCache):
+    """Keeps entries in memory, for the lifetime of the process. Share one
+    instance among auditors to share the entries."""
+
+    def __init__(self):
+        self._entries = {}
+
+    def get(self, key):
+        return self._entries.get(key)
+
+    def set(self, key, fingerprint):
+        self._entries[key] = fingerprint
+
+    def clear(self):
+        self._entries.clear()
+
+
+def _load(path):
+    """The dict in the JSON file ``path``, or an empty one if it is missing
+    or unreadable."""
+    try:
+        with open(path) as f:
+            entries = json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+    return entries if isinstance(entries, dict) else {}
+
+
+def _dump(path, entries, **kw):
+    """Replace the JSON file ``path`` atomically."""
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp = '%s.%d.%d.tmp' % (path, os.getpid(),
+                            threading.current_thread().ident)
+    with open(tmp, 'w') as f:
+        json.dump(entries, f, sort_keys=True, **kw)
+    _replace(tmp, path)
+
+
+def _default_cache_path(name='tables.json'):
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'audit_alembic', name)
+
+
+class FileTableCache(TableCache):
+    """Keeps entries in a JSON file on local disk, so that they survive from
+    one ``alembic`` process to the next.
+
+    Entries are read once, when first needed. Each write re-reads the file
+    and replaces it atomically, so several processes may share one file;
+    at worst an entry is lost and the next run checks the database again.
+
+    :param path: the cache file. Defaults to
+        ``$XDG_CACHE_HOME/audit_alembic/tables.json``.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or _default_cache_path()
+        self._entries = None
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        if self._entries is None:
+            self._entries = _load(self.path)
+        return self._entries.get(key)
+
+    def set(self, key, fingerprint):
+        with self._lock:
+            entries = _load(self.path)
+            entries[key] = fingerprint
+            _dump(self.path, entries, indent=0)
+            self._entries = entries
+
+    def clear(self):
+        """Forget all entries, e.g. after tables were dropped by hand."""
+        with self._lock:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            self._entries = {}
@@ -0,0 +1,337 @@
+"""The ``audit-alembic`` command.
+
+Each feature usable from the command line is a subcommand; run
+``audit-alembic --help`` for the list.
+"""
+import argparse
+import sys
+
+
+def _lines(path):
+    with open(path) as f:
+        return [line.strip() for line in f
+                if line.strip() and not line.lstrip().startswith('#')]
+
+
+def _fleet(args):
+    from alembic.config import Config
+
+    from .fleet import upgrade_fleet
+    urls = list(args.urls)
+    if args.urls_file:
+        urls.extend(_lines(args.urls_file))
+    if not urls:
+        sys.stderr.write('no database URLs given\n')
+        return 2
+    report = upgrade_fleet(
+        Config(args.config, ini_section=args.name), urls,
+        revision=args.revision, user_version=args.user_version,
+        workers=args.workers,
+        executor='thread' if args.threads else 'process',
+        summary_bind=args.summary_url)
+    for line in report.format():
+        print(line)
+    return 0 if report.ok else 1
+
+
+def _replay(args):
+    from sqlalchemy import create_engine
+
+    from .base import Auditor
+    from .sinks import replay
+    table = Auditor.create(None, user_version_nullable=True,
+                           table_name=args.table_name).table
+    count = replay(args.log, create_engine(args.url), table,
+                   remove=args.remove)
+    print('%d row(s) loaded into %s' % (count, args.table_name))
+    return 0
+
+
+def _predict(args):
+    from sqlalchemy import create_engine
+
+    from .base import Auditor
+    from .predict import DurationCache
+    from .predict import predict
+    auditor = Auditor.create(None, user_version_nullable=True,
+                             table_name=args.table_name,
+                             duration_column_name=args.duration_column)
+    target = create_engine(args.url)
+    prediction = predict(
+        auditor, create_engine(args.history_url) if args.history_url
+        else target, args.config, revision=args.revision,
+        target_bind=target, downgrade=args.downgrade,
+        cache=DurationCache(args.cache or None)
+        if args.cache is not None else None,
+        version_table=args.version_table)
+    for line in prediction.format():
+        print(line)
+    return 0
+
+
+def _export(args):
+    from sqlalchemy import create_engine
+
+    from .base import Auditor
+    from .export import ExportState
+    from .export import export
+    auditor = Auditor.create(None, user_version_nullable=True,
+                             table_name=args.table_name)
+    result = export(auditor, create_engine(args.url), args.output,
+                    format=args.format,
+                    state=ExportState(args.state) if args.state else None,
+                    after_id=args.after_id, batch_size=args.batch_size)
+    if result.rows:
+        print('%d row(s) exported, ids %s to %s' % result)
+    else:
+        print('0 row(s) exported')
+    return 0
+
+
+def _prune(args):
+    from datetime import timedelta
+
+    from sqlalchemy import create_engine
+
+    from .base import Auditor
+    from .retention import prune
+    auditor = Auditor.create(None, user_version_nullable=True,
+                             table_name=args.table_name)
+    result = prune(auditor, create_engine(args.url),
+                   timedelta(days=args.older_than),
+                   operation_type=args.type, rollup=not args.no_rollup,
+                   archive_dir=args.archive_dir, batch_size=args.batch_size,
+                   pause=args.pause)
+    print('%d row(s) deleted in %d batch(es)' % result[:2])
+    return 0
+
+
+def _verify(args):
+    from sqlalchemy import create_engine
+
+    from .base import Auditor
+    auditor = Auditor.create(None, user_version_nullable=True,
+                             table_name=args.table_name)
+    verification = auditor.verify(create_engine(args.url), args.config,
+                                  batch_size=args.batch_size)
+    for issue in verification:
+        print('%s\t%s\t%s' % issue)
+    print('%d row(s) checked, %d issue(s)' % (
+        verification.rows, verification.issues))
+    return 1 if verification.issues else 0
+
+
+def _drift(args):
+    from alembic.config import Config
+
+    from .base import Auditor
+    from .drift import drift_report
+    urls = list(args.urls)
+    if args.urls_file:
+        urls.extend(_lines(args.urls_file))
+    if not urls:
+        sys.stderr.write('no database URLs given\n')
+        return 2
+    report = drift_report(
+        Config(args.config, ini_section=args.name), urls,
+        auditor=Auditor.create(None, user_version_nullable=True,
+                               table_name=args.table_name),
+        workers=args.workers, per_host=args.per_host,
+        version_table=args.version_table)
+    for line in report.format():
+        print(line)
+    return 1 if report.drifted else 0
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        prog='audit-alembic',
+        description='Tools around Audit-Alembic history tables.')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+
+    fleet = commands.add_parser(
+        'fleet', help='upgrade many databases at once',
+        description='Upgrade many databases at once, auditing each, and '
+                    'report how each one fared. Exits with status 1 if any '
+                    'database failed.')
+    fleet.add_argument('urls', nargs='*', metavar='url',
+                       help='database URL')
+    fleet.add_argument('-f', '--urls-file',
+                       help='file listing database URLs, one per line')
+    fleet.add_argument('-c', '--config', default='alembic.ini',
+                       help='alembic configuration file (default: '
+                            '%(default)s)')
+    fleet.add_argument('-n', '--name', default='alembic',
+                       help='section of the configuration file (default: '
+                            '%(default)s)')
+    fleet.add_argument('-r', '--revision', default='heads',
+                       help='revision to upgrade to (default: %(default)s)')
+    fleet.add_argument('-j', '--workers', type=int, default=4,
+                       help='databases upgraded at once (default: '
+                            '%(default)s)')
+    fleet.add_argument('--threads', action='store_true',
+                       help='use threads rather than processes')
+    fleet.add_argument('--user-version',
+                       help='user version recorded in the history tables')
+    fleet.add_argument('--summary-url',
+                       help='database to record the outcome in')
+    fleet.set_defaults(func=_fleet)
+
+    replay = commands.add_parser(
+        'replay', help='load a history log into a database',
+        description='Load rows logged by a JsonLinesSink or BinaryLogSink '
+                    'into the history table made by Auditor.create. Use the '
+                    'Python API, audit_alembic.sinks.replay, for other '
+                    'tables.')
+    replay.add_argument('log', help='log file')
+    replay.add_argument('url', help='database URL')
+    replay.add_argument('-t', '--table-name',
+                        default='alembic_version_history',
+                        help='history table (default: %(default)s)')
+    replay.add_argument('--remove', action='store_true',
+                        help='delete the log once loaded')
+    replay.set_defaults(func=_replay)
+
+    predict = commands.add_parser(
+        'predict', help='estimate how long an upgrade would take',
+        description='List the steps of upgrading a database to a revision, '
+                    'with the median and 95th percentile of the durations '
+                    'recorded for each in a history table. Steps without '
+                    'recorded durations are shown with a question mark and '
+                    'left out of the total.')
+    predict.add_argument('url', help='URL of the database to upgrade')
+    predict.add_argument('-c', '--config', default='alembic.ini',
+                         help='alembic configuration file (default: '
+                              '%(default)s)')
+    predict.add_argument('-r', '--revision', default='heads',
+                         help='target revision (default: %(default)s)')
+    predict.add_argument('--downgrade', action='store_true',
+                         help='predict a downgrade to the revision instead')
+    predict.add_argument('--history-url',
+                         help='database holding the history table, if not '
+                              'the one to upgrade')
+    predict.add_argument('-t', '--table-name',
+                         default='alembic_version_history',
+                         help='history table (default: %(default)s)')
+    predict.add_argument('--duration-column', default='duration',
+                         help='column of the history table holding '
+                              'durations (default: %(default)s)')
+    predict.add_argument('--version-table', default='alembic_version',
+                         help='alembic version table (default: '
+                              '%(default)s)')
+    predict.add_argument('--cache', nargs='?', const='', metavar='FILE',
+                         help='keep durations in a local file, and read '
+                              'only new rows next time')
+    predict.set_defaults(func=_predict)
+
+    export = commands.add_parser(
+        'export', help='dump a history table to a file',
+        description='Write the rows of the history table made by '
+                    'Auditor.create to a JSON lines, CSV or Parquet file, '
+                    'reading and writing them in batches. With --state, '
+                    'only rows added since the last export are written.')
+    export.add_argument('url', help='database URL')
+    export.add_argument('output', help='file to write')
+    export.add_argument('-f', '--format', default='jsonl',
+                        choices=['jsonl', 'csv', 'parquet'],
+                        help='file format (default: %(default)s; parquet '
+                             'needs pyarrow)')
+    export.add_argument('-t', '--table-name',
+                        default='alembic_version_history',
+                        help='history table (default: %(default)s)')
+    export.add_argument('--state', metavar='FILE',
+                        help='file recording the last id exported, for '
+                             'incremental exports')
+    export.add_argument('--after-id', type=int,
+                        help='export rows after this id only')
+    export.add_argument('--batch-size', type=int, default=1000,
+                        help='rows read at a time (default: %(default)s)')
+    export.set_defaults(func=_export)
+
+    prune = commands.add_parser(
+        'prune', help='delete old rows of a history table',
+        description='Delete the rows of the history table made by '
+                    'Auditor.create older than some number of days, in '
+                    'small batches, after summing them up in a rollup '
+                    'table and optionally archiving them to compressed '
+                    'files.')
+    prune.add_argument('url', help='database URL')
+    prune.add_argument('--older-than', type=float, required=True,
+                       metavar='DAYS', help='age of the rows to delete')
+    prune.add_argument('--type', choices=['migration', 'stamp'],
+                       help='only delete rows of this operation type')
+    prune.add_argument('-t', '--table-name',
+                       default='alembic_version_history',
+                       help='history table (default: %(default)s)')
+    prune.add_argument('--archive-dir', metavar='DIR',
+                       help='write deleted rows to compressed files here')
+    prune.add_argument('--no-rollup', action='store_true',
+                       help='do not keep a summary in the rollup table')
+    prune.add_argument('--batch-size', type=int, default=500,
+                       help='rows deleted per transaction (default: '
+                            '%(default)s)')
+    prune.add_argument('--pause', type=float, default=0,
+                       help='seconds to wait between batches')
+    prune.set_defaults(func=_prune)
+
+    verify = commands.add_parser(
+        'verify', help='check a history table against the migrations',
+        description='Replay the history table made by Auditor.create over '
+                    'the revision graph of the migrations, and list the '
+                    'rows that do not follow from the ones before: steps '
+                    'that are not edges of the graph, missing steps, '
+                    'changes made without auditing and timestamps going '
+                    'backwards. Exits with status 1 if any is found.')
+    verify.add_argument('url', help='database URL')
+    verify.add_argument('-c', '--config', default='alembic.ini',
+                        help='alembic configuration file (default: '
+                             '%(default)s)')
+    verify.add_argument('-t', '--table-name',
+                        default='alembic_version_history',
+                        help='history table (default: %(default)s)')
+    verify.add_argument('--batch-size', type=int, default=1000,
+                        help='rows read at a time (default: %(default)s)')
+    verify.set_defaults(func=_verify)
+
+    drift = commands.add_parser(
+        'drift', help='compare many databases with the migrations',
+        description='Read the heads and latest history rows of many '
+                    'databases at once, and report how many steps each is '
+                    'behind or ahead of the heads of the migrations, and '
+                    'how long since it last changed. Exits with status 1 '
+                    'if any database is not at the heads.')
+    drift.add_argument('urls', nargs='*', metavar='url',
+                       help='database URL')
+    drift.add_argument('-f', '--urls-file',
+                       help='file listing database URLs, one per line')
+    drift.add_argument('-c', '--config', default='alembic.ini',
+                       help='alembic configuration file (default: '
+                            '%(default)s)')
+    drift.add_argument('-n', '--name', default='alembic',
+                       help='section of the configuration file (default: '
+                            '%(default)s)')
+    drift.add_argument('-t', '--table-name',
+                       default='alembic_version_history',
+                       help='history table (default: %(default)s)')
+    drift.add_argument('--version-table', default='alembic_version',
+                       help='alembic version table (default: %(default)s)')
+    drift.add_argument('-j', '--workers', type=int, default=16,
+                       help='databases read at once (default: %(default)s)')
+    drift.add_argument('--per-host', type=int, default=4,
+                       help='connections open at once per server (default: '
+                            '%(default)s)')
+    drift.set_defaults(func=_drift)
+    return parser
+
+
+def main(argv=None):
+    parser = _parser()
+    args = parser.parse_args(argv)
+    if getattr(args, 'func', None) is None:
+        parser.print_help()
+        return 2
+    return args.func(args)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    sys.exit(main())
@@ -0,0 +1,86 @@
+"""Detection of what the installed Alembic and Python support.
+
+This module is kept free of heavy imports: nothing is inspected until a
+function here is first called, and results are computed once per process.
+"""
+import abc
+import inspect
+
+_features = {}
+
+#: a base class for abstract classes, as ``abc.ABC`` on Python 3
+ABC = abc.ABCMeta('ABC', (object,), {'__slots__': ()})
+
+
+def _parameters(fn):
+    if hasattr(inspect, 'signature'):
+        return set(inspect.signature(fn).parameters)
+    spec = inspect.getargspec(fn)  # pragma: no cover
+    return set(spec.args)  # pragma: no cover
+
+
+def _importable(name):
+    try:
+        from importlib.util import find_spec
+    except ImportError:  # pragma: no cover
+        try:
+            __import__(name)
+        except ImportError:
+            return False
+        return True
+    return find_spec(name) is not None
+
+
+def _detect():
+    from alembic import __version__ as alembic_version
+    from alembic.runtime.environment import EnvironmentContext
+
+    configure = _parameters(EnvironmentContext.configure)
+    try:
+        import tracemalloc
+    except ImportError:  # pragma: no cover
+        tracemalloc = None
+    return {
+        'alembic_version': alembic_version,
+        'on_version_apply': 'on_version_apply' in configure,
+        'transaction_per_migration': 'transaction_per_migration' in configure,
+        'tracemalloc': tracemalloc is not None,
+        'tracemalloc_reset_peak': hasattr(tracemalloc, 'reset_peak'),
+        'pyarrow': _importable('pyarrow'),
+    }
+
+
+def features():
+    """Return a dict describing what the environment supports.
+
+    Keys:
+
+    * ``alembic_version``: the installed Alembic version string.
+    * ``on_version_apply``: whether ``context.configure`` accepts the
+      ``on_version_apply`` callback that :class:`.Auditor` relies on.
+    * ``transaction_per_migration``: whether it accepts
+      ``transaction_per_migration``.
+    * ``tracemalloc``, ``tracemalloc_reset_peak``: whether memory profiling
+      is available, and whether peaks can be reset between steps.
+    * ``pyarrow``: whether ``pyarrow`` can be imported.
+
+    The result is computed on first call and cached for the process.
+    """
+    if not _features:
+        _features.update(_detect())
+    return dict(_features)
+
+
+def alembic_supports_callback(configure_method=None):
+    """Inspect a method to tell whether it supports on_version_apply callback.
+
+    :meth:`.Auditor.setup` uses this essentially to ensure the correct version
+    of alembic is installed.
+
+    :param configure_method: the method to inspect. By default, Alembic's
+        ``EnvironmentContext.configure`` is inspected, once per process; the
+        ``alembic.context.configure`` proxy does not reveal its arguments.
+    """
+    if configure_method is None:
+        return features()['on_version_apply']
+    return 'on_version_apply' in _parameters(configure_method)
@@ -0,0 +1,105 @@
+"""A table of where each database stands now.
+
+Finding out what revision a database is on, and since when, from the
+history table means reading its latest rows. With
+:paramref:`~.Auditor.current_state`, an :class:`.Auditor` also maintains a
+:class:`CurrentState` table holding one row per head of the database: the
+revision, the step that made it a head, the user version, time and
+direction of that step. It is rewritten along with each write of history
+rows, in the same transaction, so that it is exactly as current as the
+history table, and a dashboard polling many databases reads a few rows from
+each.
+
+Heads the database had before the auditor first wrote to it only appear
+once a migration moves them.
+"""
+from sqlalchemy import Column
+from sqlalchemy import Table
+from sqlalchemy import select
+from sqlalchemy import types
+from sqlalchemy.sql import ClauseElement
+
+from .base import _connect
+from .dimensions import _literal
+
+
+class CurrentState(object):
+    """Maintains the table of current heads.
+
+    :param table: a ``Table`` as made by :meth:`define`.
+    """
+
+    #: the roles of the history table copied into each row
+    roles = ('user_version', 'changed_at', 'operation_type',
+             'operation_direction')
+
+    def __init__(self, table):
+        self.table = table
+
+    @classmethod
+    def define(cls, history, metadata, name=None,
+               user_version_type=types.String(255)):
+        """Define the table of the history table ``history``, named after it
+        with the suffix ``_current`` by default."""
+        return cls(Table(
+            name or '%s_current' % history.name, metadata,
+            Column('head', types.String(255), primary_key=True),
+            Column('alembic_version', types.String(255), nullable=False),
+            Column('prev_alembic_version', types.String(255),
+                   nullable=False),
+            Column('operation_type', types.String(32)),
+            Column('operation_direction', types.String(32)),
+            Column('user_version', user_version_type),
+            Column('changed_at', types.DateTime()),
+            schema=history.schema,
+        ))
+
+    @staticmethod
+    def track(pending, step, heads, values):
+        """Note a step in ``pending``, a dict of head to row, holding the
+        heads that arrived since the table was last written.
+
+        :param step: the ``MigrationInfo`` of the step.
+        :param heads: the heads of the database after the step.
+        :param values: the values of :attr:`roles` and of the
+            ``alembic_version`` and ``prev_alembic_version`` of the step.
+        """
+        for head in list(pending):
+            if head not in heads:
+                del pending[head]
+        for head in step.destination_revision_ids:
+            if head in heads:
+                pending[head] = dict(values, head=head)
+
+    def statements(self, heads, pending, literal=False):
+        """The statements bringing the table up to date: deleting heads that
+        are gone or have moved, and inserting those in ``pending``.
+
+        :param literal: whether to inline values, for offline scripts.
+        """
+        c = self.table.c
+
+        def value(v, column):
+            if literal and v is not None and not isinstance(v, ClauseElement):
+                return _literal(v, column.type)
+            return v
+
+        if heads:
+            gone = ~c.head.in_([value(h, c.head) for h in heads])
+            if pending:
+                gone = gone | c.head.in_([value(h, c.head) for h in pending])
+            yield self.table.delete().where(gone)
+        else:
+            yield self.table.delete()
+        for row in pending.values():
+            yield self.table.insert().values(dict(
+                (k, value(v, c[k])) for k, v in row.items()))
+
+    def read(self, bind):
+        """The rows of the table, as dicts, in order of head.
+
+        :param bind: an ``Engine`` or ``Connection``.
+        """
+        with _connect(bind) as conn:
+            return [dict(row) for row in conn.execute(
+                select([self.table]).order_by(self.table.c.head))]
@@ -0,0 +1,199 @@
+"""Values stored once in tables of their own and referenced by integer id.
+
+A history table written by :meth:`.Auditor.create` repeats the same few
+values from row to row. With ``normalize_revisions``, revisions are instead
+stored once in a :class:`Dimension` table, and each history row is linked to
+its source and destination revisions through a :class:`RevisionLinks`
+table. This keeps rows small, holds any number of heads, and lets "which
+rows touched revision X" use an index rather than a ``LIKE`` scan. Likewise,
+with ``normalize_user_version`` the user version column holds the id of a
+row in a :class:`Dimension` of user versions.
+"""
+from sqlalchemy import Column
+from sqlalchemy import ForeignKey
+from sqlalchemy import Index
+from sqlalchemy import PrimaryKeyConstraint
+from sqlalchemy import Table
+from sqlalchemy import and_
+from sqlalchemy import exists
+from sqlalchemy import func
+from sqlalchemy import select
+from sqlalchemy import types
+
+
+def _literal(value, type_):
+    # rendered inline in offline scripts, as op.bulk_insert does
+    from alembic.util.sqla_compat import _literal_bindparam
+    return _literal_bindparam(None, value, type_=type_)
+
+
+class Dimension(object):
+    """A table of distinct values, each keyed by a small integer id.
+
+    :param table: a ``Table`` with an integer primary key column ``id`` and
+        a unique column holding the values.
+    :param value_column_name: the name of that column.
+    """
+
+    def __init__(self, table, value_column_name='value'):
+        self.table = table
+        self.id = table.c.id
+        self.value = table.c[value_column_name]
+
+    @classmethod
+    def define(cls, name, metadata, value_column_name='value',
+               value_type=types.String(255)):
+        """Define the table of a new dimension."""
+        return cls(Table(name, metadata,
+                         Column('id', types.Integer, primary_key=True),
+                         Column(value_column_name, value_type,
+                                nullable=False, unique=True)),
+                   value_column_name)
+
+    def ids(self, connection, values, cache):
+        """Map each of ``values`` to its id, inserting those not stored yet.
+
+        :param connection: the ``Connection`` to query and insert with.
+        :param values: an iterable of values.
+        :param cache: a dict of value to id, consulted first and updated, so
+            that each value is looked up or inserted only once per cache.
+        :return: a dict of value to id.
+        """
+        values = set(values)
+        missing = [v for v in values if v not in cache]
+        if missing:
+            q = select([self.value, self.id]).where(self.value.in_(missing))
+            cache.update(connection.execute(q).fetchall())
+            for value in missing:
+                if value not in cache:
+                    result = connection.execute(
+                        self.table.insert().values({self.value.key: value}))
+                    cache[value] = result.inserted_primary_key[0]
+        return dict((v, cache[v]) for v in values)
+
+    def insert_missing(self, value):
+        """An INSERT of ``value`` that does nothing if it is stored already,
+        for offline scripts, where ids cannot be read back."""
+        return self.table.insert().from_select(
+            [self.value.key],
+            select([_literal(value, self.value.type)]).where(~exists().where(
+                self.value == _literal(value, self.value.type))))
+
+    def id_of(self, value):
+        """A scalar subquery giving the id of ``value``."""
+        return select([self.id]).where(
+            self.value == _literal(value, self.value.type)).as_scalar()
+
+
+class RevisionLinks(object):
+    """Links history rows to the revisions of their migration step.
+
+    Each link row holds the id of a history row, the id of a revision in
+    :attr:`revisions`, whether it is a ``source`` or a ``destination``
+    revision of the step, and its position among those, so that the
+    revision tuples of the step can be rebuilt in order.
+
+    :param revisions: a :class:`Dimension` of revisions.
+    :param table: the link table, as made by :meth:`define`.
+    """
+
+    def __init__(self, revisions, table):
+        self.revisions = revisions
+        self.table = table
+
+    @classmethod
+    def define(cls, history, metadata):
+        """Define the revision dimension and link tables of the history
+        table ``history``, named after it."""
+        revisions = Dimension.define('%s_revision' % history.name, metadata,
+                                     'revision')
+        history_id = history.c.id
+        table = Table(
+            '%s_revision_link' % history.name, metadata,
+            Column('history_id', history_id.type,
+                   ForeignKey(history_id, ondelete='CASCADE'),
+                   nullable=False),
+            Column('revision_id', types.Integer,
+                   ForeignKey(revisions.id), nullable=False),
+            Column('kind', types.String(12), nullable=False),
+            Column('position', types.SmallInteger, nullable=False),
+            PrimaryKeyConstraint('history_id', 'kind', 'position'),
+            Index('ix_%s_revision_link_revision_id' % history.name,
+                  'revision_id'),
+        )
+        return cls(revisions, table)
+
+    @property
+    def tables(self):
+        """The tables to create before the history table, and after."""
+        return [self.revisions.table], [self.table]
+
+    @staticmethod
+    def of_step(step):
+        """The ``(sources, destinations)`` revision tuples of ``step``."""
+        return (tuple(step.source_revision_ids),
+                tuple(step.destination_revision_ids))
+
+    def _links(self, history_id, revisions, revision_id):
+        links = []
+        for kind, revs in zip(('source', 'destination'), revisions):
+            for position, rev in enumerate(revs):
+                links.append({'history_id': history_id,
+                              'revision_id': revision_id(rev),
+                              'kind': kind, 'position': position})
+        return links
+
+    def write(self, connection, rows, cache):
+        """Link history rows to their revisions, with one INSERT of all
+        links.
+
+        :param connection: the ``Connection`` to write with.
+        :param rows: ``(history_id, revisions)`` pairs: the id of each
+            history row and its ``(sources, destinations)``.
+        :param cache: a dict of revision to id; see :meth:`Dimension.ids`.
+        """
+        ids = self.revisions.ids(
+            connection, [rev for _, revisions in rows
+                         for rev in revisions[0] + revisions[1]], cache)
+        links = []
+        for history_id, revisions in rows:
+            links.extend(self._links(history_id, revisions, ids.__getitem__))
+        if links:
+            connection.execute(self.table.insert(), links)
+
+    def offline_links(self, history, revisions):
+        """INSERTs linking the history row inserted last to its revisions,
+        for offline scripts."""
+        c = self.table.c
+        history_id = select([func.max(history.c.id)]).as_scalar()
+        return [self.table.insert().values({
+            'history_id': history_id,
+            'revision_id': self.revisions.id_of(link['revision_id']),
+            'kind': _literal(link['kind'], c.kind.type),
+            'position': _literal(link['position'], c.position.type)})
+            for link in self._links(None, revisions, lambda rev: rev)]
+
+    def having(self, history_id, revision, kind):
+        """A clause true of history ids linked to ``revision`` as ``kind``.
+        """
+        c = self.table.c
+        return history_id.in_(
+            select([c.history_id]).select_from(self.table.join(
+                self.revisions.table, c.revision_id == self.revisions.id))
+            .where(and_(c.kind == kind, self.revisions.value == revision)))
+
+    def fetch(self, connection, history_ids):
+        """Rebuild the revisions of history rows.
+
+        :return: a dict of history id to ``(sources, destinations)``.
+        """
+        c = self.table.c
+        q = select([c.history_id, c.kind, self.revisions.value]).select_from(
+            self.table.join(self.revisions.table,
+                            c.revision_id == self.revisions.id)
+        ).where(c.history_id.in_(history_ids)).order_by(
+            c.history_id, c.kind, c.position)
+        found = dict((i, ([], [])) for i in history_ids)
+        for history_id, kind, revision in connection.execute(q):
+            found[history_id][kind == 'destination'].append(revision)
+        return dict((i, (tuple(s), tuple(d))) for i, (s, d) in found.items())
@@ -0,0 +1,243 @@
+"""Reporting how far each database of a fleet is from the migrations.
+
+:func:`drift_report` reads, for each of a list of database URLs, its current
+heads and its latest history rows, from a pool of threads, and compares
+them with the heads of a ``ScriptDirectory``. Each database is reported as
+``current``, ``behind`` (by the number of steps an upgrade would run),
+``ahead`` (by the number of revisions applied that the migrations do not
+know of, e.g. by a newer release) or ``failed``, along with when it last
+changed. The ``audit-alembic drift`` command does the same from the command
+line.
+
+Connections are opened with no pool and closed once read; at most
+``per_host`` of them are open to the same server at a time, whatever the
+number of threads. Databases without a history table are reported all the
+same, without a time of last change.
+"""
+import collections
+import functools
+import threading
+from datetime import datetime
+
+from sqlalchemy import create_engine
+from sqlalchemy import inspect
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import NullPool
+
+from . import exc
+from .base import Auditor
+from .base import _clock
+from .base import _pending_revisions
+from .base import _script_directory
+from .cache import _url_key
+from .verify import RevisionGraph
+
+try:
+    from concurrent import futures
+except ImportError:  # pragma: no cover
+    futures = None
+
+DriftEntry = collections.namedtuple(
+    'DriftEntry', 'url status heads behind ahead since user_version error')
+DriftEntry.__doc__ = """Where one database stands.
+
+``url`` is the database URL without its password, ``status`` one of
+``current``, ``behind``, ``ahead`` or ``failed``, ``heads`` the database's
+heads joined by ``##``, ``behind`` the number of steps an
+upgrade to the script heads would run (None if unknown, as when the
+database is ahead), ``ahead`` the number of revisions applied that the
+script does not know of, ``since`` and ``user_version`` those of the
+latest history row, and ``error`` a description of the failure, if any.
+"""
+
+
+class DriftReport(object):
+    """The outcome of :func:`drift_report`.
+
+    :param heads: the heads of the script.
+    :param entries: a list of :class:`DriftEntry`, in the order of the URLs
+        given.
+    :param duration: the seconds taken.
+    """
+
+    def __init__(self, heads, entries, duration):
+        self.heads = heads
+        self.entries = entries
+        self.duration = duration
+
+    @property
+    def drifted(self):
+        """The entries of databases not at the script heads."""
+        return [e for e in self.entries if e.status != 'current']
+
+    def counts(self):
+        """The number of databases of each status."""
+        return collections.Counter(e.status for e in self.entries)
+
+    def format(self, now=None):
+        """The report as lines of text: one per database, with its status,
+        how many steps behind and ahead, and how long since it last
+        changed; then a total.
+
+        :param now: the current UTC time, by default ``datetime.utcnow()``.
+        """
+        now = now or datetime.utcnow()
+
+        def age(since):
+            if since is None:
+                return '-'
+            days = (now - since).total_seconds() / 86400
+            return '%.1fd' % days
+
+        lines = ['%-8s %6s %6s %8s %-32s %s%s' % (
+            e.status, '?' if e.behind is None else e.behind, e.ahead,
+            age(e.since), e.heads or '-', e.url,
+            ': ' + e.error.splitlines()[0] if e.error else '')
+            for e in self.entries]
+        counts = self.counts()
+        lines.append('%d database(s) against %s: %s, %.2fs' % (
+            len(self.entries), '##'.join(self.heads) or 'base',
+            ', '.join('%d %s' % (counts[s], s) for s in (
+                'current', 'behind', 'ahead', 'failed')
+                if counts[s]) or 'none', self.duration))
+        return lines
+
+
+class _Limits(object):
+    """A semaphore per host, created on first use."""
+
+    def __init__(self, per_host):
+        self.per_host = per_host
+        self._lock = threading.Lock()
+        self._semaphores = {}
+
+    def __call__(self, url):
+        key = (url.drivername.split('+')[0], url.host, url.port)
+        with self._lock:
+            semaphore = self._semaphores.get(key)
+            if semaphore is None:
+                semaphore = self._semaphores[key] = \
+                    threading.BoundedSemaphore(self.per_host)
+        return semaphore
+
+
+class _Pending(object):
+    """Counts the steps of upgrading from some heads to the script heads,
+    remembering them by heads: databases of a fleet tend to be at the same
+    few revisions."""
+
+    def __init__(self, script):
+        self.script = script
+        self._lock = threading.Lock()
+        self._counts = {}
+
+    def __call__(self, heads):
+        key = tuple(sorted(heads))
+        with self._lock:
+            count = self._counts.get(key)
+            if count is None:
+                count = self._counts[key] = len(
+                    _pending_revisions(self.script, 'heads', key))
+        return count
+
+
+def _fetch(url, auditor, version_table, depth):
+    """The heads of the database at ``url`` and its latest ``depth``
+    history rows, newest first."""
+    from alembic.runtime.migration import MigrationContext
+
+    engine = create_engine(url, poolclass=NullPool)
+    try:
+        with engine.connect() as conn:
+            heads = MigrationContext.configure(
+                conn, opts={'version_table': version_table}
+            ).get_current_heads()
+            table = auditor.table
+            rows = []
+            if table.name in inspect(conn).get_table_names(
+                    schema=table.schema):
+                rows = list(auditor.history(conn, limit=depth,
+                                            newest_first=True,
+                                            batch_size=depth))
+    finally:
+        engine.dispose()
+    return heads, rows
+
+
+def _compare(url, heads, rows, graph, pending, auditor):
+    """The :class:`DriftEntry` of a database given its heads and latest
+    history rows."""
+    separator = auditor.version_separator
+    version_key = ('alembic_version' if auditor.revisions is not None
+                   else auditor.column('alembic_version').key)
+    unknown = set(h for h in heads if h not in graph)
+    if unknown:
+        # revisions applied since the last one the script knows of
+        for row in rows:
+            revisions = [r for r in (row[version_key] or '').split(
+                separator) if r]
+            if all(r in graph for r in revisions):
+                break
+            if row[auditor.column('operation_direction').key] == 'up':
+                unknown.update(r for r in revisions if r not in graph)
+        behind = None
+    else:
+        behind = pending(heads)
+    ahead = len(unknown)
+    status = 'ahead' if ahead else 'behind' if behind else 'current'
+    latest = rows[0] if rows else {}
+    return DriftEntry(
+        url, status, separator.join(sorted(heads)) or None, behind, ahead,
+        latest.get(auditor.roles.get('changed_at')),
+        latest.get(auditor.roles.get('user_version')), None)
+
+
+def _check_one(url, auditor, version_table, depth, graph, pending, limits):
+    parsed = make_url(url)
+    key = _url_key(parsed)
+    try:
+        with limits(parsed):
+            heads, rows = _fetch(url, auditor, version_table, depth)
+        return _compare(key, heads, rows, graph, pending, auditor)
+    except Exception as e:
+        return DriftEntry(key, 'failed', None, None, 0, None, None,
+                          '%s: %s' % (type(e).__name__, e))
+
+
+def drift_report(script, urls, auditor=None, workers=16, per_host=4,
+                 version_table='alembic_version', depth=50):
+    """Compare each of ``urls`` with the heads of ``script``.
+
+    A failure to read one database is reported and does not stop the
+    others.
+
+    :param script: the ``ScriptDirectory`` of the migrations, or an alembic
+        ``Config`` or the path to an ``alembic.ini`` locating it.
+    :param urls: database URLs.
+    :param auditor: the :class:`.Auditor` whose history table to read in
+        each database; only its table definition is used. Defaults to
+        :meth:`.Auditor.create`'s.
+    :param workers: the number of databases read at once.
+    :param per_host: the most connections open at once to each server,
+        told apart by backend, host and port. All SQLite files count as one
+        host.
+    :param version_table: the alembic version table.
+    :param depth: the most history rows read per database, to find out how
+        far ahead it is.
+    :return: a :class:`DriftReport`.
+    """
+    if futures is None:  # pragma: no cover
+        raise exc.AuditSetupError('the drift report needs concurrent.futures;'
+                                  ' install the futures backport')
+    script = _script_directory(script)
+    if auditor is None:
+        auditor = Auditor.create(None, user_version_nullable=True)
+    started = _clock()
+    check = functools.partial(
+        _check_one, auditor=auditor, version_table=version_table,
+        depth=depth, graph=RevisionGraph(script), pending=_Pending(script),
+        limits=_Limits(per_host))
+    with futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        entries = list(pool.map(check, [str(url) for url in urls]))
+    return DriftReport(tuple(script.get_heads()), entries,
+                       _clock() - started)
@@ -0,0 +1,229 @@
+"""Exporting the history table to files.
+
+:func:`export` reads the rows of a history table with
+:meth:`.Auditor.history`, in batches keyed on ``id``, and writes each batch
+to a JSON lines, CSV or Parquet file before reading the next, so memory use
+does not grow with the table. Given an
+:class:`ExportState`, it remembers the last id exported from each table, and
+the next export reads only the rows after it. The ``audit-alembic export``
+command does the same from the command line.
+
+Parquet needs ``pyarrow`` (``pip install audit-alembic[parquet]``).
+"""
+import collections
+import csv
+import io
+import json
+import os
+import sys
+import threading
+from datetime import datetime
+
+from sqlalchemy import types
+
+from . import exc
+from .base import _connect
+from .cache import _dump
+from .cache import _load
+from .cache import _persistent_key
+from .cache import _replace
+from .cache import _url_key
+from .compat import features
+from .sinks import _json_default
+
+ExportResult = collections.namedtuple('ExportResult',
+                                      'rows first_id last_id')
+ExportResult.__doc__ = """What :func:`export` wrote: the number of rows, and
+the ids of the first and last, None if there were none."""
+
+
+def _text(path):
+    if sys.version_info < (3,):  # pragma: no cover
+        return open(path, 'wb')
+    return io.open(path, 'w', encoding='utf-8', newline='')
+
+
+class JsonLinesWriter(object):
+    """Writes each row as a JSON object on a line of its own. Datetimes are
+    written in ISO 8601 format."""
+
+    def __init__(self, path, columns, table):
+        self.f = _text(path)
+
+    def write(self, rows):
+        for row in rows:
+            self.f.write(u'%s\n' % json.dumps(row, default=_json_default,
+                                              sort_keys=True))
+
+    def close(self):
+        self.f.close()
+
+
+class CsvWriter(object):
+    """Writes a header line of column names, then a line per row. Datetimes
+    are written in ISO 8601 format, and NULL as an empty field."""
+
+    def __init__(self, path, columns, table):
+        self.f = _text(path)
+        self.columns = columns
+        self.csv = csv.writer(self.f)
+        self.csv.writerow(columns)
+
+    @staticmethod
+    def _value(value):
+        if value is None:
+            return ''
+        if isinstance(value, (datetime, bytes)):
+            return _json_default(value)
+        return value
+
+    def write(self, rows):
+        self.csv.writerows([self._value(row.get(c)) for c in self.columns]
+                           for row in rows)
+
+    def close(self):
+        self.f.close()
+
+
+class ParquetWriter(object):
+    """Writes each batch of rows as a row group of a Parquet file, with a
+    schema following the column types of the table. Columns of
+    :paramref:`~.Auditor.dimensions` take the type of their values."""
+
+    def __init__(self, path, columns, table):
+        if not features()['pyarrow']:
+            raise exc.AuditSetupError('Parquet export needs pyarrow')
+        import pyarrow
+        import pyarrow.parquet
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema([
+            (c, self._type(table.c[c].type if c in table.c else None))
+            for c in columns])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+
+    def _type(self, type_):
+        pa = self.pyarrow
+        # variants and other decorated types, e.g. the BIGINT of id
+        while isinstance(type_, types.TypeDecorator):
+            type_ = type_.impl
+        for sa_type, pa_type in ((types.Boolean, pa.bool_()),
+                                 (types.Integer, pa.int64()),
+                                 (types.Float, pa.float64()),
+                                 (types.Numeric, pa.float64()),
+                                 (types.DateTime, pa.timestamp('us')),
+                                 (types.LargeBinary, pa.binary())):
+            if isinstance(type_, sa_type):
+                return pa_type
+        return pa.string()
+
+    def write(self, rows):
+        self.writer.write_table(self.pyarrow.Table.from_arrays(
+            [self.pyarrow.array([row.get(field.name) for row in rows],
+                                type=field.type)
+             for field in self.schema], schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+writers = {'jsonl': JsonLinesWriter, 'csv': CsvWriter,
+           'parquet': ParquetWriter}
+
+
+class ExportState(object):
+    """Keeps the last id exported from each history table in a JSON file,
+    keyed by database URL and table name.
+
+    :param path: the state file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(connection, table):
+        # relative SQLite paths made absolute, as they name the same file
+        # whatever the working directory of the export
+        url = connection.engine.url
+        return '%s|%s' % (_persistent_key(url) or _url_key(url),
+                          table.fullname)
+
+    def get(self, key):
+        """The last id exported for ``key``, or None."""
+        return _load(self.path).get(key)
+
+    def set(self, key, last_id):
+        with self._lock:
+            entries = _load(self.path)
+            entries[key] = last_id
+            _dump(self.path, entries, indent=0)
+
+
+def _columns(auditor):
+    columns = [c.key for c in auditor.table.c]
+    if auditor.revisions is not None:
+        columns.extend(['prev_alembic_version', 'alembic_version'])
+    return columns
+
+
+def _batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def export(auditor, bind, path, format='jsonl', state=None, after_id=None,
+           batch_size=1000):
+    """Write the rows of the history table of ``auditor`` to ``path``.
+
+    The file is written under a temporary name and moved into place once
+    complete; the state, if any, is updated after that, so that an export
+    interrupted half way is done again in full next time.
+
+    :param auditor: the :class:`.Auditor` of the history table.
+    :param bind: an ``Engine`` or ``Connection`` of the database holding
+        it.
+    :param path: the file to write. It is replaced if it exists.
+    :param format: ``jsonl``, ``csv`` or ``parquet``; see :data:`writers`.
+    :param state: an :class:`ExportState`. If given, only rows after the
+        last one it records for this table are exported, and it is updated.
+    :param after_id: only export rows after this id; overrides ``state``.
+    :param batch_size: how many rows to read and write at a time.
+    :return: an :class:`ExportResult`.
+    """
+    if format not in writers:
+        raise exc.AuditConstructError('unknown export format %r' % format)
+    id_key = auditor.column('id').key
+    with _connect(bind) as conn:
+        key = state.key(conn, auditor.table) if state is not None else None
+        if after_id is None and state is not None:
+            after_id = state.get(key)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        # the types of the rows, with values of dimension columns
+        source = auditor._select().alias()
+        writer = writers[format](tmp, _columns(auditor), source)
+        count, first_id, last_id = 0, None, None
+        try:
+            for batch in _batches(auditor.history(
+                    conn, after_id=after_id, batch_size=batch_size),
+                    batch_size):
+                writer.write(batch)
+                count += len(batch)
+                if first_id is None:
+                    first_id = batch[0][id_key]
+                last_id = batch[-1][id_key]
+        except Exception:
+            writer.close()
+            os.remove(tmp)
+            raise
+        writer.close()
+    _replace(tmp, path)
+    if state is not None and last_id is not None:
+        state.set(key, last_id)
+    return ExportResult(count, first_id, last_id)
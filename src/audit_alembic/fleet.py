@@ -0,0 +1,268 @@
+"""Upgrading many databases at once.
+
+:func:`upgrade_fleet` runs ``alembic upgrade`` against a list of database
+URLs from a pool of worker processes or threads, auditing each database with
+an :class:`.Auditor` of its own, and returns a :class:`FleetReport` of how
+each database fared. The ``audit-alembic fleet`` command does the same from
+the command line.
+
+Each database is migrated by a :class:`~alembic.runtime.migration.\
+MigrationContext` configured here, not by the project's ``env.py``: give
+any options ``env.py`` would pass to ``context.configure`` as
+``context_opts``.
+
+.. note::
+
+    The ``alembic.op`` proxy used by migration scripts is global to the
+    process. Worker threads therefore take turns running migration scripts,
+    and only connecting, checking the history table and the like overlap;
+    use processes, the default, for migrations to run in parallel.
+"""
+import collections
+import functools
+import threading
+import uuid
+from datetime import datetime
+
+from sqlalchemy import Column
+from sqlalchemy import Float
+from sqlalchemy import Integer
+from sqlalchemy import MetaData
+from sqlalchemy import String
+from sqlalchemy import Table
+from sqlalchemy import Text
+from sqlalchemy import create_engine
+from sqlalchemy import types
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import NullPool
+
+from . import exc
+from .base import Auditor
+from .base import _clock
+from .base import _pending_revisions
+from .base import _script_directory
+from .cache import _url_key
+
+try:
+    from concurrent import futures
+except ImportError:  # pragma: no cover
+    futures = None
+
+# scripts may only run one at a time per process: see the module docstring
+_op_lock = threading.Lock()
+# ScriptDirectory instances of a worker process, by _script_args; a worker
+# process lasts as long as its fleet run
+_scripts = {}
+
+DatabaseResult = collections.namedtuple(
+    'DatabaseResult',
+    'url status revision started_at duration steps error')
+DatabaseResult.__doc__ = """How the upgrade of one database went.
+
+``url`` is the database URL without its password, ``status`` one of ``ok``
+or ``failed``, ``revision`` the database's heads afterwards joined by
+``##``, ``duration`` the seconds taken, ``steps`` the number of migration
+steps applied and ``error`` a description of the failure, if any.
+"""
+
+
+class FleetReport(object):
+    """The outcome of :func:`upgrade_fleet`.
+
+    :param run_id: a unique id for the fleet run.
+    :param results: a list of :class:`DatabaseResult`, in the order of the
+        URLs given.
+    :param duration: the seconds taken by the whole run.
+    """
+
+    def __init__(self, run_id, results, duration):
+        self.run_id = run_id
+        self.results = results
+        self.duration = duration
+
+    @property
+    def ok(self):
+        """Whether every database was upgraded."""
+        return all(r.status == 'ok' for r in self.results)
+
+    @property
+    def failed(self):
+        return [r for r in self.results if r.status != 'ok']
+
+    def format(self):
+        """The report as lines of text, one per database then a total."""
+        lines = ['%-6s %8.2fs %-32s %s%s' % (
+            r.status, r.duration, r.revision or '-', r.url,
+            ': ' + r.error if r.error else '') for r in self.results]
+        lines.append('%d database(s), %d failed, %.2fs' % (
+            len(self.results), len(self.failed), self.duration))
+        return lines
+
+
+def summary_table(metadata=None, name='alembic_fleet_history'):
+    """Define a table recording one row per database per fleet run, for
+    :paramref:`~upgrade_fleet.summary_bind`."""
+    return Table(
+        name, metadata if metadata is not None else MetaData(),
+        Column('id', types.BIGINT().with_variant(Integer, 'sqlite'),
+               primary_key=True),
+        Column('run_id', String(32), nullable=False, index=True),
+        Column('url', String(255), nullable=False),
+        Column('status', String(16), nullable=False),
+        Column('revision', String(255)),
+        Column('started_at', types.DateTime()),
+        Column('duration', Float()),
+        Column('steps', Integer()),
+        Column('error', Text()),
+    )
+
+
+def _script_args(script):
+    """Picklable arguments rebuilding the ``ScriptDirectory`` ``script``."""
+    args = [('dir', script.dir)]
+    for name in ('file_template', 'truncate_slug_length',
+                 'version_locations', 'sourceless', 'output_encoding',
+                 'timezone'):
+        if hasattr(script, name):
+            value = getattr(script, name)
+            args.append((name, tuple(value) if isinstance(value, list)
+                         else value))
+    return tuple(args)
+
+
+def _get_script(script_args):
+    script = _scripts.get(script_args)
+    if script is None:
+        from alembic.script import ScriptDirectory
+        kw = dict(script_args)
+        if kw.get('version_locations') is not None:
+            kw['version_locations'] = list(kw['version_locations'])
+        script = _scripts[script_args] = ScriptDirectory(**kw)
+    return script
+
+
+class _nothing(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+def _upgrade_one(script, url, revision, auditor_factory, context_opts,
+                 serialize):
+    """Upgrade the database at ``url``; run by workers. ``script`` is a
+    ``ScriptDirectory``, or in a worker process its :func:`_script_args`.
+    """
+    from alembic.operations import Operations
+    from alembic.runtime.migration import MigrationContext
+    from alembic.runtime.migration import MigrationStep
+
+    started_at = datetime.utcnow()
+    started = _clock()
+    steps = []
+    heads = ()
+    try:
+        if isinstance(script, tuple):
+            script = _get_script(script)
+        auditor = auditor_factory()
+
+        def upgrade(rev, context):
+            return [MigrationStep.upgrade_from_script(script.revision_map, sc)
+                    for sc in _pending_revisions(script, revision, rev)]
+
+        def count(**kw):
+            steps.append(kw['step'])
+
+        engine = create_engine(url, poolclass=NullPool)
+        try:
+            with engine.connect() as conn:
+                opts = dict(context_opts or {})
+                opts.update(fn=upgrade, script=script,
+                            on_version_apply=(auditor.listen, count))
+                ctx = MigrationContext.configure(connection=conn, opts=opts)
+                with _op_lock if serialize else _nothing():
+                    with Operations.context(ctx):
+                        with ctx.begin_transaction():
+                            with auditor.run(ctx):
+                                ctx.run_migrations()
+                heads = ctx.get_current_heads()
+        finally:
+            engine.dispose()
+    except Exception as e:
+        return DatabaseResult(_url_key(make_url(url)), 'failed',
+                              '##'.join(heads) or None, started_at,
+                              _clock() - started, len(steps),
+                              '%s: %s' % (type(e).__name__, e))
+    return DatabaseResult(_url_key(make_url(url)), 'ok',
+                          '##'.join(heads) or None, started_at,
+                          _clock() - started, len(steps), None)
+
+
+def upgrade_fleet(script, urls, revision='heads', auditor_factory=None,
+                  user_version=None, workers=4, executor='process',
+                  context_opts=None, summary_bind=None, summary=None):
+    """Upgrade each of ``urls`` to ``revision``.
+
+    A failure on one database is reported and does not stop the others.
+
+    :param script: the ``ScriptDirectory`` of the migrations, or an alembic
+        ``Config`` or the path to an ``alembic.ini`` locating it.
+    :param urls: database URLs.
+    :param revision: the revision to upgrade to.
+    :param auditor_factory: a callable taking no arguments and returning
+        the :class:`.Auditor` of one database; it is called once per
+        database. With processes, it must be picklable, e.g. a module-level
+        function or a ``functools.partial`` of one. Defaults to
+        :meth:`.Auditor.create` with ``user_version``.
+    :param user_version: the user version for the default auditor.
+    :param workers: the number of databases upgraded at once.
+    :param executor: ``process`` or ``thread``; see the module docstring.
+    :param context_opts: further options for each ``MigrationContext``, as
+        would be passed to ``context.configure`` in ``env.py``, e.g.
+        ``version_table``. They must be picklable with processes.
+    :param summary_bind: an ``Engine`` or URL of a database to record the
+        outcome in, one row per database in the :func:`summary_table`.
+    :param summary: the table to use instead of the default
+        :func:`summary_table`.
+    :return: a :class:`FleetReport`.
+    """
+    if executor not in ('process', 'thread'):
+        raise exc.AuditConstructError('unknown executor %r' % executor)
+    if futures is None:  # pragma: no cover
+        raise exc.AuditSetupError('the fleet runner needs concurrent.futures;'
+                                  ' install the futures backport')
+    script = _script_directory(script)
+    if auditor_factory is None:
+        auditor_factory = functools.partial(
+            Auditor.create, user_version, user_version_nullable=True)
+    run_id = uuid.uuid4().hex
+    started = _clock()
+    pool = (futures.ProcessPoolExecutor if executor == 'process'
+            else futures.ThreadPoolExecutor)(max_workers=workers)
+    with pool:
+        if executor == 'process':
+            script = _script_args(script)
+        jobs = [pool.submit(_upgrade_one, script, str(url), revision,
+                            auditor_factory, context_opts,
+                            executor == 'thread')
+                for url in urls]
+        results = [job.result() for job in jobs]
+    report = FleetReport(run_id, results, _clock() - started)
+    if summary_bind is not None:
+        record_summary(report, summary_bind, summary)
+    return report
+
+
+def record_summary(report, bind, table=None):
+    """Write ``report`` to ``table``, created if needed, through ``bind``,
+    an ``Engine`` or URL."""
+    if table is None:
+        table = summary_table()
+    engine = bind if hasattr(bind, 'connect') else create_engine(bind)
+    with engine.begin() as conn:
+        table.create(conn, checkfirst=True)
+        if report.results:
+            conn.execute(table.insert(), [
+                dict(r._asdict(), run_id=report.run_id)
+                for r in report.results])
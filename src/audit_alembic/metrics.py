@@ -0,0 +1,330 @@
+"""Migration metrics for dashboards.
+
+Given exporters through :paramref:`~.Auditor.metrics`, an :class:`.Auditor`
+emits an event per migration step, and one per run opened with
+:meth:`.Auditor.run`. Events are put on a queue and handed to the exporters
+by a background thread, so that exporting never holds up the migration; if
+the queue is full, events are dropped and counted in
+:attr:`Emitter.dropped`.
+
+Built-in exporters:
+
+* :class:`PrometheusTextfile` writes counters and histograms in the
+  Prometheus text format, for the node exporter's textfile collector.
+* :class:`SpanRecorder` keeps a span per run and per step, in the manner of
+  OpenTelemetry, in memory or for a callback to forward.
+"""
+import atexit
+import collections
+import logging
+import os
+import threading
+import time
+import uuid
+
+from .base import _clock
+from .base import ccv
+
+try:
+    import queue
+except ImportError:  # pragma: no cover
+    import Queue as queue
+
+log = logging.getLogger(__name__)
+
+StepEvent = collections.namedtuple('StepEvent', (
+    'run_id', 'operation_type', 'direction', 'source', 'destination',
+    'started_at', 'duration', 'sql_statements', 'sql_rows', 'sql_time'))
+StepEvent.__doc__ = """A migration step, as given to :meth:`Exporter.step`.
+
+``operation_type`` and ``direction`` are as computed by
+:class:`.CommonColumnValues`; ``source`` and ``destination`` are tuples of
+revisions; ``started_at`` is a Unix time. ``duration`` and the ``sql_*``
+measurements are as described for :class:`.StepMetric`, None where not
+measured.
+"""
+
+RunEvent = collections.namedtuple('RunEvent', (
+    'run_id', 'started_at', 'duration', 'steps', 'status'))
+RunEvent.__doc__ = """A migration run, as given to :meth:`Exporter.run`.
+
+``status`` is ``ok``, or ``failed`` if the :meth:`.Auditor.run` block
+raised.
+"""
+
+
+class Exporter(object):
+    """Base class for metrics exporters. Methods are called from the
+    emitter's thread, one at a time."""
+
+    def step(self, event):
+        """Take a :class:`StepEvent`."""
+
+    def run(self, event):
+        """Take a :class:`RunEvent`."""
+
+    def flush(self):
+        """Called whenever the emitter has caught up with the migration."""
+
+
+class Emitter(object):
+    """Hands events over to exporters from a background thread.
+
+    :param exporters: a list of :class:`Exporter`.
+    :param maxsize: the most events that may wait in the queue.
+    :param exit_timeout: the most seconds to wait, when the process exits,
+        for the events emitted so far to be exported.
+    """
+
+    def __init__(self, exporters, maxsize=10000, exit_timeout=5):
+        self.exporters = list(exporters)
+        self.exit_timeout = exit_timeout
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize)
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def begin(self, run):
+        """Note the start of a run."""
+        run.id = uuid.uuid4().hex
+        run.started_at = time.time()
+        # later times are offsets on the monotonic clock, from this one,
+        # which an explicit run has already started timing its first step at
+        run.clock_started = run.step_started or _clock()
+
+    @staticmethod
+    def _elapsed(run):
+        return _clock() - run.clock_started
+
+    def step(self, run, step):
+        """Emit the step just ended in ``run``."""
+        metrics = run.metrics
+        duration = metrics.get('duration')
+        now = run.started_at + self._elapsed(run)
+        self._put(('step', StepEvent(
+            run.id, ccv.operation_type(step=step),
+            ccv.operation_direction(step=step),
+            tuple(step.source_revision_ids),
+            tuple(step.destination_revision_ids),
+            now - duration if duration is not None else now, duration,
+            metrics.get('sql_statements'), metrics.get('sql_rows'),
+            metrics.get('sql_time'))))
+
+    def end(self, run, status='ok'):
+        """Emit a run opened by :meth:`.Auditor.run`."""
+        self._put(('run', RunEvent(run.id, run.started_at,
+                                   self._elapsed(run), run.steps, status)))
+
+    def _put(self, item):
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    def _start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._work, name='audit-alembic-metrics')
+                self._thread.daemon = True
+                self._thread.start()
+                atexit.register(self.flush, self.exit_timeout)
+
+    def _work(self):
+        pending = False
+        while True:
+            kind, event = self._queue.get()
+            if kind != 'flushed':
+                pending = True
+                self._call(kind, event)
+            if pending and (kind == 'flushed' or self._queue.empty()):
+                pending = False
+                self._call('flush')
+            if kind == 'flushed':
+                event.set()
+
+    def _call(self, method, *args):
+        for exporter in self.exporters:
+            try:
+                getattr(exporter, method)(*args)
+            except Exception:
+                log.exception('metrics exporter %r failed', exporter)
+
+    def flush(self, timeout=None):
+        """Block until events emitted so far are exported.
+
+        :return: whether that happened within ``timeout`` seconds.
+        """
+        if self._thread is None:
+            return True
+        marker = threading.Event()
+        self._queue.put(('flushed', marker))
+        return marker.wait(timeout)
+
+
+def _labels(labels):
+    return ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\')
+                                 .replace('"', '\\"'))
+                    for k, v in sorted(labels.items(),
+                                       key=lambda kv: (kv[0] == 'le', kv)))
+
+
+class PrometheusTextfile(Exporter):
+    """Writes metrics to a file in the Prometheus text format, replacing it
+    atomically each time the emitter catches up. Point the node exporter's
+    textfile collector at its directory.
+
+    Metrics, all prefixed with :paramref:`prefix`:
+
+    * ``steps_total``: migration steps, by ``operation_type`` and
+      ``direction``.
+    * ``step_duration_seconds``: a histogram of step durations, by the same
+      labels.
+    * ``runs_total``: runs, by ``status``.
+    * ``last_run_duration_seconds``, ``last_run_steps``,
+      ``last_run_timestamp_seconds``: of the last run.
+
+    :param path: the file, conventionally ending in ``.prom``.
+    :param labels: a dict of labels added to every metric, e.g. the
+        database name.
+    :param buckets: upper bounds of the duration histogram buckets.
+    :param prefix: the prefix of the metric names.
+    """
+
+    def __init__(self, path, labels=None, prefix='alembic_audit_',
+                 buckets=(.01, .05, .1, .5, 1, 5, 10, 30, 60, 300)):
+        self.path = path
+        self.labels = dict(labels or {})
+        self.prefix = prefix
+        self.buckets = tuple(buckets)
+        self.steps = collections.Counter()
+        self.durations = {}
+        self.runs = collections.Counter()
+        self.last_run = None
+        self._dirty = False
+
+    def step(self, event):
+        key = (event.operation_type, event.direction)
+        self.steps[key] += 1
+        if event.duration is not None:
+            hist = self.durations.setdefault(
+                key, [[0] * len(self.buckets), 0, 0.0])
+            for i, bound in enumerate(self.buckets):
+                if event.duration <= bound:
+                    hist[0][i] += 1
+            hist[1] += 1
+            hist[2] += event.duration
+        self._dirty = True
+
+    def run(self, event):
+        self.runs[event.status] += 1
+        self.last_run = event
+        self._dirty = True
+
+    def render(self):
+        """The metrics as text."""
+        p = self.prefix
+        lines = []
+
+        def sample(name, value, **labels):
+            labels = dict(self.labels, **labels)
+            lines.append('%s%s%s %s' % (
+                p, name, '{%s}' % _labels(labels) if labels else '',
+                repr(float(value))))
+
+        lines.append('# HELP %ssteps_total Migration steps applied.' % p)
+        lines.append('# TYPE %ssteps_total counter' % p)
+        for (type_, direction), n in sorted(self.steps.items()):
+            sample('steps_total', n, operation_type=type_,
+                   direction=direction)
+        lines.append('# HELP %sstep_duration_seconds Duration of migration '
+                     'steps.' % p)
+        lines.append('# TYPE %sstep_duration_seconds histogram' % p)
+        for (type_, direction), (counts, n, total) in sorted(
+                self.durations.items()):
+            for bound, count in zip(self.buckets, counts):
+                sample('step_duration_seconds_bucket', count,
+                       operation_type=type_, direction=direction,
+                       le=repr(float(bound)))
+            sample('step_duration_seconds_bucket', n, operation_type=type_,
+                   direction=direction, le='+Inf')
+            sample('step_duration_seconds_sum', total, operation_type=type_,
+                   direction=direction)
+            sample('step_duration_seconds_count', n, operation_type=type_,
+                   direction=direction)
+        lines.append('# HELP %sruns_total Migration runs.' % p)
+        lines.append('# TYPE %sruns_total counter' % p)
+        for status, n in sorted(self.runs.items()):
+            sample('runs_total', n, status=status)
+        if self.last_run is not None:
+            run = self.last_run
+            for name, value in (
+                    ('last_run_duration_seconds', run.duration),
+                    ('last_run_steps', run.steps),
+                    ('last_run_timestamp_seconds',
+                     run.started_at + run.duration)):
+                lines.append('# TYPE %s%s gauge' % (p, name))
+                sample(name, value)
+        return '\n'.join(lines) + '\n'
+
+    def flush(self):
+        if not self._dirty:
+            return
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        getattr(os, 'replace', os.rename)(tmp, self.path)
+        self._dirty = False
+
+
+Span = collections.namedtuple('Span', (
+    'name', 'trace_id', 'span_id', 'parent_id', 'start_time', 'end_time',
+    'attributes'))
+Span.__doc__ = """A span, in the manner of OpenTelemetry: ids are hex
+strings, times are Unix times. A run is a trace whose root span, named
+``alembic.run``, is the parent of one ``alembic.step`` span per step."""
+
+
+class SpanRecorder(Exporter):
+    """Records a :class:`Span` per run and per step.
+
+    :param callback: if given, each span is passed to it, e.g. to forward it
+        to a tracing system, rather than kept in :attr:`spans`.
+    :param maxlen: the most spans kept; older ones are discarded.
+    """
+
+    def __init__(self, callback=None, maxlen=10000):
+        self.callback = callback
+        self.spans = collections.deque(maxlen=maxlen)
+
+    @staticmethod
+    def _root_id(run_id):
+        return run_id[:16] if run_id else None
+
+    def _record(self, span):
+        if self.callback is not None:
+            self.callback(span)
+        else:
+            self.spans.append(span)
+
+    def step(self, event):
+        self._record(Span(
+            'alembic.step', event.run_id, uuid.uuid4().hex[:16],
+            self._root_id(event.run_id), event.started_at,
+            event.started_at + (event.duration or 0.0), {
+                'alembic.operation_type': event.operation_type,
+                'alembic.direction': event.direction,
+                'alembic.source': ','.join(event.source),
+                'alembic.destination': ','.join(event.destination),
+                'db.statements': event.sql_statements,
+            }))
+
+    def run(self, event):
+        self._record(Span(
+            'alembic.run', event.run_id, self._root_id(event.run_id), None,
+            event.started_at, event.started_at + event.duration, {
+                'alembic.steps': event.steps,
+                'alembic.status': event.status,
+            }))
@@ -0,0 +1,182 @@
+"""Predicting how long pending migrations will take.
+
+:func:`predict` lists the steps ``alembic upgrade`` (or ``downgrade``) would
+run on a database, and estimates each from the durations recorded for the
+same revision in a history table, e.g. that of a staging database or of the
+databases of earlier deployments. The ``audit-alembic predict`` command does
+the same from the command line.
+
+Recording durations needs a history table with a ``duration`` column, see
+:paramref:`~.Auditor.create.duration_column_name`.
+"""
+import collections
+import os
+import threading
+
+from .base import _connect
+from .base import _pending_revisions
+from .base import _script_directory
+from .cache import _default_cache_path
+from .cache import _dump
+from .cache import _load
+from .cache import _url_key
+
+StepEstimate = collections.namedtuple('StepEstimate',
+                                      'revision doc samples p50 p95')
+StepEstimate.__doc__ = """The estimate of one pending step.
+
+``revision`` is the revision the step applies, ``samples`` the number of
+durations recorded for it, and ``p50`` and ``p95`` the median and 95th
+percentile of those in seconds, or None without history.
+"""
+
+
+def percentile(values, fraction):
+    """The ``fraction`` quantile of ``values``, interpolating linearly
+    between the closest ranks."""
+    values = sorted(values)
+    if not values:
+        return None
+    rank = fraction * (len(values) - 1)
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+class Prediction(object):
+    """The outcome of :func:`predict`.
+
+    Totals add up the percentiles of each step, so :attr:`p95` is a
+    pessimistic bound: all steps are rarely slow at once. Steps without
+    history count for nothing; check :attr:`unknown`.
+
+    :param steps: a list of :class:`StepEstimate`, in the order they would
+        run.
+    :param direction: ``up`` or ``down``.
+    """
+
+    def __init__(self, steps, direction='up'):
+        self.steps = steps
+        self.direction = direction
+
+    @property
+    def unknown(self):
+        """The steps with no recorded duration."""
+        return [s for s in self.steps if not s.samples]
+
+    @property
+    def p50(self):
+        return sum(s.p50 for s in self.steps if s.samples)
+
+    @property
+    def p95(self):
+        return sum(s.p95 for s in self.steps if s.samples)
+
+    def format(self):
+        """The prediction as lines of text, one per step then a total."""
+        lines = ['%-32s %8s %8s %5d  %s' % (
+            s.revision,
+            '%.2fs' % s.p50 if s.samples else '?',
+            '%.2fs' % s.p95 if s.samples else '?',
+            s.samples, s.doc or '') for s in self.steps]
+        lines.append('%d step(s) %s: p50 %.2fs, p95 %.2fs%s' % (
+            len(self.steps), self.direction, self.p50, self.p95,
+            ', %d without history' % len(self.unknown)
+            if self.unknown else ''))
+        return lines
+
+
+class DurationCache(object):
+    """Keeps the durations read from history tables in a JSON file on local
+    disk, so that a later prediction against the same table only reads the
+    rows added since, by id.
+
+    :param path: the cache file. Defaults to
+        ``$XDG_CACHE_HOME/audit_alembic/durations.json``.
+    :param max_samples: the most durations kept per revision; the oldest
+        are dropped.
+    """
+
+    def __init__(self, path=None, max_samples=1000):
+        self.path = path or _default_cache_path('durations.json')
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+
+    def durations(self, auditor, bind, direction='up'):
+        """All durations recorded in the table of ``auditor`` through
+        ``bind``, as a dict of revision to list of seconds, updated from the
+        database first."""
+        with _connect(bind) as conn:
+            key = '%s|%s|%s' % (_url_key(conn.engine.url),
+                                auditor.table.fullname, direction)
+            with self._lock:
+                entries = _load(self.path)
+                entry = entries.get(key) or {'after_id': None,
+                                             'durations': {}}
+                found = entry['durations']
+                for id_, revision, duration in auditor.durations(
+                        conn, direction=direction,
+                        after_id=entry['after_id']):
+                    found.setdefault(revision, []).append(duration)
+                    entry['after_id'] = id_
+                for revision, values in found.items():
+                    del values[:-self.max_samples]
+                entries[key] = entry
+                _dump(self.path, entries)
+        return found
+
+    def clear(self):
+        """Forget all entries."""
+        with self._lock:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+
+def predict(auditor, bind, script, revision='heads', current=None,
+            target_bind=None, downgrade=False, cache=None,
+            version_table='alembic_version'):
+    """Estimate how long migrating to ``revision`` would take.
+
+    :param auditor: the :class:`.Auditor` of the history table to read.
+    :param bind: an ``Engine`` or ``Connection`` of the database holding
+        it.
+    :param script: the ``ScriptDirectory`` of the migrations, or an alembic
+        ``Config`` or the path to an ``alembic.ini`` locating it.
+    :param revision: the target revision.
+    :param current: the current heads of the database to migrate. Defaults
+        to those read from ``target_bind``.
+    :param target_bind: an ``Engine`` or ``Connection`` of the database to
+        migrate, if not that of ``bind``.
+    :param downgrade: whether to predict a downgrade to ``revision``.
+    :param cache: a :class:`DurationCache`. Without one, the durations of
+        the pending revisions are summarized afresh in the database, with
+        :meth:`.Auditor.duration_percentiles`.
+    :param version_table: the alembic version table, to read the current
+        heads from.
+    :return: a :class:`Prediction`.
+    """
+    script = _script_directory(script)
+    if current is None:
+        from alembic.runtime.migration import MigrationContext
+        with _connect(target_bind if target_bind is not None
+                      else bind) as conn:
+            current = MigrationContext.configure(
+                conn, opts={'version_table': version_table}
+            ).get_current_heads()
+    scripts = _pending_revisions(script, revision, current, downgrade)
+    direction = 'down' if downgrade else 'up'
+    if cache is not None:
+        found = {}
+        for rev, values in cache.durations(auditor, bind, direction).items():
+            found[rev] = (len(values),
+                          [percentile(values, .5), percentile(values, .95)])
+    else:
+        found = auditor.duration_percentiles(
+            bind, [sc.revision for sc in scripts], (.5, .95), direction)
+    estimates = []
+    for sc in scripts:
+        count, (p50, p95) = found.get(sc.revision, (0, (None, None)))
+        estimates.append(StepEstimate(sc.revision, sc.doc, count, p50, p95))
+    return Prediction(estimates, direction)
@@ -0,0 +1,135 @@
+"""Profiling of individual migration steps.
+
+A :class:`StepProfiler` given to an :class:`.Auditor` wraps each migration
+step with ``cProfile`` and/or ``tracemalloc``. The results are available as
+:class:`.StepMetric` values ``profile`` and ``peak_memory``, which
+:meth:`.Auditor.create` stores in columns of the history table.
+"""
+import cProfile
+import json
+import os
+import pstats
+import random
+import uuid
+import zlib
+
+from . import exc
+
+try:
+    import tracemalloc
+except ImportError:  # pragma: no cover
+    tracemalloc = None
+
+
+def load_profile(data):
+    """Decode a compact profile as stored in the history table.
+
+    :return: a list of ``[function, ncalls, tottime, cumtime]`` lists,
+        hottest first.
+    """
+    return json.loads(zlib.decompress(data).decode('utf-8'))
+
+
+class _Session(object):
+    __slots__ = ('profile', 'tracing')
+
+    def __init__(self, profile, tracing):
+        self.profile = profile
+        self.tracing = tracing
+
+
+class StepProfiler(object):
+    """Profiles migration steps.
+
+    :param cprofile: run each step under ``cProfile``.
+    :param memory: trace memory allocations of each step with
+        ``tracemalloc`` and report the peak, in bytes.
+    :param top: how many of the functions with the highest internal time to
+        keep in the compact profile.
+    :param sample_rate: the fraction of steps to profile, between 0 and 1.
+        Steps not sampled have no profile and no peak memory.
+    :param directory: if given, full ``pstats`` dumps are written there, one
+        file per step named after its destination revision(s), and the
+        ``profile`` value is the file's name rather than a compact profile.
+        Either way the profile is found through the history row.
+    """
+
+    def __init__(self, cprofile=True, memory=False, top=20, sample_rate=1.0,
+                 directory=None):
+        if memory and tracemalloc is None:  # pragma: no cover
+            raise exc.AuditConstructError('tracemalloc is not available')
+        self.cprofile = cprofile
+        self.memory = memory
+        self.top = top
+        self.sample_rate = sample_rate
+        self.directory = directory
+
+    def start(self):
+        """Begin profiling a step.
+
+        :return: a session to pass to :meth:`stop`, or None if the step is
+            not sampled.
+        """
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return None
+        tracing = None
+        if self.memory:
+            tracing = not tracemalloc.is_tracing()
+            if tracing:
+                tracemalloc.start()
+            elif hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+        profile = None
+        if self.cprofile:
+            profile = cProfile.Profile()
+            profile.enable()
+        return _Session(profile, tracing)
+
+    def cancel(self, session):
+        """Stop profiling without keeping the results."""
+        if session is not None:
+            if session.profile is not None:
+                session.profile.disable()
+            if session.tracing:
+                tracemalloc.stop()
+
+    def stop(self, session, step=None):
+        """Finish profiling a step.
+
+        :param session: as returned by :meth:`start`.
+        :param step: the ``MigrationInfo`` of the step, used to name files.
+        :return: a dict with keys ``profile`` and ``peak_memory``.
+        """
+        if session is None:
+            return {'profile': None, 'peak_memory': None}
+        if session.profile is not None:
+            session.profile.disable()
+        peak = None
+        if session.tracing is not None:
+            peak = tracemalloc.get_traced_memory()[1]
+            if session.tracing:
+                tracemalloc.stop()
+        profile = None
+        if session.profile is not None:
+            if self.directory:
+                profile = self._dump(session.profile, step)
+            else:
+                profile = self._compact(session.profile)
+        return {'profile': profile, 'peak_memory': peak}
+
+    def _compact(self, profile):
+        stats = pstats.Stats(profile).stats
+        hot = sorted(stats.items(), key=lambda item: -item[1][2])
+        summary = [[pstats.func_std_string(func), nc, round(tt, 6),
+                    round(ct, 6)]
+                   for func, (cc, nc, tt, ct, callers) in hot[:self.top]]
+        return zlib.compress(json.dumps(summary).encode('utf-8'))
+
+    def _dump(self, profile, step):
+        revisions = getattr(step, 'destination_revision_ids', None) or \
+            ('base',)
+        name = '%s-%s.prof' % ('_'.join(revisions), uuid.uuid4().hex[:12])
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        profile.dump_stats(os.path.join(self.directory, name))
+        return name
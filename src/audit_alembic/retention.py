@@ -0,0 +1,234 @@
+"""Pruning old rows of the history table.
+
+:func:`prune` deletes the rows of a history table older than a given age,
+optionally only those of one operation type, e.g. ``stamp``. It works in
+small batches bounded by id, each in a transaction of its own, so that
+locks are held briefly and other migrations are not held up. Before a batch
+is deleted:
+
+* it is folded into a :func:`rollup_table`, which keeps, per revision,
+  operation type and direction, when it was first and last applied, how
+  many times, and the minimum, average and maximum durations where
+  recorded;
+* it may be archived to a gzip-compressed JSON lines file.
+
+The ``audit-alembic prune`` command does the same from the command line.
+"""
+import collections
+import gzip
+import json
+import os
+import time
+from datetime import datetime
+
+from sqlalchemy import Column
+from sqlalchemy import Integer
+from sqlalchemy import MetaData
+from sqlalchemy import PrimaryKeyConstraint
+from sqlalchemy import String
+from sqlalchemy import Table
+from sqlalchemy import and_
+from sqlalchemy import select
+from sqlalchemy import types
+
+from .base import _connect
+from .cache import _replace
+from .sinks import _json_default
+
+PruneResult = collections.namedtuple('PruneResult', 'rows batches archives')
+PruneResult.__doc__ = """What :func:`prune` did: the number of rows deleted,
+the number of batches, and the paths of the archive files written."""
+
+
+def rollup_table(history, metadata=None, name=None):
+    """Define the rollup table of the history table ``history``, named after
+    it with a ``_rollup`` suffix by default."""
+    return Table(
+        name or '%s_rollup' % history.name,
+        metadata if metadata is not None else MetaData(),
+        Column('revision', String(255), nullable=False),
+        Column('operation_type', String(32), nullable=False),
+        Column('operation_direction', String(32), nullable=False),
+        Column('first_applied', types.DateTime()),
+        Column('last_applied', types.DateTime()),
+        Column('count', Integer(), nullable=False),
+        Column('duration_count', Integer(), nullable=False),
+        Column('duration_min', types.Float()),
+        Column('duration_avg', types.Float()),
+        Column('duration_max', types.Float()),
+        PrimaryKeyConstraint('revision', 'operation_type',
+                             'operation_direction'),
+        schema=history.schema,
+    )
+
+
+def _keys(auditor):
+    """The key of each role in the rows :meth:`.Auditor.history` reads."""
+    keys = dict((role, auditor.column(role).key) for role in (
+        'changed_at', 'operation_type', 'operation_direction'))
+    keys['alembic_version'] = (
+        'alembic_version' if auditor.revisions is not None
+        else auditor.column('alembic_version').key)
+    for role in ('duration', 'steps'):
+        if auditor.roles.get(role, '') in auditor.table.c:
+            keys[role] = auditor.column(role).key
+    return keys
+
+
+def _summarize(rows, keys):
+    """Aggregate history rows as the rollup table does; ``keys`` tells
+    which key of each row holds what, as :func:`_keys` does."""
+    found = {}
+    for row in rows:
+        duration = row.get(keys.get('duration'))
+        key = (row[keys['alembic_version']] or '',
+               row[keys['operation_type']],
+               row[keys['operation_direction']])
+        entry = found.get(key)
+        if entry is None:
+            entry = found[key] = {
+                'first_applied': None, 'last_applied': None, 'count': 0,
+                'duration_count': 0, 'duration_min': None,
+                'duration_avg': None, 'duration_max': None}
+        _merge(entry, {
+            'first_applied': row[keys['changed_at']],
+            'last_applied': row[keys['changed_at']],
+            'count': row.get(keys.get('steps')) or 1,
+            'duration_count': 0 if duration is None else 1,
+            'duration_min': duration,
+            'duration_avg': duration,
+            'duration_max': duration})
+    return found
+
+
+def _merge(entry, other):
+    """Fold the aggregates ``other`` into ``entry``."""
+    def pick(fn, a, b):
+        return b if a is None else a if b is None else fn(a, b)
+
+    n, m = entry['duration_count'], other['duration_count']
+    if m:
+        entry['duration_avg'] = ((entry['duration_avg'] or 0.0) * n +
+                                 other['duration_avg'] * m) / (n + m)
+    entry['duration_count'] = n + m
+    entry['count'] += other['count']
+    for key, fn in (('first_applied', min), ('last_applied', max),
+                    ('duration_min', min), ('duration_max', max)):
+        entry[key] = pick(fn, entry[key], other[key])
+
+
+def _update_rollup(conn, rollup, rows, keys):
+    c = rollup.c
+    for (revision, type_, direction), found in _summarize(rows,
+                                                          keys).items():
+        where = and_(c.revision == revision, c.operation_type == type_,
+                     c.operation_direction == direction)
+        existing = conn.execute(select([rollup]).where(where)).first()
+        if existing is None:
+            conn.execute(rollup.insert().values(
+                revision=revision, operation_type=type_,
+                operation_direction=direction, **found))
+        else:
+            entry = dict(existing)
+            _merge(entry, found)
+            conn.execute(rollup.update().where(where).values(
+                dict((k, entry[k]) for k in found)))
+
+
+def _archive(directory, table, rows, id_key):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = os.path.join(directory, '%s-%s-%s.jsonl.gz' % (
+        table.name, rows[0][id_key], rows[-1][id_key]))
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with gzip.open(tmp, 'wb') as f:
+        for row in rows:
+            f.write(json.dumps(row, default=_json_default,
+                               sort_keys=True).encode('utf-8') + b'\n')
+    _replace(tmp, path)
+    return path
+
+
+def read_archive(path):
+    """Iterate over the rows of an archive file written by :func:`prune`, as
+    dicts; datetimes are left in ISO 8601 format."""
+    with gzip.open(path, 'rb') as f:
+        for line in f:
+            yield json.loads(line.decode('utf-8'))
+
+
+def prune(auditor, bind, older_than, operation_type=None, rollup=True,
+          archive_dir=None, batch_size=500, pause=0, now=None):
+    """Delete the rows of the history table of ``auditor`` changed more than
+    ``older_than`` ago.
+
+    Each batch is read, rolled up, archived and deleted in a transaction of
+    its own; the delete is bounded by the ids of the batch. If a batch
+    fails, the batches before it stay deleted, and the failed one may be
+    left archived: running again picks up where it stopped.
+
+    :param auditor: the :class:`.Auditor` of the history table.
+    :param bind: an ``Engine`` of the database holding it; a ``Connection``
+        must not be in a transaction already.
+    :param older_than: a ``timedelta``.
+    :param operation_type: only prune rows of this type, e.g. ``stamp``.
+    :param rollup: whether to update the :func:`rollup_table`, created if
+        needed; or a ``Table`` defined likewise to update instead.
+    :param archive_dir: if given, write each batch to a gzip-compressed
+        JSON lines file in this directory, named after the table and the ids
+        of the batch; see :func:`read_archive`.
+    :param batch_size: the most rows deleted per transaction.
+    :param pause: seconds to sleep between batches, to let other writers
+        in.
+    :param now: the current UTC time, by default ``datetime.utcnow()``.
+    :return: a :class:`PruneResult`.
+    """
+    cutoff = (now or datetime.utcnow()) - older_than
+    id_col = auditor.column('id')
+    changed_at = auditor.column('changed_at')
+    if rollup is True:
+        rollup = rollup_table(auditor.table)
+    elif rollup is False:
+        rollup = None
+    keys = _keys(auditor)
+    filters = [changed_at < cutoff]
+    if operation_type is not None:
+        column = auditor.column('operation_type')
+        if column.key in auditor.dimensions:
+            dimension = auditor.dimensions[column.key]
+            filters.append(column.in_(select([dimension.id]).where(
+                dimension.value == operation_type)))
+        else:
+            filters.append(column == operation_type)
+    deleted = batches = 0
+    archives = []
+    with _connect(bind) as conn:
+        if rollup is not None:
+            rollup.create(conn, checkfirst=True)
+        while True:
+            with conn.begin():
+                rows = list(auditor.history(
+                    conn, operation_type=operation_type, until=cutoff,
+                    limit=batch_size, batch_size=batch_size))
+                if not rows:
+                    break
+                first, last = rows[0][id_col.key], rows[-1][id_col.key]
+                if rollup is not None:
+                    _update_rollup(conn, rollup, rows, keys)
+                if archive_dir is not None:
+                    archives.append(_archive(archive_dir, auditor.table, rows,
+                                             id_col.key))
+                if auditor.revisions is not None:
+                    links = auditor.revisions.table
+                    conn.execute(links.delete().where(
+                        links.c.history_id.in_([r[id_col.key]
+                                                for r in rows])))
+                conn.execute(auditor.table.delete().where(and_(
+                    id_col >= first, id_col <= last, *filters)))
+            deleted += len(rows)
+            batches += 1
+            if len(rows) < batch_size:
+                break
+            if pause:
+                time.sleep(pause)
+    return PruneResult(deleted, batches, archives)
@@ -0,0 +1,493 @@
+"""Destinations for audit rows other than the migration's own connection.
+
+By default an :class:`.Auditor` inserts its rows on the connection, and in
+the transaction, of the migration it audits. Given a :class:`Sink`, it hands
+rows to the sink instead and leaves the migration connection alone.
+
+Where no table can be written at migration time (read replicas, locked-down
+schemas, offline mode), a :class:`JsonLinesSink` or :class:`BinaryLogSink`
+appends rows to a local file, and :func:`replay` loads them into the history
+table later.
+"""
+import abc
+import atexit
+import io
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime
+
+from sqlalchemy import types
+from sqlalchemy.sql.expression import BindParameter
+
+from . import exc
+from .compat import ABC
+
+try:
+    import queue
+except ImportError:  # pragma: no cover
+    import Queue as queue
+
+log = logging.getLogger(__name__)
+
+_iso_formats = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S',
+                '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S')
+
+
+def _parse_datetime(value):
+    for fmt in _iso_formats:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise exc.AuditRuntimeError('not a timestamp: %r' % value)
+
+
+def plain_row(table, row):
+    """Return ``row`` with plain Python values only.
+
+    Rows built for an offline (``--sql``) migration may hold literal SQL
+    expressions, such as the timestamp from
+    :meth:`.CommonColumnValues.change_time`; these are replaced by their
+    values. Strings given for ``DateTime`` columns, as read back from a
+    serialized row, are parsed into datetimes, and those given for
+    ``LargeBinary`` columns are encoded back into bytes.
+    """
+    plain = {}
+    for key, val in row.items():
+        if isinstance(val, BindParameter):
+            val = val.value
+        if hasattr(val, 'split'):
+            type_ = table.c[key].type
+            if isinstance(type_, types.DateTime):
+                val = _parse_datetime(val)
+            elif isinstance(type_, types.LargeBinary):
+                # as encoded by _json_default
+                val = val.encode('latin-1')
+        plain[key] = val
+    return plain
+
+
+def _json_default(val):
+    if isinstance(val, datetime):
+        return val.isoformat()
+    if isinstance(val, BindParameter):
+        return val.value
+    if isinstance(val, bytes):
+        return val.decode('latin-1')
+    raise TypeError('cannot serialize %r' % (val,))
+
+
+class Sink(ABC):
+    """Base class for audit row destinations."""
+
+    @abc.abstractmethod
+    def write(self, table, rows):
+        """Accept a list of row dicts destined for ``table``."""
+
+    def flush(self):
+        """Block until rows accepted so far are stored."""
+
+    def close(self):
+        """Flush and release any resources."""
+        self.flush()
+
+
+class ThreadedSink(Sink):
+    """Writes rows to a separate database from a background thread.
+
+    Rows are put on a bounded queue and :meth:`write` returns at once; a
+    daemon thread drains the queue and inserts the rows in batches through
+    ``bind``, which should be an engine distinct from the one migrated. The
+    migration transaction therefore never waits on audit inserts.
+
+    Pending rows are flushed when the process exits normally.
+
+    .. note::
+
+        Rows are handed over when the auditor writes them, which, unless the
+        auditor is :paramref:`~.Auditor.buffered`, is before the migration
+        transaction commits. Use a buffered auditor to send only rows of
+        committed transactions.
+
+    :param bind: an ``Engine`` to write rows with.
+    :param maxsize: the most rows that may wait in the queue.
+    :param policy: what to do with a row when the queue is full:
+
+        * ``block``: wait for room, slowing down the migration.
+        * ``drop_oldest``: discard the oldest queued row. The number of rows
+          discarded is kept in :attr:`dropped`.
+        * ``spill``: append the row to :paramref:`spill_path`; the thread
+          loads spilled rows back once it has caught up.
+    :param spill_path: file used by the ``spill`` policy.
+    :param batch_size: the most rows inserted by one statement.
+    """
+
+    policies = ('block', 'drop_oldest', 'spill')
+
+    def __init__(self, bind, maxsize=1000, policy='block', spill_path=None,
+                 batch_size=500):
+        if policy not in self.policies:
+            raise exc.AuditConstructError('unknown policy %r' % policy)
+        if policy == 'spill' and not spill_path:
+            raise exc.AuditConstructError('spill policy needs a spill_path')
+        self.bind = bind
+        self.policy = policy
+        self.spill_path = spill_path
+        self.batch_size = batch_size
+        self.dropped = 0
+        self.failed = 0
+        self._queue = queue.Queue(maxsize)
+        self._tables = {}
+        self._created = set()
+        self._spill_lock = threading.Lock()
+        # rows spilled by an earlier process are picked up too
+        self._spilled = bool(spill_path) and os.path.exists(spill_path)
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def _start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._work, name='audit-alembic-sink')
+                self._thread.daemon = True
+                self._thread.start()
+                atexit.register(self.close)
+
+    def write(self, table, rows):
+        if self._thread is None:
+            self._start()
+        self._tables.setdefault(table.key, table)
+        for row in rows:
+            self._put((table.key, row))
+
+    def _put(self, item):
+        while True:
+            if self.policy == 'block':
+                return self._queue.put(item)
+            try:
+                return self._queue.put_nowait(item)
+            except queue.Full:
+                if self.policy == 'spill':
+                    return self._spill([item])
+            try:
+                oldest = self._queue.get_nowait()
+            except queue.Empty:  # pragma: no cover
+                continue
+            if isinstance(oldest, tuple):
+                self.dropped += 1
+            else:  # pragma: no cover
+                # never drop a flush marker
+                self._queue.put(oldest)
+
+    def _spill(self, items):
+        with self._spill_lock:
+            with open(self.spill_path, 'a') as f:
+                for key, row in items:
+                    f.write(json.dumps([key, row], default=_json_default))
+                    f.write('\n')
+            self._spilled = True
+
+    def _unspill(self):
+        with self._spill_lock:
+            if not self._spilled:
+                return []
+            try:
+                with open(self.spill_path) as f:
+                    items = [tuple(json.loads(line)) for line in f
+                             if line.strip()]
+                os.remove(self.spill_path)
+            except (IOError, OSError):
+                items = []
+            self._spilled = False
+        # keep rows for tables no auditor has written to in this process
+        unknown = [item for item in items if item[0] not in self._tables]
+        if unknown:
+            self._spill(unknown)
+        return [item for item in items if item[0] in self._tables]
+
+    def _insert(self, items):
+        by_table = {}
+        for key, row in items:
+            by_table.setdefault(key, []).append(row)
+        with self.bind.begin() as conn:
+            for key, rows in by_table.items():
+                table = self._tables[key]
+                if key not in self._created:
+                    table.create(conn, checkfirst=True)
+                    self._created.add(key)
+                rows = [plain_row(table, row) for row in rows]
+                for i in range(0, len(rows), self.batch_size):
+                    conn.execute(table.insert(), rows[i:i + self.batch_size])
+
+    def _store(self, items):
+        if not items:
+            return
+        try:
+            self._insert(items)
+        except Exception:
+            log.exception('audit sink failed to write %d rows', len(items))
+            if self.spill_path:
+                self._spill(items)
+            else:
+                self.failed += len(items)
+
+    def _work(self):
+        stop = False
+        while not stop:
+            items, markers = [], []
+            item = self._queue.get()
+            while True:
+                if item is None:
+                    stop = True
+                elif isinstance(item, tuple):
+                    items.append(item)
+                else:
+                    markers.append(item)
+                if stop or markers or len(items) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            if markers or self._queue.empty():
+                items.extend(self._unspill())
+            self._store(items)
+            for marker in markers:
+                marker.set()
+
+    def flush(self, timeout=None):
+        """Block until every row written so far is stored, dropped, or, if
+        the database could not be reached, spilled to disk.
+
+        :param timeout: give up after this many seconds.
+        :return: whether the flush completed.
+        """
+        if self._thread is None:
+            if not self._spilled:
+                return True
+            self._start()
+        marker = threading.Event()
+        self._queue.put(marker)
+        return marker.wait(timeout)
+
+    def close(self, timeout=None):
+        """Flush, then stop the background thread."""
+        if self._thread is None:
+            return
+        self.flush(timeout)
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self._thread = None
+
+
+class LogSink(Sink):
+    """Base class for sinks appending rows to a local file.
+
+    Each :meth:`write` is a single append to the file, handed to the
+    operating system at once; :func:`os.fsync` is called once enough rows
+    or time have gone by since the last one, and on :meth:`flush`.
+
+    :param path: the log file, created if needed and appended to.
+    :param fsync_rows: sync after this many rows.
+    :param fsync_seconds: sync once this many seconds have passed since the
+        last sync, at the next write.
+
+    If both are None, the file is only synced by :meth:`flush` and
+    :meth:`close`.
+    """
+
+    def __init__(self, path, fsync_rows=100, fsync_seconds=1.0):
+        self.path = path
+        self.fsync_rows = fsync_rows
+        self.fsync_seconds = fsync_seconds
+        self._lock = threading.Lock()
+        self._file = None
+        self._unsynced = 0
+        self._synced_at = None
+
+    def _open(self):
+        new = not os.path.exists(self.path) or not os.path.getsize(self.path)
+        self._file = io.open(self.path, 'ab')
+        if new:
+            self._file.write(self.header)
+        self._synced_at = time.time()
+        atexit.register(self.close)
+
+    @abc.abstractmethod
+    def _encode(self, key, rows):
+        """The bytes appended to the file for ``rows`` of the table keyed
+        ``key``."""
+
+    def write(self, table, rows):
+        data = self._encode(table.key, rows)
+        with self._lock:
+            if self._file is None:
+                self._open()
+            self._file.write(data)
+            self._file.flush()
+            self._unsynced += len(rows)
+            if ((self.fsync_rows and self._unsynced >= self.fsync_rows) or
+                    (self.fsync_seconds is not None and
+                     time.time() - self._synced_at >= self.fsync_seconds)):
+                self._sync()
+
+    def _sync(self):
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._synced_at = time.time()
+
+    def flush(self):
+        """Sync the file to disk."""
+        with self._lock:
+            if self._file is not None and self._unsynced:
+                self._sync()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                if self._unsynced:
+                    self._sync()
+                self._file.close()
+                self._file = None
+
+
+class JsonLinesSink(LogSink):
+    """Appends rows to a text file, one JSON ``[table, row]`` array per line
+    (the format of :paramref:`ThreadedSink.spill_path`).
+
+    See :class:`LogSink` for the parameters.
+    """
+
+    header = b''
+
+    def _encode(self, key, rows):
+        return ''.join(
+            json.dumps([key, row], default=_json_default) + '\n'
+            for row in rows).encode('utf-8')
+
+
+_binary_magic = b'AALOG1\n'
+_frame = struct.Struct('>II')
+
+
+class BinaryLogSink(LogSink):
+    """Appends rows to a binary file in compact frames, one per
+    :meth:`write`.
+
+    The file begins with ``AALOG1\\n``. Each frame is a big-endian 32-bit
+    length and CRC-32 of its payload, then the payload: a zlib-compressed
+    JSON array of ``[table, row]`` arrays. A frame cut short by a crash is
+    detected and ignored by :func:`replay`.
+
+    See :class:`LogSink` for the parameters.
+    """
+
+    header = _binary_magic
+
+    def _encode(self, key, rows):
+        payload = zlib.compress(json.dumps(
+            [[key, row] for row in rows],
+            default=_json_default).encode('utf-8'))
+        return _frame.pack(len(payload),
+                           zlib.crc32(payload) & 0xffffffff) + payload
+
+
+def read_log(path):
+    """Iterate over the ``(table key, row)`` pairs of a log written by
+    :class:`JsonLinesSink` or :class:`BinaryLogSink`. A record cut short at
+    the end of the file is skipped; one damaged elsewhere raises
+    :class:`.AuditRuntimeError`."""
+    with io.open(path, 'rb') as f:
+        if f.read(len(_binary_magic)) == _binary_magic:
+            records = _read_binary(f, path)
+        else:
+            f.seek(0)
+            records = _read_lines(f, path)
+        for record in records:
+            yield record
+
+
+def _read_lines(f, path):
+    for i, line in enumerate(f):
+        if not line.strip():
+            continue
+        try:
+            key, row = json.loads(line.decode('utf-8'))
+        except ValueError:
+            if not line.endswith(b'\n'):
+                log.warning('%s: ignoring incomplete last line', path)
+                return
+            raise exc.AuditRuntimeError('%s: bad record on line %d'
+                                        % (path, i + 1))
+        yield key, row
+
+
+def _read_binary(f, path):
+    while True:
+        head = f.read(_frame.size)
+        if not head:
+            return
+        payload = b''
+        if len(head) == _frame.size:
+            size, crc = _frame.unpack(head)
+            payload = f.read(size)
+        if len(head) < _frame.size or len(payload) < size:
+            log.warning('%s: ignoring incomplete last frame', path)
+            return
+        if zlib.crc32(payload) & 0xffffffff != crc:
+            raise exc.AuditRuntimeError('%s: bad frame checksum' % path)
+        for key, row in json.loads(zlib.decompress(payload).decode('utf-8')):
+            yield key, row
+
+
+def replay(path, bind, tables, batch_size=1000, remove=False):
+    """Bulk-load a log written by :class:`JsonLinesSink` or
+    :class:`BinaryLogSink` into its tables, which are created if needed.
+
+    Rows are inserted in one transaction; loading the same log twice inserts
+    its rows twice, so pass ``remove`` or move the log aside once loaded.
+
+    :param path: the log file.
+    :param bind: an ``Engine`` to load the rows with.
+    :param tables: an :class:`.Auditor`, a ``Table``, or a list of either,
+        whose tables the logged rows belong to.
+    :param batch_size: the most rows inserted by one statement.
+    :param remove: delete the log once loaded.
+    :return: the number of rows loaded.
+    :raise .AuditRuntimeError: if a row belongs to none of ``tables``.
+    """
+    if not isinstance(tables, (list, tuple)):
+        tables = [tables]
+    by_key = dict((t.key, t) for t in (getattr(t, 'table', t)
+                                       for t in tables))
+    pending = {}
+    count = 0
+    with bind.begin() as conn:
+        def insert(key):
+            table = by_key[key]
+            if key not in created:
+                table.create(conn, checkfirst=True)
+                created.add(key)
+            conn.execute(table.insert(), pending.pop(key))
+
+        created = set()
+        for key, row in read_log(path):
+            if key not in by_key:
+                raise exc.AuditRuntimeError('%s: row for unknown table %s'
+                                            % (path, key))
+            batch = pending.setdefault(key, [])
+            batch.append(plain_row(by_key[key], row))
+            count += 1
+            if len(batch) >= batch_size:
+                insert(key)
+        for key in list(pending):
+            insert(key)
+    if remove:
+        os.remove(path)
+    return count
@@ -0,0 +1,187 @@
+"""Checking a history table against the revision graph.
+
+:meth:`.Auditor.verify` replays the rows of a history table, in order of id,
+over the revision graph of a ``ScriptDirectory``, keeping track of the heads
+the database should be at. Each row is checked against those heads and the
+graph, and any inconsistency is reported as an :class:`Issue`:
+
+``unknown_revision``
+    the row names a revision not in the graph.
+``illegal_transition``
+    a migration step that is not an edge of the graph, e.g. an upgrade to a
+    revision from something other than its down revisions.
+``gap``
+    the row starts further along the graph than the previous rows left the
+    database, as if steps had not been recorded.
+``out_of_band``
+    the row starts somewhere the previous rows cannot explain, or applies a
+    revision the database already had: the database was changed without
+    auditing, e.g. by hand or by restoring a backup.
+``clock_regression``
+    the row was changed at an earlier time than the row before it.
+
+After an issue, checking carries on from where the row left the database.
+Rows are read in batches, so memory use depends on the size of the revision graph,
+not of the history.
+
+The ``audit-alembic verify`` command does the same from the command line.
+"""
+import collections
+
+Issue = collections.namedtuple('Issue', 'id kind message')
+Issue.__doc__ = """An inconsistency found by :meth:`.Auditor.verify` in the
+history row with id ``id``; ``kind`` is one of those listed in
+:mod:`audit_alembic.verify`."""
+
+
+class RevisionGraph(object):
+    """The revisions of a ``ScriptDirectory`` and their down revisions,
+    including dependencies, read once and kept in memory.
+
+    :param script: a ``ScriptDirectory``.
+    :param cache_size: the most ancestry lookups remembered.
+    """
+
+    def __init__(self, script, cache_size=10000):
+        get_revisions = script.revision_map.get_revisions
+        self.down = {}
+        for sc in script.walk_revisions():
+            # as alembic reports steps, dependencies count as down revisions
+            self.down[sc.revision] = tuple(
+                r.revision for r in get_revisions(sc.down_revision) +
+                get_revisions(sc.dependencies))
+        self.cache_size = cache_size
+        self._ancestry = {}
+
+    def __contains__(self, revision):
+        return revision in self.down
+
+    def is_ancestor(self, ancestor, revision):
+        """Whether ``ancestor`` is a strict ancestor of ``revision``."""
+        key = (ancestor, revision)
+        found = self._ancestry.get(key)
+        if found is None:
+            found = False
+            seen = set()
+            todo = list(self.down.get(revision, ()))
+            while todo:
+                rev = todo.pop()
+                if rev == ancestor:
+                    found = True
+                    break
+                if rev not in seen:
+                    seen.add(rev)
+                    todo.extend(self.down.get(rev, ()))
+            if len(self._ancestry) >= self.cache_size:
+                self._ancestry.clear()
+            self._ancestry[key] = found
+        return found
+
+
+class Verification(object):
+    """Iterates over the issues of a history, as :class:`Issue` tuples.
+
+    :param rows: history rows, as dicts, in order of id.
+    :param graph: a :class:`RevisionGraph`.
+    :param keys: a dict of role to the key of each row holding it; see
+        :paramref:`~.Auditor.roles`.
+    :param separator: the delimiter of several revisions in a version.
+
+    Once iterated over, :attr:`rows` and :attr:`issues` count the rows
+    checked and the issues found.
+    """
+
+    def __init__(self, rows, graph, keys, separator='##'):
+        self._rows = rows
+        self.graph = graph
+        self.keys = keys
+        self.separator = separator
+        self.rows = 0
+        self.issues = 0
+
+    def _revisions(self, row, role):
+        value = row.get(self.keys[role])
+        return tuple(value.split(self.separator)) if value else ()
+
+    def _normalize(self, heads):
+        """Drop heads that are ancestors of other heads."""
+        if len(heads) < 2:
+            return heads
+        return set(h for h in heads
+                   if not any(self.graph.is_ancestor(h, other)
+                              for other in heads if other != h))
+
+    def _continuity(self, heads, sources, upgrade):
+        """The kind of issue with ``sources`` given ``heads``, if any."""
+        for source in sources:
+            if source in heads:
+                continue
+            if any(self.graph.is_ancestor(source, h) for h in heads):
+                if upgrade:
+                    # a new branch, from behind a head
+                    continue
+                return 'gap'
+            if upgrade and any(self.graph.is_ancestor(h, source)
+                               for h in heads):
+                return 'gap'
+            return 'out_of_band'
+
+    def _check(self, heads, row):
+        graph = self.graph
+        sources = self._revisions(row, 'prev_alembic_version')
+        dests = self._revisions(row, 'alembic_version')
+        upgrade = row[self.keys['operation_direction']] == 'up'
+        migration = row[self.keys['operation_type']] == 'migration'
+        unknown = [r for r in sources + dests if r not in graph]
+        if unknown:
+            yield 'unknown_revision', 'unknown revision(s) %s' % ', '.join(
+                unknown)
+            return
+        if migration:
+            revision, down = (dests, sources) if upgrade else (sources, dests)
+            if len(revision) != 1 or \
+                    set(graph.down[revision[0]]) != set(down):
+                yield 'illegal_transition', '%s from %s to %s is not a step ' \
+                    'of the revision graph' % (
+                        'upgrade' if upgrade else 'downgrade',
+                        ', '.join(sources) or 'base',
+                        ', '.join(dests) or 'base')
+                return
+        if heads is None:
+            # the first row tells where the database was
+            return
+        kind = self._continuity(heads, sources, upgrade)
+        if kind is None and upgrade and migration and any(
+                dests[0] == h or graph.is_ancestor(dests[0], h)
+                for h in heads):
+            yield 'out_of_band', '%s was already applied' % dests[0]
+        elif kind is not None:
+            yield kind, 'starts from %s, but the database was at %s' % (
+                ', '.join(sources) or 'base',
+                ', '.join(sorted(heads)) or 'base')
+
+    def __iter__(self):
+        heads = None
+        last_changed = None
+        changed_key = self.keys.get('changed_at')
+        for row in self._rows:
+            self.rows += 1
+            row_id = row[self.keys['id']]
+            issues = list(self._check(heads, row))
+            changed = row.get(changed_key) if changed_key else None
+            if changed is not None:
+                if last_changed is not None and changed < last_changed:
+                    issues.append(('clock_regression',
+                                   'changed at %s, before the previous row '
+                                   '(%s)' % (changed, last_changed)))
+                last_changed = changed
+            for kind, message in issues:
+                self.issues += 1
+                yield Issue(row_id, kind, message)
+            sources = self._revisions(row, 'prev_alembic_version')
+            dests = self._revisions(row, 'alembic_version')
+            if heads is None or any(kind != 'clock_regression'
+                                    for kind, _ in issues):
+                # start over from what the row tells
+                heads = set(sources)
+            heads = self._normalize((heads - set(sources)) | set(dests))
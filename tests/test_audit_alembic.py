@@ -1,10 +1,21 @@
+import contextlib
+import csv
 import functools
+import gc
+import itertools
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
 from datetime import datetime
 from datetime import timedelta
 
 import pytest
 from alembic import command as alcommand
 from alembic import util
+from alembic.runtime.migration import MigrationContext
 from alembic.testing.env import _get_staging_directory
 from alembic.testing.env import _testing_config
 from alembic.testing.env import _write_config_file
@@ -13,6 +24,8 @@
 from sqlalchemy import Column
 from sqlalchemy import MetaData
 from sqlalchemy import Table
+from sqlalchemy import create_engine
+from sqlalchemy import event
 from sqlalchemy import inspect
 from sqlalchemy import types
 from sqlalchemy.sql import select
@@ -22,7 +35,18 @@
 from sqlalchemy.testing.util import drop_all_tables
 
 import audit_alembic
+from audit_alembic import cache
+from audit_alembic import cli
+from audit_alembic import drift
 from audit_alembic import exc
+from audit_alembic import export
+from audit_alembic import fleet
+from audit_alembic import metrics
+from audit_alembic import predict
+from audit_alembic import profiling
+from audit_alembic import retention
+from audit_alembic import sinks
+from audit_alembic import verify
 
 test_col_name = 'custom_data'
 
@@ -36,23 +60,34 @@
     raise audit_alembic.exc.AuditSetupError(
         'Alembic version %r not supported' % al_version)
 
-listen = audit_alembic.test_auditor.listen
+auditor = audit_alembic.test_auditor
+listen = auditor.listen
+options = audit_alembic.test_env_options or {}
+
+def run_migrations():
+    if options.get('run'):
+        with auditor.run():
+            context.run_migrations()
+    else:
+        context.run_migrations()
 
 def run_migrations_offline():
     url = config.get_main_option('sqlalchemy.url')
     context.configure(url=url, target_metadata=None,
-                      literal_binds=True, on_version_apply=listen)
+                      literal_binds=True, on_version_apply=listen,
+                      **options.get('configure', {}))
     with context.begin_transaction():
-        context.run_migrations()
+        run_migrations()
 
 def run_migrations_online():
     connectable = audit_alembic.test_version.engine
 
     with connectable.connect() as connection:
         context.configure(connection=connection, target_metadata=None,
-                          on_version_apply=listen)
+                          on_version_apply=listen,
+                          **options.get('configure', {}))
         with context.begin_transaction():
-            context.run_migrations()
+            run_migrations()
 
 if context.is_offline_mode():
     run_migrations_offline()
@@ -219,7 +254,8 @@ def version(request):
     The Auditor can be accessed via ``audit_alembic.test_auditor``
     """
     audit_alembic.test_auditor = audit_alembic.test_version \
-        = audit_alembic.test_custom_data = None
+        = audit_alembic.test_custom_data = audit_alembic.test_env_options \
+        = None
 
     vers = _Versioner(':'.join((request.module.__name__, request.cls.__name__,
                                 request.function.__name__)))
@@ -288,6 +324,23 @@ def _history():
     return sqla_test_config.db.execute(q).fetchall()
 
 
+@contextlib.contextmanager
+def _statements(engine, prefix):
+    """Collect the SQL statements beginning with ``prefix`` that are executed
+    on ``engine`` while the block is open."""
+    found = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        if statement.lower().startswith(prefix.lower()):
+            found.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield found
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
 class TestAuditTable(TestBase):
     __backend__ = True
     history = staticmethod(_history)
@@ -447,6 +500,1661 @@ def has_create(l):
         ))) is not None, 'insert statement not found'
 
 
+class TestBuffered(TestBase):
+    __backend__ = True
+    history = staticmethod(_history)
+    insert = 'insert into alembic_version_history'
+
+    def _auditor(self, version, **kw):
+        return audit_alembic.Auditor.create(
+            version.version,
+            extra_columns=[(Column(test_col_name, types.String(32)), None)],
+            **kw)
+
+    def test_one_insert_per_run(self, env, version, cmd):
+        with mock.patch('audit_alembic.test_auditor',
+                        self._auditor(version, buffered=True)), \
+                mock.patch('audit_alembic.test_env_options', {'run': True}), \
+                _statements(version.engine, self.insert) as inserts:
+            cmd.upgrade(env.R.D)
+        assert len(inserts) == 1
+        assert [h[:2] for h in self.history()] == [
+            (env.R.A, ''),
+            (env.R.B, env.R.A),
+            (env.R.C, env.R.B),
+            (env.R.D, env.R.C),
+        ]
+
+    def test_row_threshold(self, env, version, cmd):
+        with mock.patch('audit_alembic.test_auditor',
+                        self._auditor(version, flush_rows=3)), \
+                mock.patch('audit_alembic.test_env_options', {'run': True}), \
+                _statements(version.engine, self.insert) as inserts:
+            cmd.upgrade(env.R.E)
+        assert len(inserts) == 2
+        assert len(self.history()) == 5
+
+    def test_byte_threshold(self, env, version, cmd):
+        with mock.patch('audit_alembic.test_auditor',
+                        self._auditor(version, flush_bytes=1)), \
+                mock.patch('audit_alembic.test_env_options', {'run': True}), \
+                _statements(version.engine, self.insert) as inserts:
+            cmd.upgrade(env.R.B)
+        assert len(inserts) == 2
+
+    def test_no_run_no_transaction(self, env, version, cmd):
+        options = {'configure': {'transactional_ddl': False}}
+        with mock.patch('audit_alembic.test_auditor',
+                        self._auditor(version, buffered=True)), \
+                mock.patch('audit_alembic.test_env_options', options):
+            cmd.upgrade(env.R.C)
+        assert len(self.history()) == 3
+
+    def test_flush_at_commit(self, env, version, cmd):
+        options = {'configure': {'transactional_ddl': True,
+                                 'transaction_per_migration': True}}
+        with mock.patch('audit_alembic.test_auditor',
+                        self._auditor(version, buffered=True)), \
+                mock.patch('audit_alembic.test_env_options', options), \
+                _statements(version.engine, self.insert) as inserts:
+            cmd.upgrade(env.R.C)
+        assert len(inserts) == 3
+        assert len(self.history()) == 3
+
+    def test_failed_run_discards_rows(self, env, version, cmd):
+        def fail_at_b(step=None, **kw):
+            if step.up_revision_id == env.R.B:
+                raise RuntimeError('boom')
+
+        auditor = audit_alembic.Auditor.create(
+            version.version, buffered=True,
+            extra_columns=[(Column(test_col_name, types.String(32)),
+                            fail_at_b)])
+        options = {'run': True, 'configure': {'transactional_ddl': True}}
+        with mock.patch('audit_alembic.test_auditor', auditor), \
+                mock.patch('audit_alembic.test_env_options', options), \
+                pytest.raises(RuntimeError):
+            cmd.upgrade(env.R.C)
+        assert auditor.table.name not in inspect(version.engine).get_table_names()
+
+
+class TestDuration(TestBase):
+    __backend__ = True
+
+    def _durations(self, env, version, cmd, options):
+        auditor = audit_alembic.Auditor.create(
+            version.version, duration_column_name='duration')
+        clock = itertools.count()
+        with mock.patch('audit_alembic.test_auditor', auditor), \
+                mock.patch('audit_alembic.test_env_options', options), \
+                mock.patch('audit_alembic.base._clock',
+                           lambda: float(next(clock))):
+            cmd.upgrade(env.R.C)
+        q = select([auditor.table.c.duration]).order_by(auditor.table.c.id)
+        return [r[0] for r in version.engine.execute(q)]
+
+    def test_duration_with_run(self, env, version, cmd):
+        assert self._durations(env, version, cmd, {'run': True}) == [1, 1, 1]
+
+    def test_duration_without_run(self, env, version, cmd):
+        assert self._durations(env, version, cmd, {}) == [None, 1, 1]
+
+    @pytest.mark.parametrize('buffered', [False, True])
+    def test_writes_not_timed(self, env, version, cmd, buffered):
+        # each step takes a second, each write of history rows ten
+        auditor = audit_alembic.Auditor.create(
+            version.version, duration_column_name='duration',
+            buffered=buffered)
+        now = [0.0]
+        write = auditor._write_rows
+
+        def slow_write(run, rows):
+            now[0] += 10
+            write(run, rows)
+
+        def step(conn, cursor, statement, *args):
+            if statement.startswith(('INSERT INTO alembic_version ',
+                                     'UPDATE alembic_version ')):
+                now[0] += 1
+
+        options = {'run': True,
+                   'configure': {'transactional_ddl': True,
+                                 'transaction_per_migration': True}}
+        event.listen(version.engine, 'before_cursor_execute', step)
+        try:
+            with mock.patch('audit_alembic.test_auditor', auditor), \
+                    mock.patch('audit_alembic.test_env_options', options), \
+                    mock.patch.object(auditor, '_write_rows', slow_write), \
+                    mock.patch('audit_alembic.base._clock', lambda: now[0]):
+                cmd.upgrade(env.R.C)
+        finally:
+            event.remove(version.engine, 'before_cursor_execute', step)
+        q = select([auditor.table.c.duration]).order_by(auditor.table.c.id)
+        assert [r[0] for r in version.engine.execute(q)] == [1, 1, 1]
+
+    def test_step_metric_in_make_row(self, env, version, cmd):
+        table = Table('custom_alembic_history', MetaData(),
+                      Column('id', types.Integer, primary_key=True),
+                      Column('took', types.Float))
+        auditor = audit_alembic.Auditor(
+            table, {'took': audit_alembic.StepMetric('duration')})
+        with mock.patch('audit_alembic.test_auditor', auditor), \
+                mock.patch('audit_alembic.test_env_options', {'run': True}):
+            cmd.upgrade(env.R.B)
+        durations = version.engine.execute(select([table.c.took])).fetchall()
+        assert len(durations) == 2
+        assert all(d[0] >= 0 for d in durations)
+
+
+class TestInstrumentSql(TestBase):
+    __backend__ = True
+
+    def _stats(self, env, version, cmd, **kw):
+        auditor = audit_alembic.Auditor.create(version.version,
+                                               instrument_sql=True, **kw)
+        with mock.patch('audit_alembic.test_auditor', auditor), \
+                mock.patch('audit_alembic.test_env_options', {'run': True}):
+            cmd.upgrade(env.R.C)
+        table = auditor.table
+        q = select([table.c.sql_statements, table.c.sql_rows,
+                    table.c.sql_time]).order_by(table.c.id)
+        return version.engine.execute(q).fetchall()
+
+    def test_counts_exclude_audit_writes(self, env, version, cmd):
+        stats = self._stats(env, version, cmd)
+        # past the first step, each step only updates alembic_version
+        assert [s[:2] for s in stats[1:]] == [(1, 1), (1, 1)]
+        assert stats[0][0] > 1
+        assert all(s[2] >= 0 for s in stats)
+
+    def test_counts_buffered(self, env, version, cmd):
+        stats = self._stats(env, version, cmd, buffered=True)
+        assert [s[:2] for s in stats[1:]] == [(1, 1), (1, 1)]
+
+    def test_implicit_runs_detach(self):
+        auditor = audit_alembic.Auditor.create('v', instrument_sql=True,
+                                               buffered=True)
+        with create_engine('sqlite://').connect() as conn:
+            for i in range(3):
+                ctx = MigrationContext.configure(conn)
+                with conn.begin():
+                    auditor.listen(ctx=ctx, heads=(), run_args={},
+                                   step=_Step(str(i), str(i + 1), False))
+                    assert len(conn.dispatch.commit) == 1
+                    assert len(conn.dispatch.before_cursor_execute) == 1
+                del ctx
+                gc.collect()
+            assert len(conn.dispatch.commit) == 0
+            assert len(conn.dispatch.before_cursor_execute) == 0
+            assert len(list(auditor.history(conn))) == 3
+
+
+class TestProfiling(TestBase):
+    __backend__ = True
+
+    def _profiles(self, env, version, cmd, profiler, options={'run': True}):
+        auditor = audit_alembic.Auditor.create(version.version,
+                                               profiler=profiler)
+        with mock.patch('audit_alembic.test_auditor', auditor), \
+                mock.patch('audit_alembic.test_env_options', options):
+            cmd.upgrade(env.R.B)
+        table = auditor.table
+        cols = [table.c.alembic_version]
+        cols += [c for c in (table.c.get('profile'),
+                             table.c.get('peak_memory')) if c is not None]
+        q = select(cols).order_by(table.c.id)
+        return version.engine.execute(q).fetchall()
+
+    def test_compact_profile(self, env, version, cmd):
+        rows = self._profiles(env, version, cmd, profiling.StepProfiler(
+            memory=True, top=5))
+        assert len(rows) == 2
+        for _, profile, peak in rows:
+            hot = profiling.load_profile(profile)
+            assert 0 < len(hot) <= 5
+            assert all(len(h) == 4 for h in hot)
+            assert peak > 0
+
+    def test_profile_files(self, env, version, cmd, tmpdir):
+        rows = self._profiles(env, version, cmd, profiling.StepProfiler(
+            directory=str(tmpdir)))
+        assert sorted(os.listdir(str(tmpdir))) == sorted(r[1] for r in rows)
+        for rev, name in rows:
+            assert name.startswith(rev)
+
+    def test_not_sampled(self, env, version, cmd):
+        rows = self._profiles(env, version, cmd, profiling.StepProfiler(
+            memory=True, sample_rate=0))
+        assert [r[1:] for r in rows] == [(None, None), (None, None)]
+
+    def test_implicit_run_not_profiled(self, env, version, cmd):
+        rows = self._profiles(env, version, cmd, profiling.StepProfiler(),
+                              options={})
+        assert [r[1] for r in rows] == [None, None]
+
+
+class TestMemoize(TestBase):
+    __backend__ = True
+
+    def _calls(self, env, version, cmd, revs, scope=None):
+        calls = []
+
+        def value(step=None, **kw):
+            calls.append(step)
+            return 'v%d' % len(calls)
+
+        extra = [(Column('c0', types.String(32)), value, scope)]
+        auditor = audit_alembic.Auditor.create(
+            value, user_version_scope=scope, extra_columns=extra)
+        with mock.patch('audit_alembic.test_auditor', auditor):
+            for rev in revs:
+                cmd.upgrade(rev)
+        q = select([auditor.table.c.user_version]).order_by(
+            auditor.table.c.id)
+        return calls, [r[0] for r in version.engine.execute(q)]
+
+    def test_run_scope(self, env, version, cmd):
+        calls, versions = self._calls(env, version, cmd, [env.R.C, env.R.D],
+                                      'run')
+        assert len(calls) == 4  # user_version and c0, for each of 2 runs
+        assert versions == ['v1', 'v1', 'v1', 'v3']
+
+    def test_process_scope(self, env, version, cmd):
+        calls, versions = self._calls(env, version, cmd, [env.R.C, env.R.D],
+                                      'process')
+        assert len(calls) == 2
+        assert set(versions) == set(['v1'])
+
+    def test_step_scope(self, env, version, cmd):
+        calls = []
+
+        def value(step=None, **kw):
+            calls.append(step)
+            return 'v%d' % len(calls)
+
+        shared = audit_alembic.memoize(value, 'step')
+        auditor = audit_alembic.Auditor.create(
+            shared, extra_columns=[(Column('c%d' % i, types.String(32)),
+                                    shared) for i in range(3)])
+        with mock.patch('audit_alembic.test_auditor', auditor):
+            cmd.upgrade(env.R.C)
+        table = auditor.table
+        q = select([table.c.user_version, table.c.c0, table.c.c1,
+                    table.c.c2]).order_by(table.c.id)
+        assert version.engine.execute(q).fetchall() == [
+            ('v1',) * 4, ('v2',) * 4, ('v3',) * 4]
+        assert len(calls) == 3
+
+    def test_ttl_scope(self):
+        clock = iter([0, 1, 5, 6, 100])
+        with mock.patch('audit_alembic.base._clock', lambda: next(clock)):
+            memo = audit_alembic.memoize(lambda **kw: next(values), 5)
+            values = iter(['a', 'b', 'c'])
+            assert [memo() for _ in range(5)] == ['a', 'a', 'b', 'b', 'c']
+
+    def test_rewrapped(self):
+        calls = []
+
+        def value(**kw):
+            calls.append(kw)
+            return len(calls)
+
+        inner = audit_alembic.memoize(value, 'step')
+        outer = audit_alembic.memoize(inner, 'process')
+        assert (outer.scope, outer.fn, outer.__name__) == (
+            'process', value, 'value')
+        assert outer._lock is not inner._lock
+        assert [outer(ctx=object(), step=object()) for _ in range(3)] == \
+            [1, 1, 1]
+
+    def test_not_held_while_computing(self):
+        import threading
+        started, release = threading.Event(), threading.Event()
+
+        def slow(**kw):
+            started.set()
+            release.wait(5)
+            return 'slow'
+
+        memo = audit_alembic.memoize(slow, 'run')
+        ctx, other = mock.Mock(), mock.Mock()
+        found = []
+        thread = threading.Thread(target=memo, kwargs={'ctx': ctx})
+        thread.start()
+        try:
+            assert started.wait(5)
+            memo.fn = lambda **kw: 'fast'
+            fast = threading.Thread(
+                target=lambda: found.append(memo(ctx=other)))
+            fast.start()
+            fast.join(2)
+            assert found == ['fast']
+        finally:
+            release.set()
+            thread.join()
+        assert memo(ctx=ctx) == 'slow'
+
+    def test_no_scope(self, env, version, cmd):
+        calls, _ = self._calls(env, version, cmd, [env.R.C])
+        assert len(calls) == 6
+
+
+class TestTableCache(TestBase):
+    __backend__ = True
+
+    @pytest.fixture(autouse=True)
+    def persistent(self, version, tmpdir):
+        # in-memory databases are never cached: migrate a file instead
+        if cache._persistent_key(version.engine.url) is not None:
+            yield
+            return
+        saved = version.engine, version.conn
+        version.engine = create_engine('sqlite:///%s' % tmpdir.join('c.db'))
+        version.conn = version.engine.connect()
+        yield
+        version.conn.close()
+        version.engine.dispose()
+        version.engine, version.conn = saved
+
+    def _auditor(self, version, table_cache, *extra):
+        return audit_alembic.Auditor.create(
+            version.version, table_cache=table_cache,
+            extra_columns=[(Column(test_col_name, types.String(32)), None)] +
+            [(col, None) for col in extra])
+
+    def _run(self, env, version, cmd, auditor, rev):
+        # every statement naming the table, bar the inserts, is a check
+        with mock.patch('audit_alembic.test_auditor', auditor), \
+                _statements(version.engine, '') as statements:
+            cmd.upgrade(rev)
+        return [s for s in statements if auditor.table.name in s and
+                not s.lower().startswith('insert')]
+
+    def test_memory_cache_skips_check(self, env, version, cmd):
+        table_cache = cache.MemoryTableCache()
+        first = self._run(env, version, cmd,
+                          self._auditor(version, table_cache), env.R.A)
+        assert first
+        second = self._run(env, version, cmd,
+                           self._auditor(version, table_cache), env.R.B)
+        assert not second
+
+    def test_file_cache_persists(self, env, version, cmd, tmpdir):
+        path = str(tmpdir.join('tables.json'))
+        self._run(env, version, cmd,
+                  self._auditor(version, cache.FileTableCache(path)), env.R.A)
+        assert not self._run(
+            env, version, cmd,
+            self._auditor(version, cache.FileTableCache(path)), env.R.B)
+
+    def test_fingerprint_change_invalidates(self, env, version, cmd, tmpdir):
+        table_cache = cache.FileTableCache(str(tmpdir.join('tables.json')))
+        self._run(env, version, cmd, self._auditor(version, table_cache),
+                  env.R.A)
+        version.conn.execute('DROP TABLE alembic_version_history')
+        # a new column means a new table definition, so the entry is stale
+        auditor = self._auditor(version, table_cache,
+                                Column('extra', types.Integer))
+        assert self._run(env, version, cmd, auditor, env.R.B)
+        assert table_cache.known(version.conn, auditor.table)
+        assert not table_cache.known(
+            version.conn, self._auditor(version, table_cache).table)
+
+    def test_keys(self, tmpdir, monkeypatch):
+        table_cache = cache.MemoryTableCache()
+        table = audit_alembic.Auditor.create('v').table
+
+        def key(url):
+            return table_cache.key(mock.Mock(engine=create_engine(url)), table)
+
+        for url in ('sqlite://', 'sqlite:///:memory:',
+                    'sqlite:///file::memory:?cache=shared&uri=true'):
+            assert key(url) is None
+        monkeypatch.chdir(str(tmpdir))
+        assert key('sqlite:///h.db') == key('sqlite:///%s' % tmpdir.join(
+            'h.db'))
+        conn = create_engine('sqlite://').connect()
+        table_cache.add(conn, table)
+        assert not table_cache.known(conn, table)
+        assert not table_cache._entries
+
+    def test_abstract(self):
+        with pytest.raises(TypeError):
+            cache.TableCache()
+
+
+class TestThreadedSink(TestBase):
+    def _rows(self, n):
+        return [{'alembic_version': str(i), 'operation_type': 'migration',
+                 'operation_direction': 'up',
+                 'changed_at': datetime(2017, 6, 21, 12, i)}
+                for i in range(n)]
+
+    def _stored(self, engine, table):
+        q = select([table.c.alembic_version, table.c.changed_at]).order_by(
+            table.c.id)
+        return engine.execute(q).fetchall()
+
+    def test_rows_go_to_sink(self, env, version, cmd, tmpdir):
+        engine = create_engine('sqlite:///%s' % tmpdir.join('audit.db'))
+        sink = sinks.ThreadedSink(engine)
+        auditor = audit_alembic.Auditor.create(version.version, sink=sink)
+        with mock.patch('audit_alembic.test_auditor', auditor):
+            cmd.upgrade(env.R.C)
+        sink.close()
+        assert [r[0] for r in self._stored(engine, auditor.table)] == [
+            env.R.A, env.R.B, env.R.C]
+        assert auditor.table.name not in inspect(version.engine) \
+            .get_table_names()
+
+    def test_drop_oldest(self, tmpdir):
+        engine = create_engine('sqlite:///%s' % tmpdir.join('audit.db'))
+        sink = sinks.ThreadedSink(engine, maxsize=2, policy='drop_oldest')
+        table = audit_alembic.Auditor.create('a').table
+        with mock.patch.object(sink, '_start'):
+            sink.write(table, self._rows(5))
+        assert sink.dropped == 3
+        sink._start()
+        sink.close()
+        assert [r[0] for r in self._stored(engine, table)] == ['3', '4']
+
+    def test_spill(self, tmpdir):
+        engine = create_engine('sqlite:///%s' % tmpdir.join('audit.db'))
+        spill = tmpdir.join('spill.jsonl')
+        sink = sinks.ThreadedSink(engine, maxsize=1, policy='spill',
+                                  spill_path=str(spill))
+        table = audit_alembic.Auditor.create('a').table
+        with mock.patch.object(sink, '_start'):
+            sink.write(table, self._rows(3))
+        assert len(spill.readlines()) == 2
+        sink._start()
+        sink.close()
+        assert self._stored(engine, table) == [
+            (r['alembic_version'], r['changed_at']) for r in self._rows(3)]
+        assert not spill.check()
+
+    def test_spill_when_unreachable(self, tmpdir):
+        spill = tmpdir.join('spill.jsonl')
+        engine = create_engine('sqlite:///%s' % tmpdir.join('no', 'such.db'))
+        sink = sinks.ThreadedSink(engine, policy='spill',
+                                  spill_path=str(spill))
+        table = audit_alembic.Auditor.create('a').table
+        sink.write(table, self._rows(2))
+        sink.close()
+        assert len(spill.readlines()) == 2
+
+
+class TestLogSinks(TestBase):
+    @pytest.fixture(params=['jsonl', 'binary'])
+    def make_sink(self, request, tmpdir):
+        cls = {'jsonl': sinks.JsonLinesSink,
+               'binary': sinks.BinaryLogSink}[request.param]
+        path = str(tmpdir.join('audit.log'))
+        return lambda **kw: cls(path, **kw)
+
+    def test_abstract(self, tmpdir):
+        with pytest.raises(TypeError):
+            sinks.Sink()
+        with pytest.raises(TypeError):
+            sinks.LogSink(str(tmpdir.join('audit.log')))
+
+    def _replayed(self, sink, auditor, tmpdir, **kw):
+        engine = create_engine('sqlite:///%s' % tmpdir.join('replay.db'))
+        assert sinks.replay(sink.path, engine, auditor, batch_size=2,
+                            **kw) == 3
+        return list(auditor.history(engine))
+
+    def test_online(self, env, version, cmd, tmpdir, make_sink):
+        sink = make_sink()
+        auditor = audit_alembic.Auditor.create(
+            version.version, sink=sink, duration_column_name='duration')
+        with mock.patch('audit_alembic.test_auditor', auditor):
+            cmd.upgrade(env.R.C)
+        sink.close()
+        assert auditor.table.name not in inspect(version.engine) \
+            .get_table_names()
+        rows = self._replayed(sink, auditor, tmpdir, remove=True)
+        assert [r['alembic_version'] for r in rows] == [
+            env.R.A, env.R.B, env.R.C]
+        assert all(isinstance(r['changed_at'], datetime) for r in rows)
+        assert not os.path.exists(sink.path)
+
+    def test_offline(self, env, cmd, capsys, tmpdir, make_sink):
+        sink = make_sink()
+        auditor = audit_alembic.Auditor.create('v', sink=sink)
+        with mock.patch('audit_alembic.test_auditor', auditor):
+            cmd.upgrade(env.R.C, sql=True)
+        sink.close()
+        assert 'alembic_version_history' not in capsys.readouterr()[0]
+        rows = self._replayed(sink, auditor, tmpdir)
+        assert [r['alembic_version'] for r in rows] == [
+            env.R.A, env.R.B, env.R.C]
+        assert all(isinstance(r['changed_at'], datetime) for r in rows)
+
+    def test_fsync_batching(self, make_sink):
+        table = audit_alembic.Auditor.create('v').table
+        sink = make_sink(fsync_rows=3, fsync_seconds=None)
+        row = {'alembic_version': 'a', 'operation_type': 'migration',
+               'operation_direction': 'up'}
+        with mock.patch('os.fsync') as fsync:
+            for _ in range(7):
+                sink.write(table, [row])
+            assert fsync.call_count == 2
+            sink.flush()
+            assert fsync.call_count == 3
+            sink.close()
+            assert fsync.call_count == 3
+
+    def test_incomplete_last_record(self, make_sink, tmpdir):
+        auditor = audit_alembic.Auditor.create('v')
+        sink = make_sink()
+        row = {'alembic_version': 'a', 'operation_type': 'migration',
+               'operation_direction': 'up'}
+        sink.write(auditor.table, [row] * 3)
+        sink.write(auditor.table, [row])
+        sink.close()
+        with open(sink.path, 'rb+') as f:
+            f.truncate(os.path.getsize(sink.path) - 5)
+        assert len(self._replayed(sink, auditor, tmpdir)) == 3
+
+    def test_unknown_table(self, make_sink, tmpdir):
+        sink = make_sink()
+        sink.write(audit_alembic.Auditor.create('v', table_name='a').table,
+                   [{'alembic_version': 'a'}])
+        sink.close()
+        with pytest.raises(exc.AuditRuntimeError):
+            sinks.replay(sink.path, create_engine('sqlite://'),
+                         audit_alembic.Auditor.create('v', table_name='b'))
+
+    def test_cli(self, make_sink, tmpdir, capsys):
+        sink = make_sink()
+        auditor = audit_alembic.Auditor.create('v')
+        sink.write(auditor.table, [{'alembic_version': 'a',
+                                    'operation_type': 'stamp',
+                                    'operation_direction': 'up'}])
+        sink.close()
+        url = 'sqlite:///%s' % tmpdir.join('replay.db')
+        assert cli.main(['replay', sink.path, url]) == 0
+        assert capsys.readouterr()[0].startswith('1 row(s) loaded')
+        assert len(list(auditor.history(create_engine(url)))) == 1
+
+
+class TestSqlModeBatched(TestBase):
+    insert = 'insert into alembic_version_history'
+
+    def _script(self, env, cmd, capsys, options, **kw):
+        _, _ = capsys.readouterr()
+        auditor = audit_alembic.Auditor.create('v', **kw)
+        with mock.patch('audit_alembic.test_auditor', auditor), \
+                mock.patch('audit_alembic.test_env_options', options):
+            cmd.upgrade(env.R.C, sql=True)
+        out, _ = capsys.readouterr()
+        return [stmt.strip() for stmt in out.split(';') if stmt.strip()]
+
+    def test_one_insert_per_run(self, env, cmd, capsys):
+        out = self._script(env, cmd, capsys, {'run': True}, buffered=True)
+        inserts = [s for s in out if s.lower().startswith(self.insert)]
+        assert len(inserts) == 1
+        assert all(getattr(env.R, r) in inserts[0] for r in 'ABC')
+
+    def test_insert_before_commit(self, env, cmd, capsys):
+        options = {'configure': {'transactional_ddl': True}}
+        out = self._script(env, cmd, capsys, options, buffered=True)
+        inserts = [i for i, s in enumerate(out)
+                   if s.lower().startswith(self.insert)]
+        assert len(inserts) == 1
+        assert out[inserts[0] + 1] == 'COMMIT'
+
+    def test_offline_output(self, env, cmd, capsys, tmpdir):
+        path = tmpdir.join('audit.sql')
+        out = self._script(env, cmd, capsys, {'run': True}, buffered=True,
+                           offline_output=str(path))
+        assert not [s for s in out if 'alembic_version_history' in s]
+        audit = [s.strip() for s in path.read().split(';') if s.strip()]
+        assert len(audit) == 5
+        assert audit[0].lower().startswith(
+            'create table alembic_version_history')
+        assert all(s.lower().startswith('create index') for s in audit[1:4])
+        assert audit[4].lower().startswith(self.insert)
+
+
+class TestHistory(TestBase):
+    __backend__ = True
+
+    @pytest.fixture
+    def auditor(self, env, version, cmd):
+        auditor = audit_alembic.Auditor.create(version.version)
+        with mock.patch('audit_alembic.test_auditor', auditor):
+            cmd.upgrade(env.R.D)
+            cmd.downgrade(env.R.B)
+        return auditor
+
+    def _versions(self, rows):
+        return [(r['alembic_version'], r['operation_direction'])
+                for r in rows]
+
+    def test_default_indexes(self, auditor, version):
+        indexes = inspect(version.engine).get_indexes(auditor.table.name)
+        assert sorted(i['column_names'] for i in indexes) == [
+            ['alembic_version'], ['changed_at'], ['user_version']]
+
+    def test_no_indexes(self, version):
+        auditor = audit_alembic.Auditor.create(version.version,
+                                               indexes=False)
+        assert not auditor.table.indexes
+
+    def test_all_in_order(self, auditor, version, env):
+        R = env.R
+        assert self._versions(auditor.history(version.engine)) == [
+            (R.A, 'up'), (R.B, 'up'), (R.C, 'up'), (R.D, 'up'),
+            (R.C, 'down'), (R.B, 'down')]
+
+    def test_filters(self, auditor, version, env):
+        R = env.R
+        assert self._versions(auditor.history(
+            version.engine, revision=R.C)) == [(R.C, 'up'), (R.C, 'down')]
+        assert self._versions(auditor.history(
+            version.engine, direction='down')) == [(R.C, 'down'),
+                                                   (R.B, 'down')]
+        assert self._versions(auditor.history(
+            version.engine, prev_revision=R.C, direction='up')) == [
+            (R.D, 'up')]
+        rows = list(auditor.history(version.engine))
+        assert len(list(auditor.history(
+            version.engine, user_version=rows[0]['user_version']))) == 6
+        assert not list(auditor.history(version.engine, user_version='x'))
+        assert len(list(auditor.history(
+            version.engine, since=rows[0]['changed_at'],
+            until=rows[-1]['changed_at']))) == 5
+
+    def test_keyset_pagination(self, auditor, version, env):
+        R = env.R
+        with version.engine.connect() as conn:
+            with _statements(version.engine, 'select') as selects:
+                page = list(auditor.history(conn, limit=4, batch_size=3))
+            assert len(selects) == 2
+            assert self._versions(page) == [
+                (R.A, 'up'), (R.B, 'up'), (R.C, 'up'), (R.D, 'up')]
+            rest = list(auditor.history(conn, after_id=page[-1]['id']))
+        assert self._versions(rest) == [(R.C, 'down'), (R.B, 'down')]
+
+    def test_newest_first(self, auditor, version, env):
+        R = env.R
+        last = list(auditor.history(version.engine, newest_first=True,
+                                    limit=2, batch_size=1))
+        assert self._versions(last) == [(R.B, 'down'), (R.C, 'down')]
+        before = auditor.history(version.engine, newest_first=True,
+                                 after_id=last[-1]['id'], limit=1)
+        assert self._versions(before) == [(R.D, 'up')]
+
+    def test_missing_role(self, env, version, cmd):
+        table = Table('custom_alembic_history', MetaData(),
+                      Column('id', types.Integer, primary_key=True))
+        auditor = audit_alembic.Auditor(table, {})
+        with pytest.raises(exc.AuditRuntimeError):
+            list(auditor.history(version.engine, revision='a'))
+
+
+class TestNormalizedRevisions(TestBase):
+    __backend__ = True
+
+    def _versions(self, rows):
+        return [(set(r['prev_alembic_version'].split('##')) - {''},
+                 set(r['alembic_version'].split('##')))
+                for r in rows]
+
+    def test_linked_revisions(self, env, version, cmd):
+        R = env.R
+        auditor = audit_alembic.Auditor.create(version.version,
+                                               normalize_revisions=True)
+        assert 'alembic_version' not in auditor.table.c
+        revisions = auditor.revisions.revisions.table
+        with mock.patch('audit_alembic.test_auditor', auditor), \
+                _statements(version.engine,
+                            'insert into %s ' % revisions.name) as inserts:
+            cmd.upgrade(env.R.F)
+        # each revision is stored once, though most appear in two steps
+        assert len(inserts) == 8
+        rows = list(auditor.history(version.engine))
+        assert len(rows) == 8
+        assert self._versions(rows)[0] == (set(), {R.A})
+        assert self._versions(rows)[-1] == ({R.E, R.E0}, {R.F})
+        assert self._versions(auditor.history(
+            version.engine, revision=R.C)) == [({R.B}, {R.C})]
+        assert self._versions(auditor.history(
+            version.engine, prev_revision=R.E0)) == [({R.E, R.E0}, {R.F})]
+
+    def test_links_written_per_flush(self, env, version, cmd):
+        auditor = audit_alembic.Auditor.create(
+            version.version, normalize_revisions=True, buffered=True)
+        links = auditor.revisions.table
+        with mock.patch('audit_alembic.test_auditor', auditor), \
+                mock.patch('audit_alembic.test_env_options', {'run': True}), \
+                _statements(version.engine,
+                            'insert into %s ' % links.name) as inserts:
+            cmd.upgrade(env.R.F)
+        assert len(inserts) == 1
+        assert self._versions(auditor.history(version.engine))[-1] == (
+            {env.R.E, env.R.E0}, {env.R.F})
+
+    def test_offline(self, env, cmd, capsys, tmpdir):
+        R = env.R
+        path = tmpdir.join('audit.sql')
+        auditor = audit_alembic.Auditor.create(
+            'v', normalize_revisions=True, offline_output=str(path))
+        with mock.patch('audit_alembic.test_auditor', auditor), \
+                mock.patch('audit_alembic.test_env_options', {'run': True}):
+            cmd.upgrade('%s:%s' % (R.B, R.F), sql=True)
+        engine = create_engine('sqlite://')
+        with engine.begin() as conn:
+            for stmt in path.read().split(';'):
+                if stmt.strip():
+                    conn.execute(stmt)
+        # SQLite cannot parse the ISO timestamps rendered offline, so read
+        # the links without the rows
+        ids = [r[0] for r in engine.execute(
+            select([auditor.table.c.id]).order_by(auditor.table.c.id))]
+        linked = auditor.revisions.fetch(engine, ids)
+        assert [tuple(map(set, linked[i])) for i in ids] == [
+            ({R.B}, {R.C}), ({R.C}, {R.D0}), ({R.D0}, {R.E0}),
+            ({R.C}, {R.D}), ({R.D}, {R.E}), ({R.E, R.E0}, {R.F})]
+
+    def test_no_sink(self):
+        with pytest.raises(exc.AuditConstructError):
+            audit_alembic.Auditor.create(
+                'v', normalize_revisions=True,
+                sink=sinks.ThreadedSink(create_engine('sqlite://')))
+
+
+class TestNormalizedUserVersion(TestBase):
+    __backend__ = True
+
+    def test_one_row_per_version(self, env, version, cmd):
+        auditor = audit_alembic.Auditor.create(
+            'rel-1', normalize_user_version=True, buffered=True)
+        dimension = auditor.dimensions['user_version'].table
+        with mock.patch('audit_alembic.test_auditor', auditor), \
+                _statements(version.engine,
+                            'select %s.' % dimension.name) as selects, \
+                _statements(version.engine,
+                            'insert into %s ' % dimension.name) as inserts:
+            cmd.upgrade(env.R.D)
+        assert len(selects) == len(inserts) == 1
+        with mock.patch('audit_alembic.test_auditor', auditor):
+            cmd.downgrade(env.R.B)
+        ids = version.engine.execute(
+            select([auditor.table.c.user_version])).fetchall()
+        assert len(ids) == 6 and all(isinstance(i[0], int) for i in ids)
+        assert version.engine.execute(
+            select([dimension.c.user_version])).fetchall() == [('rel-1',)]
+        rows = list(auditor.history(version.engine, user_version='rel-1'))
+        assert len(rows) == 6
+        assert set(r['user_version'] for r in rows) == {'rel-1'}
+        assert not list(auditor.history(version.engine, user_version='x'))
+
+    def test_offline(self, env, cmd, tmpdir):
+        path = tmpdir.join('audit.sql')
+        auditor = audit_alembic.Auditor.create(
+            'rel-1', normalize_user_version=True, normalize_revisions=True,
+            offline_output=str(path))
+        with mock.patch('audit_alembic.test_auditor', auditor), \
+                mock.patch('audit_alembic.test_env_options', {'run': True}):
+            cmd.upgrade(env.R.C, sql=True)
+        engine = create_engine('sqlite://')
+        with engine.begin() as conn:
+            for stmt in path.read().split(';'):
+                if stmt.strip():
+                    conn.execute(stmt)
+        dimension = auditor.dimensions['user_version']
+        assert engine.execute(
+            select([dimension.id, dimension.value])).fetchall() == [
+            (1, 'rel-1')]
+        assert engine.execute(
+            select([auditor.table.c.user_version])).fetchall() == [(1,)] * 3
+
+
+class _Step(object):
+    """Stands in for a ``MigrationInfo``."""
+    def __init__(self, source, destination, is_stamp=True, is_upgrade=True):
+        self.source_revision_ids = tuple(source.split())
+        self.destination_revision_ids = tuple(destination.split())
+        self.is_stamp = is_stamp
+        self.is_migration = not is_stamp
+        self.is_upgrade = is_upgrade
+
+
+class TestCompressStamps(TestBase):
+    __backend__ = True
+
+    steps = [_Step('', 'a'), _Step('a', 'b'), _Step('b', 'c d'),
+             _Step('c d', 'e', is_stamp=False),
+             _Step('e', 'c d', is_upgrade=False),
+             _Step('c d', 'b', is_upgrade=False),
+             _Step('b', 'c')]
+
+    def _listen(self, auditor, ctx):
+        for step in self.steps:
+            auditor.listen(ctx=ctx, step=step, heads=(), run_args={})
+
+    def _rows(self, version, explicit=True, **kw):
+        auditor = audit_alembic.Auditor.create('v', compress_stamps=True,
+                                               **kw)
+        with version.engine.connect() as conn:
+            ctx = MigrationContext.configure(conn)
+            if explicit:
+                with auditor.run(ctx):
+                    self._listen(auditor, ctx)
+            else:
+                self._listen(auditor, ctx)
+        t = auditor.table
+        return [tuple(r) for r in version.engine.execute(select([
+            t.c.prev_alembic_version, t.c.alembic_version, t.c.operation_type,
+            t.c.operation_direction, t.c.steps]).order_by(t.c.id))]
+
+    @pytest.mark.parametrize('buffered', [False, True])
+    def test_ranges(self, version, buffered):
+        assert self._rows(version, buffered=buffered) == [
+            ('', 'c##d', 'stamp', 'up', 3),
+            ('c##d', 'e', 'migration', 'up', 1),
+            ('e', 'b', 'stamp', 'down', 2),
+            ('b', 'c', 'stamp', 'up', 1)]
+
+    def test_no_boundary(self, version):
+        # without a transaction or a run, we could not tell when a range
+        # ends: every step is recorded
+        assert [r[-1] for r in self._rows(version, explicit=False)] == \
+            [1] * len(self.steps)
+
+    def test_stamp_command(self, env, version, cmd):
+        auditor = audit_alembic.Auditor.create(version.version,
+                                               compress_stamps=True)
+        with mock.patch('audit_alembic.test_auditor', auditor), \
+                mock.patch('audit_alembic.test_env_options', {'run': True}):
+            cmd.upgrade(env.R.B)
+            cmd.stamp(env.R.D)
+        rows = list(auditor.history(version.engine))
+        assert [(r['operation_type'], r['steps']) for r in rows] == [
+            ('migration', 1), ('migration', 1), ('stamp', 1)]
+
+
+class TestConcurrency(TestBase):
+    def _migrate(self, auditor, url, steps):
+        engine = create_engine(url)
+        try:
+            with engine.connect() as conn:
+                ctx = MigrationContext.configure(conn)
+                with auditor.run(ctx):
+                    for step in steps:
+                        auditor.listen(ctx=ctx, step=step, heads=(),
+                                       run_args={})
+        finally:
+            engine.dispose()
+
+    def _count(self, auditor, url):
+        engine = create_engine(url)
+        try:
+            return len(list(auditor.history(engine)))
+        finally:
+            engine.dispose()
+
+    def test_table_per_database(self, tmpdir):
+        auditor = audit_alembic.Auditor.create('v')
+        urls = ['sqlite:///%s' % tmpdir.join('%d.db' % i) for i in range(2)]
+        for url in urls:
+            self._migrate(auditor, url, [_Step('', 'a', is_stamp=False)])
+        assert [self._count(auditor, url) for url in urls] == [1, 1]
+
+    def test_table_per_memory_database(self):
+        auditor = audit_alembic.Auditor.create('v')
+        engines = [create_engine('sqlite://') for _ in range(2)]
+        for engine in engines:
+            with engine.connect() as conn:
+                ctx = MigrationContext.configure(conn)
+                with auditor.run(ctx):
+                    auditor.listen(ctx=ctx, step=_Step('', 'a', is_stamp=False),
+                                   heads=(), run_args={})
+        assert [len(list(auditor.history(engine))) for engine in engines] \
+            == [1, 1]
+
+    def test_database_looked_up_once_per_run(self, tmpdir):
+        auditor = audit_alembic.Auditor.create('v')
+        engine = create_engine('sqlite:///%s' % tmpdir.join('h.db'))
+        with mock.patch.object(auditor, '_database_key',
+                               wraps=auditor._database_key) as key:
+            for _ in range(2):
+                with engine.connect() as conn:
+                    ctx = MigrationContext.configure(conn)
+                    with auditor.run(ctx):
+                        for i in range(3):
+                            auditor.listen(
+                                ctx=ctx, step=_Step(str(i), str(i + 1)),
+                                heads=(), run_args={})
+        assert key.call_count == 2
+        assert len(list(auditor.history(engine))) == 6
+
+    @pytest.mark.parametrize('kw', [{}, {'buffered': True},
+                                    {'normalize_user_version': True,
+                                     'normalize_revisions': True}])
+    def test_stress(self, tmpdir, kw):
+        import threading
+        auditor = audit_alembic.Auditor.create(
+            audit_alembic.memoize(lambda **_: 'v', 'run'),
+            duration_column_name='duration', **kw)
+        steps = [_Step(str(i), str(i + 1), is_stamp=False)
+                 for i in range(50)]
+        urls = ['sqlite:///%s' % tmpdir.join('%d.db' % i) for i in range(16)]
+        start = threading.Event()
+        errors = []
+
+        def work(url):
+            start.wait()
+            try:
+                for _ in range(2):
+                    self._migrate(auditor, url, steps)
+            except Exception as e:  # pragma: no cover
+                errors.append(e)
+
+        threads = [threading.Thread(target=work, args=(url,))
+                   for url in urls]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        assert not errors
+        assert [self._count(auditor, url) for url in urls] == \
+            [100] * len(urls)
+
+
+class TestFleet(TestBase):
+    def _urls(self, tmpdir, n):
+        return ['sqlite:///%s' % tmpdir.join('db%d.db' % i) for i in range(n)]
+
+    def _history(self, url):
+        engine = create_engine(url)
+        try:
+            return list(audit_alembic.Auditor.create('v').history(engine))
+        finally:
+            engine.dispose()
+
+    def test_threads(self, env, tmpdir):
+        urls = self._urls(tmpdir, 6)
+        bad = 'sqlite:///%s' % tmpdir.join('missing', 'x.db')
+        report = fleet.upgrade_fleet(_testing_config(), urls + [bad],
+                                     user_version='1.0', workers=3,
+                                     executor='thread')
+        assert not report.ok
+        assert [r.status for r in report.results] == ['ok'] * 6 + ['failed']
+        assert report.failed[0].error.startswith('OperationalError')
+        assert set(r.revision for r in report.results[:6]) == {env.R.H}
+        assert set(r.steps for r in report.results[:6]) == {16}
+        for url in urls:
+            rows = self._history(url)
+            assert len(rows) == 16
+            assert set(r['user_version'] for r in rows) == {'1.0'}
+        # a second run has nothing left to do
+        again = fleet.upgrade_fleet(_testing_config(), urls, workers=3,
+                                    executor='thread')
+        assert again.ok and set(r.steps for r in again.results) == {0}
+
+    def test_processes(self, env, tmpdir):
+        urls = self._urls(tmpdir, 3)
+        summary = 'sqlite:///%s' % tmpdir.join('summary.db')
+        report = fleet.upgrade_fleet(_testing_config(), urls, env.R.C,
+                                     workers=2, summary_bind=summary)
+        assert report.ok
+        assert [r.revision for r in report.results] == [env.R.C] * 3
+        assert [len(self._history(url)) for url in urls] == [3] * 3
+        rows = create_engine(summary).execute(
+            select([fleet.summary_table()])).fetchall()
+        assert [(r.run_id, r.status, r.steps) for r in rows] == \
+            [(report.run_id, 'ok', 3)] * 3
+
+    def test_cli(self, env, tmpdir, capsys):
+        urls = self._urls(tmpdir, 2)
+        listing = tmpdir.join('urls.txt')
+        listing.write('# tenants\n%s\n' % urls[1])
+        config = _testing_config().config_file_name
+        assert cli.main(['fleet', '-c', config, '--threads', '-r', env.R.B,
+                         '-f', str(listing), urls[0]]) == 0
+        out = capsys.readouterr()[0].splitlines()
+        assert len(out) == 3
+        assert out[0].startswith('ok') and env.R.B in out[0]
+        assert out[-1].startswith('2 database(s), 0 failed')
+        assert cli.main(['fleet', '-c', config]) == 2
+
+    def test_bad_executor(self):
+        with pytest.raises(exc.AuditConstructError):
+            fleet.upgrade_fleet(None, [], executor='fibers')
+
+
+class TestMetrics(TestBase):
+    def _upgrade(self, env, cmd, *exporters):
+        auditor = audit_alembic.Auditor.create('v', metrics=exporters)
+        with mock.patch('audit_alembic.test_auditor', auditor), \
+                mock.patch('audit_alembic.test_env_options', {'run': True}):
+            cmd.upgrade(env.R.C)
+        assert auditor.emitter.flush(5)
+        return auditor
+
+    def test_spans(self, env, cmd):
+        recorder = metrics.SpanRecorder()
+        self._upgrade(env, cmd, recorder)
+        spans = list(recorder.spans)
+        assert [s.name for s in spans] == ['alembic.step'] * 3 + [
+            'alembic.run']
+        root = spans[-1]
+        assert root.attributes == {'alembic.steps': 3,
+                                   'alembic.status': 'ok'}
+        assert set(s.trace_id for s in spans) == set([root.trace_id])
+        assert [s.parent_id for s in spans[:3]] == [root.span_id] * 3
+        assert [s.attributes['alembic.destination'] for s in spans[:3]] == [
+            env.R.A, env.R.B, env.R.C]
+        assert all(s.attributes['alembic.operation_type'] == 'migration'
+                   for s in spans[:3])
+        assert all(root.start_time <= s.start_time <= s.end_time
+                   <= root.end_time for s in spans[:3])
+
+    def test_prometheus(self, env, cmd, tmpdir):
+        path = str(tmpdir.join('alembic.prom'))
+        self._upgrade(env, cmd, metrics.PrometheusTextfile(
+            path, labels={'db': 'main'}, buckets=(1000,)))
+        with open(path) as f:
+            lines = f.read().splitlines()
+        labels = 'db="main",direction="up",operation_type="migration"'
+        assert 'alembic_audit_steps_total{%s} 3.0' % labels in lines
+        assert ('alembic_audit_step_duration_seconds_bucket{%s,le="1000.0"} '
+                '3.0' % labels) in lines
+        assert ('alembic_audit_step_duration_seconds_count{%s} 3.0'
+                % labels) in lines
+        assert 'alembic_audit_runs_total{db="main",status="ok"} 1.0' in lines
+        assert 'alembic_audit_last_run_steps{db="main"} 3.0' in lines
+        assert not [name for name in os.listdir(str(tmpdir))
+                    if name.endswith('.tmp')]
+
+    def test_exported_at_exit(self, tmpdir):
+        path = str(tmpdir.join('alembic.prom'))
+        code = '\n'.join([
+            'from alembic.runtime.migration import MigrationContext',
+            'from alembic.runtime.migration import MigrationInfo',
+            'from sqlalchemy import create_engine',
+            'import audit_alembic',
+            'from audit_alembic.metrics import PrometheusTextfile',
+            'auditor = audit_alembic.Auditor.create(',
+            '    "v", metrics=[PrometheusTextfile(%r)])' % path,
+            'with create_engine("sqlite://").connect() as conn:',
+            '    ctx = MigrationContext.configure(conn)',
+            '    with auditor.run(ctx):',
+            '        for i in range(200):',
+            '            auditor.listen(ctx=ctx, heads=(), run_args={},',
+            '                           step=MigrationInfo(',
+            '                               None, is_upgrade=True,',
+            '                               is_stamp=False,',
+            '                               up_revisions="a",',
+            '                               down_revisions=()))',
+        ])
+        subprocess.check_call([sys.executable, '-c', code], env=dict(
+            os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+        with open(path) as f:
+            lines = f.read().splitlines()
+        assert 'alembic_audit_steps_total{direction="up",' \
+            'operation_type="migration"} 200.0' in lines
+        assert 'alembic_audit_runs_total{status="ok"} 1.0' in lines
+        assert 'alembic_audit_last_run_steps 200.0' in lines
+
+    def test_failed_run(self):
+        recorder = metrics.SpanRecorder()
+        auditor = audit_alembic.Auditor.create('v', metrics=[recorder])
+        with create_engine('sqlite://').connect() as conn:
+            ctx = MigrationContext.configure(conn)
+            with pytest.raises(ValueError), auditor.run(ctx):
+                auditor.listen(ctx=ctx, step=_Step('', 'a'), heads=(),
+                               run_args={})
+                raise ValueError()
+        assert auditor.emitter.flush(5)
+        assert [s.attributes.get('alembic.status') for s in recorder.spans] \
+            == [None, 'failed']
+
+    def test_non_blocking(self):
+        release = threading.Event()
+
+        class Slow(metrics.Exporter):
+            def step(self, event):
+                release.wait(5)
+
+        recorder = metrics.SpanRecorder()
+        emitter = metrics.Emitter([Slow(), recorder], maxsize=2)
+        run = mock.Mock(metrics={'duration': 0.5}, id='0' * 32,
+                        started_at=0.0, clock_started=0.0)
+        for _ in range(5):
+            emitter.step(run, _Step('', 'a'))
+        assert emitter.dropped >= 2
+        release.set()
+        assert emitter.flush(5)
+        assert 1 <= len(recorder.spans) <= 3
+
+    def test_no_emitter_by_default(self):
+        assert audit_alembic.Auditor.create('v').emitter is None
+
+    def test_failing_exporter(self, env, cmd):
+        class Broken(metrics.Exporter):
+            def step(self, event):
+                raise ValueError()
+
+        recorder = metrics.SpanRecorder()
+        self._upgrade(env, cmd, Broken(), recorder)
+        assert len(recorder.spans) == 4
+
+
+class TestPredict(TestBase):
+    def _record(self, auditor, url, steps):
+        engine = create_engine(url)
+        with engine.connect() as conn:
+            ctx = MigrationContext.configure(conn)
+            with auditor.run(ctx):
+                for step in steps:
+                    auditor.listen(ctx=ctx, step=step, heads=(),
+                                   run_args={})
+        return engine
+
+    def _steps(self, env):
+        R = env.R
+        up = [_Step('', R.A, is_stamp=False), _Step(R.A, R.B, is_stamp=False)]
+        return up * 3 + [_Step(R.B, R.C),
+                         _Step(R.B, R.A, is_stamp=False, is_upgrade=False)]
+
+    @pytest.mark.parametrize('kw', [{}, {'normalize_revisions': True},
+                                    {'normalize_user_version': True}])
+    def test_predict(self, env, tmpdir, kw):
+        auditor = audit_alembic.Auditor.create(
+            'v', duration_column_name='duration', **kw)
+        engine = self._record(auditor, 'sqlite:///%s' % tmpdir.join('h.db'),
+                              self._steps(env))
+        prediction = predict.predict(auditor, engine, _testing_config(),
+                                     env.R.C, current=())
+        assert [(s.revision, s.samples) for s in prediction.steps] == [
+            (env.R.A, 3), (env.R.B, 3), (env.R.C, 0)]
+        assert [s.revision for s in prediction.unknown] == [env.R.C]
+        assert 0 < prediction.p50 <= prediction.p95
+        down = predict.predict(auditor, engine, _testing_config(), 'base',
+                               current=(env.R.B,), downgrade=True)
+        assert [(s.revision, s.samples) for s in down.steps] == [
+            (env.R.B, 1), (env.R.A, 0)]
+
+    @pytest.mark.parametrize('kw', [
+        {}, {'normalize_revisions': True, 'normalize_user_version': True}])
+    def test_duration_percentiles(self, env, tmpdir, kw):
+        auditor = audit_alembic.Auditor.create(
+            'v', duration_column_name='duration', **kw)
+        engine = self._record(auditor, 'sqlite:///%s' % tmpdir.join('h.db'),
+                              self._steps(env))
+        durations = {}
+        for _, rev, duration in auditor.durations(engine):
+            durations.setdefault(rev, []).append(duration)
+        statements = []
+        with engine.connect() as conn:
+            event.listen(conn, 'before_cursor_execute',
+                         lambda *args: statements.append(args[2]))
+            found = auditor.duration_percentiles(
+                conn, [env.R.A, env.R.B, env.R.C], (0, .5, .95, 1))
+        assert len(statements) == 1
+        assert sorted(found) == sorted([env.R.A, env.R.B])
+        for rev, (count, quantiles) in found.items():
+            assert count == 3
+            assert quantiles == [pytest.approx(predict.percentile(
+                durations[rev], f)) for f in (0, .5, .95, 1)]
+
+    def test_percentile(self):
+        values = [4.0, 1.0, 3.0, 2.0, 5.0]
+        assert predict.percentile(values, .5) == 3.0
+        assert predict.percentile(values, .95) == pytest.approx(4.8)
+        assert predict.percentile([7.0], .95) == 7.0
+        assert predict.percentile([], .5) is None
+
+    def test_cache(self, env, tmpdir):
+        auditor = audit_alembic.Auditor.create(
+            'v', duration_column_name='duration')
+        url = 'sqlite:///%s' % tmpdir.join('h.db')
+        engine = self._record(auditor, url, self._steps(env)[:2])
+        cache = predict.DurationCache(str(tmpdir.join('durations.json')))
+        reads = []
+        durations = auditor.durations
+
+        def counted(*args, **kw):
+            for row in durations(*args, **kw):
+                reads.append(row)
+                yield row
+
+        with mock.patch.object(auditor, 'durations', counted):
+            found = cache.durations(auditor, engine)
+            assert sorted(found) == sorted([env.R.A, env.R.B])
+            assert len(reads) == 2
+            self._record(auditor, url, self._steps(env)[:1])
+            found = cache.durations(auditor, engine)
+            assert len(reads) == 3
+            assert len(found[env.R.A]) == 2
+        cache.clear()
+        assert not os.path.exists(cache.path)
+
+    def test_cli(self, env, tmpdir, capsys):
+        auditor = audit_alembic.Auditor.create(
+            'v', duration_column_name='duration')
+        url = 'sqlite:///%s' % tmpdir.join('h.db')
+        self._record(auditor, url, self._steps(env)[:2])
+        config = _testing_config().config_file_name
+        assert cli.main(['predict', url, '-c', config, '-r', env.R.C,
+                         '--cache', str(tmpdir.join('d.json'))]) == 0
+        out = capsys.readouterr()[0].splitlines()
+        assert len(out) == 4
+        assert out[2].startswith(env.R.C) and '?' in out[2]
+        assert out[-1].startswith('3 step(s) up') and \
+            out[-1].endswith('1 without history')
+
+
+class TestExport(TestBase):
+    def _export(self, tmpdir, name, **kw):
+        path = str(tmpdir.join(name))
+        result = export.export(audit_alembic.test_auditor,
+                               sqla_test_config.db, path, batch_size=2, **kw)
+        return result, path
+
+    def test_jsonl_incremental(self, env, cmd, tmpdir):
+        cmd.upgrade(env.R.C)
+        state = export.ExportState(str(tmpdir.join('state.json')))
+        result, path = self._export(tmpdir, 'a.jsonl', state=state)
+        assert result.rows == 3
+        with open(path) as f:
+            rows = [json.loads(line) for line in f]
+        assert [r['alembic_version'] for r in rows] == [
+            env.R.A, env.R.B, env.R.C]
+        assert [r['id'] for r in rows] == list(range(result.first_id,
+                                                     result.last_id + 1))
+        cmd.upgrade(env.R.D)
+        again, path = self._export(tmpdir, 'b.jsonl', state=state)
+        assert (again.rows, again.first_id) == (1, result.last_id + 1)
+        with open(path) as f:
+            assert json.loads(f.read())['alembic_version'] == env.R.D
+        nothing, path = self._export(tmpdir, 'c.jsonl', state=state)
+        assert nothing == (0, None, None)
+        assert os.path.getsize(path) == 0
+        assert not [name for name in os.listdir(str(tmpdir))
+                    if name.endswith('.tmp')]
+
+    def test_state_key(self, tmpdir):
+        connection = mock.Mock(engine=create_engine('sqlite:///app.db'))
+        keys = []
+        for name in ('a', 'b'):
+            with tmpdir.join(name).ensure(dir=True).as_cwd():
+                keys.append(export.ExportState.key(
+                    connection, audit_alembic.test_auditor.table))
+        assert keys[0] != keys[1]
+        assert str(tmpdir.join('a', 'app.db')) in keys[0]
+
+    def test_csv(self, env, cmd, tmpdir):
+        cmd.upgrade(env.R.B)
+        result, path = self._export(tmpdir, 'a.csv', format='csv',
+                                    after_id=0)
+        with open(path) as f:
+            rows = list(csv.DictReader(f))
+        assert [r['alembic_version'] for r in rows] == [env.R.A, env.R.B]
+        assert rows[0]['prev_alembic_version'] == ''
+        assert datetime.strptime(rows[0]['changed_at'][:19],
+                                 '%Y-%m-%dT%H:%M:%S')
+
+    def test_parquet(self, env, cmd, tmpdir):
+        pq = pytest.importorskip('pyarrow.parquet')
+        cmd.upgrade(env.R.C)
+        result, path = self._export(tmpdir, 'a.parquet', format='parquet')
+        table = pq.read_table(path)
+        assert table.column('alembic_version').to_pylist() == [
+            env.R.A, env.R.B, env.R.C]
+        assert pq.ParquetFile(path).num_row_groups == 2
+        assert table.column('id').to_pylist() == [1, 2, 3]
+
+    def test_parquet_normalized(self, env, tmpdir):
+        pq = pytest.importorskip('pyarrow.parquet')
+        auditor = audit_alembic.Auditor.create(
+            'rel-1', normalize_revisions=True, normalize_user_version=True)
+        engine = create_engine('sqlite:///%s' % tmpdir.join('h.db'))
+        with engine.connect() as conn:
+            ctx = MigrationContext.configure(conn)
+            with auditor.run(ctx):
+                for step in (_Step('', env.R.A), _Step(env.R.A, env.R.B)):
+                    auditor.listen(ctx=ctx, step=step, heads=(),
+                                   run_args={})
+        path = str(tmpdir.join('a.parquet'))
+        export.export(auditor, engine, path, format='parquet')
+        table = pq.read_table(path)
+        assert table.column('user_version').to_pylist() == ['rel-1'] * 2
+        assert table.column('alembic_version').to_pylist() == [
+            env.R.A, env.R.B]
+
+    def test_no_pyarrow(self, tmpdir):
+        with mock.patch('audit_alembic.export.features',
+                        lambda: {'pyarrow': False}), \
+                pytest.raises(exc.AuditSetupError):
+            self._export(tmpdir, 'a.parquet', format='parquet')
+        with pytest.raises(exc.AuditConstructError):
+            self._export(tmpdir, 'a.xml', format='xml')
+
+    def test_cli(self, env, tmpdir, capsys):
+        url = 'sqlite:///%s' % tmpdir.join('h.db')
+        fleet.upgrade_fleet(_testing_config(), [url], env.R.C,
+                            executor='thread')
+        output = str(tmpdir.join('out.csv'))
+        state = str(tmpdir.join('state.json'))
+        for expected in ('3 row(s) exported, ids 1 to 3', '0 row(s) exported'):
+            assert cli.main(['export', url, output, '-f', 'csv',
+                             '--state', state]) == 0
+            assert capsys.readouterr()[0].strip() == expected
+
+
+class TestRetention(TestBase):
+    later = datetime.utcnow() + timedelta(days=30)
+
+    def _rollup(self, auditor):
+        rollup = retention.rollup_table(auditor.table)
+        return dict(((r.revision, r.operation_direction), r)
+                    for r in sqla_test_config.db.execute(select([rollup])))
+
+    def test_prune(self, env, cmd, tmpdir):
+        auditor = audit_alembic.test_auditor
+        cmd.upgrade(env.R.C)
+        archive = str(tmpdir.join('archive'))
+        result = retention.prune(auditor, sqla_test_config.db,
+                                 timedelta(days=1), archive_dir=archive,
+                                 batch_size=2, now=self.later)
+        assert result[:2] == (3, 2)
+        assert list(auditor.history(sqla_test_config.db)) == []
+        archived = [row for path in result.archives
+                    for row in retention.read_archive(path)]
+        assert [r['alembic_version'] for r in archived] == [
+            env.R.A, env.R.B, env.R.C]
+        first = self._rollup(auditor)
+        cmd.downgrade('base')
+        cmd.upgrade(env.R.A)
+        assert retention.prune(auditor, sqla_test_config.db,
+                               timedelta(days=1), now=self.later).rows == 4
+        rollup = self._rollup(auditor)
+        assert sorted(rollup) == sorted([
+            (env.R.A, 'up'), (env.R.B, 'up'), (env.R.C, 'up'),
+            (env.R.B, 'down'), (env.R.A, 'down'), ('', 'down')])
+        a = rollup[env.R.A, 'up']
+        assert a.count == 2 and a.duration_count == 0
+        assert a.first_applied == first[env.R.A, 'up'].first_applied
+        assert a.last_applied > a.first_applied
+
+    def test_recent_and_type(self, env, cmd):
+        auditor = audit_alembic.test_auditor
+        cmd.upgrade(env.R.B)
+        cmd.stamp(env.R.C)
+        db = sqla_test_config.db
+        assert retention.prune(auditor, db, timedelta(days=1),
+                               rollup=False).rows == 0
+        result = retention.prune(auditor, db, timedelta(days=1),
+                                 operation_type='stamp', rollup=False,
+                                 now=self.later)
+        assert result.rows == 1
+        assert [r['operation_type'] for r in auditor.history(db)] == [
+            'migration'] * 2
+        assert retention.rollup_table(auditor.table).name not in \
+            inspect(db).get_table_names()
+
+    @pytest.mark.parametrize('kw', [
+        {'normalize_revisions': True}, {'normalize_user_version': True},
+        {'duration_column_name': 'elapsed', 'change_time_column_name': 'ts',
+         'alembic_version_column_name': 'rev',
+         'operation_column_name': 'op', 'direction_column_name': 'dir'}])
+    def test_durations(self, tmpdir, kw):
+        kw.setdefault('duration_column_name', 'duration')
+        auditor = audit_alembic.Auditor.create('v', **kw)
+        engine = create_engine('sqlite:///%s' % tmpdir.join('h.db'))
+        with engine.connect() as conn:
+            ctx = MigrationContext.configure(conn)
+            with auditor.run(ctx):
+                for _ in range(3):
+                    auditor.listen(ctx=ctx, step=_Step('', 'a', False),
+                                   heads=(), run_args={})
+        durations = [r[kw['duration_column_name']]
+                     for r in auditor.history(engine)]
+        assert retention.prune(auditor, engine, timedelta(days=1),
+                               now=self.later).rows == 3
+        row = engine.execute(select([
+            retention.rollup_table(auditor.table)])).fetchone()
+        assert (row.revision, row.count, row.duration_count) == ('a', 3, 3)
+        assert row.duration_min == min(durations)
+        assert row.duration_max == max(durations)
+        assert row.duration_avg == pytest.approx(sum(durations) / 3)
+        assert list(auditor.history(engine)) == []
+
+    def test_cli(self, env, tmpdir, capsys):
+        url = 'sqlite:///%s' % tmpdir.join('h.db')
+        fleet.upgrade_fleet(_testing_config(), [url], env.R.C,
+                            executor='thread')
+        assert cli.main(['prune', url, '--older-than', '0']) == 0
+        assert capsys.readouterr()[0].strip() == \
+            '3 row(s) deleted in 1 batch(es)'
+
+
+class TestCurrentState(TestBase):
+    def _current(self, auditor):
+        return dict((r['head'], r) for r in
+                    auditor.current_state.read(sqla_test_config.db))
+
+    @pytest.mark.parametrize('kw', [
+        {}, {'buffered': True}, {'compress_stamps': True},
+        {'normalize_revisions': True, 'normalize_user_version': True}])
+    def test_heads(self, env, cmd, version, kw):
+        auditor = audit_alembic.Auditor.create(version.version,
+                                               current_state=True, **kw)
+        with mock.patch('audit_alembic.test_auditor', auditor), \
+                mock.patch('audit_alembic.test_env_options', {'run': True}):
+            cmd.upgrade(env.R.C)
+            current = self._current(auditor)
+            assert list(current) == [env.R.C]
+            assert current[env.R.C]['prev_alembic_version'] == env.R.B
+            assert current[env.R.C]['operation_direction'] == 'up'
+            assert current[env.R.C]['user_version'] == version.version()
+            assert isinstance(current[env.R.C]['changed_at'], datetime)
+            cmd.upgrade(env.R.E1)
+            e1 = self._current(auditor)[env.R.E1]
+            version.inc()
+            cmd.stamp(env.R.D)
+            current = self._current(auditor)
+            assert sorted(current) == sorted([env.R.D, env.R.E1])
+            assert current[env.R.E1] == e1
+            assert current[env.R.D]['operation_type'] == 'stamp'
+            assert current[env.R.D]['user_version'] == version.version()
+            cmd.downgrade(env.R.D0)
+            current = self._current(auditor)
+            assert sorted(current) == sorted([env.R.D, env.R.D0])
+            assert current[env.R.D0]['operation_direction'] == 'down'
+            cmd.downgrade('base')
+            assert self._current(auditor) == {}
+
+    def test_offline(self, env, cmd, capsys):
+        auditor = audit_alembic.Auditor.create('v', current_state=True)
+        with mock.patch('audit_alembic.test_auditor', auditor):
+            cmd.upgrade(env.R.B, sql=True)
+        out = capsys.readouterr()[0]
+        assert out.count('DELETE FROM alembic_version_history_current') == 2
+        assert "VALUES ('%s'" % env.R.B in out
+
+    def test_sink(self):
+        with pytest.raises(exc.AuditConstructError):
+            audit_alembic.Auditor.create('v', current_state=True,
+                                         sink=sinks.JsonLinesSink('log'))
+
+
+class TestVerify(TestBase):
+    def _insert(self, auditor, prev, new, type_='migration', direction='up',
+                changed_at=None):
+        sqla_test_config.db.execute(auditor.table.insert().values(
+            prev_alembic_version=prev, alembic_version=new,
+            operation_type=type_, operation_direction=direction,
+            changed_at=changed_at or datetime.utcnow()))
+
+    def _issues(self, auditor):
+        return [(i.kind, i.id) for i in auditor.verify(
+            sqla_test_config.db, _testing_config(), batch_size=2)]
+
+    @pytest.mark.parametrize('kw', [{}, {'normalize_revisions': True}])
+    def test_clean(self, env, cmd, version, kw):
+        auditor = audit_alembic.Auditor.create(version.version, **kw)
+        with mock.patch('audit_alembic.test_auditor', auditor):
+            cmd.upgrade(env.R.C)
+            cmd.upgrade(env.R.E1)
+            cmd.stamp(env.R.D)
+            cmd.upgrade('heads')
+            cmd.downgrade(env.R.D0)
+            cmd.downgrade('base')
+        verification = auditor.verify(sqla_test_config.db, _testing_config(),
+                                      batch_size=3)
+        assert list(verification) == []
+        assert verification.rows == len(list(
+            auditor.history(sqla_test_config.db)))
+        assert verification.issues == 0
+
+    def test_issues(self, env, cmd):
+        auditor = audit_alembic.test_auditor
+        cmd.upgrade(env.R.B)
+        R = env.R
+        # skips B -> C
+        self._insert(auditor, R.C, R.D)
+        # not an edge
+        self._insert(auditor, R.D, R.F)
+        # out of band: the database went back to C
+        self._insert(auditor, R.C, R.D0)
+        self._insert(auditor, R.D0, R.E1, changed_at=datetime(2000, 1, 1))
+        self._insert(auditor, R.E1, R.E1 + 'x')
+        # already applied
+        self._insert(auditor, R.D0, R.E1)
+        ids = [r['id'] for r in auditor.history(sqla_test_config.db)]
+        assert self._issues(auditor) == [
+            ('gap', ids[2]), ('illegal_transition', ids[3]),
+            ('out_of_band', ids[4]), ('clock_regression', ids[5]),
+            ('unknown_revision', ids[6]), ('out_of_band', ids[7])]
+
+    def test_downgrade_gap(self, env, cmd):
+        auditor = audit_alembic.test_auditor
+        cmd.upgrade(env.R.C)
+        self._insert(auditor, env.R.B, env.R.A, direction='down')
+        ids = [r['id'] for r in auditor.history(sqla_test_config.db)]
+        assert self._issues(auditor) == [('gap', ids[-1])]
+
+    def test_graph(self, env):
+        from alembic.script import ScriptDirectory
+        graph = verify.RevisionGraph(
+            ScriptDirectory.from_config(_testing_config()), cache_size=2)
+        assert graph.is_ancestor(env.R.A, env.R.H)
+        assert graph.is_ancestor(env.R.G4, env.R.H)
+        assert sorted(graph.down[env.R.H]) == sorted(
+            [env.R.G, env.R.G2, env.R.G4])
+        assert graph.down[env.R.A] == ()
+        assert not graph.is_ancestor(env.R.H, env.R.A)
+        assert not graph.is_ancestor(env.R.D, env.R.E1)
+        assert len(graph._ancestry) <= 2
+        assert env.R.H in graph and 'x' not in graph
+
+    def test_cli(self, env, cmd, tmpdir, capsys):
+        url = 'sqlite:///%s' % tmpdir.join('h.db')
+        fleet.upgrade_fleet(_testing_config(), [url], env.R.C,
+                            executor='thread')
+        config = _testing_config().config_file_name
+        assert cli.main(['verify', url, '-c', config]) == 0
+        assert capsys.readouterr()[0].strip() == '3 row(s) checked, 0 issue(s)'
+        auditor = audit_alembic.Auditor.create(None,
+                                               user_version_nullable=True)
+        create_engine(url).execute(auditor.table.insert().values(
+            prev_alembic_version=env.R.A, alembic_version=env.R.C,
+            operation_type='migration', operation_direction='up'))
+        assert cli.main(['verify', url, '-c', config]) == 1
+        out = capsys.readouterr()[0].splitlines()
+        assert out[0].startswith('4\tillegal_transition\t')
+        assert out[-1] == '4 row(s) checked, 1 issue(s)'
+
+
+class TestDrift(TestBase):
+    def _fleet(self, env, tmpdir):
+        urls = ['sqlite:///%s' % tmpdir.join('db%d.db' % i) for i in range(4)]
+        fleet.upgrade_fleet(_testing_config(), urls[:1], executor='thread')
+        fleet.upgrade_fleet(_testing_config(), urls[1:3], env.R.C,
+                            executor='thread')
+        # urls[2] was upgraded by a newer release
+        engine = create_engine(urls[2])
+        auditor = audit_alembic.Auditor.create('v')
+        for new in ('x1', 'x2'):
+            engine.execute('UPDATE alembic_version SET version_num = ?', new)
+            engine.execute(auditor.table.insert().values(
+                prev_alembic_version=env.R.C, alembic_version=new,
+                operation_type='migration', operation_direction='up',
+                changed_at=datetime.utcnow(), user_version='v2'))
+        engine.dispose()
+        # urls[3] is empty
+        return urls + ['sqlite:///%s' % tmpdir.join('nowhere', 'db.db')]
+
+    def test_report(self, env, tmpdir):
+        urls = self._fleet(env, tmpdir)
+        report = drift.drift_report(_testing_config(), urls, workers=3,
+                                    per_host=2)
+        assert sorted(report.heads) == sorted([env.R.H, env.R.G4])
+        assert [(e.status, e.behind, e.ahead) for e in report.entries] == [
+            ('current', 0, 0), ('behind', 13, 0), ('ahead', None, 2),
+            ('behind', 16, 0), ('failed', None, 0)]
+        current, behind, ahead, empty, failed = report.entries
+        assert current.heads == env.R.H
+        assert current.since is not None
+        assert isinstance(behind.since, datetime)
+        assert behind.user_version is None
+        assert ahead.user_version == 'v2'
+        assert empty.heads is None and empty.since is None
+        assert failed.error.startswith('OperationalError')
+        assert report.drifted == report.entries[1:]
+        assert report.counts() == {'current': 1, 'behind': 2, 'ahead': 1,
+                                   'failed': 1}
+        lines = report.format()
+        assert lines[-1].startswith(
+            '5 database(s) against %s: 1 current, 2 behind, 1 ahead, '
+            '1 failed' % '##'.join(report.heads))
+
+    def test_per_host(self, env, tmpdir):
+        urls = ['sqlite:///%s' % tmpdir.join('db%d.db' % i) for i in range(8)]
+        lock = threading.Lock()
+        open_ = [0, 0]
+        fetch = drift._fetch
+
+        def counting(*args):
+            with lock:
+                open_[0] += 1
+                open_[1] = max(open_)
+            try:
+                time.sleep(.02)
+                return fetch(*args)
+            finally:
+                with lock:
+                    open_[0] -= 1
+
+        with mock.patch.object(drift, '_fetch', counting):
+            report = drift.drift_report(_testing_config(), urls, workers=8,
+                                        per_host=2)
+        assert [e.status for e in report.entries] == ['behind'] * 8
+        assert open_[1] == 2
+
+    def test_cli(self, env, tmpdir, capsys):
+        urls = self._fleet(env, tmpdir)
+        config = _testing_config().config_file_name
+        urls_file = tmpdir.join('urls.txt')
+        urls_file.write('# tenants\n%s\n' % '\n'.join(urls[1:]))
+        assert cli.main(['drift', '-c', config, urls[0]]) == 0
+        assert capsys.readouterr()[0].splitlines()[0].startswith('current ')
+        assert cli.main(['drift', '-c', config, '-f', str(urls_file),
+                         '--per-host', '1']) == 1
+        out = capsys.readouterr()[0].splitlines()
+        assert [line.split()[0] for line in out[:-1]] == [
+            'behind', 'ahead', 'behind', 'failed']
+        assert cli.main(['drift', '-c', config]) == 2
+
+
 class TestEnsureCoverage(TestBase):  # might as well call it what it is...
     def test_create_with_metadata(self):
         audit_alembic.Auditor.create('a', metadata=MetaData())
@@ -496,6 +2204,36 @@ def flatten(dt, up=False):
         after = flatten(datetime.utcnow(), True)  # ceiling
         assert then <= after
 
+    def test_custom_table_constant_value(self, env, cmd, version):
+        then = datetime(2017, 6, 21, 12, 30)
+        with mock.patch('audit_alembic.test_auditor',
+                        _custom_auditor({'changed_at': then})) as auditor:
+            cmd.upgrade(env.R.B)
+
+        q = select([auditor.table.c.changed_at])
+        assert sqla_test_config.db.execute(q).fetchall() == [(then,), (then,)]
+
+    def test_import_is_light(self):
+        code = ('import sys, audit_alembic; '
+                'assert "sqlalchemy" not in sys.modules, "eager"; '
+                'audit_alembic.Auditor; '
+                'assert "sqlalchemy" in sys.modules, "lazy"')
+        subprocess.check_call([sys.executable, '-c', code], env=dict(
+            os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+
+    def test_lazy_attribute_error(self):
+        with pytest.raises(AttributeError):
+            audit_alembic.spam
+
+    def test_features(self):
+        from audit_alembic import compat
+        found = audit_alembic.features()
+        assert found['on_version_apply']
+        assert found['alembic_version']
+        with mock.patch.object(compat, '_detect') as detect:
+            assert audit_alembic.features() == found
+        assert not detect.called
+
     def test_supports_callback_test(self):
         from audit_alembic import alembic_supports_callback
         assert alembic_supports_callback()
@@ -517,6 +2255,10 @@ def test_bad_make_row_non_callable(self):
         with pytest.raises(exc.AuditConstructError):
             _custom_auditor(make_row=object())
 
+    def test_make_row_unknown_column(self):
+        with pytest.raises(exc.AuditConstructError):
+            _custom_auditor(make_row={'changed_at': None, 'spam': 'eggs'})
+
     def test_duplicate_column_names(self):
         with pytest.raises(exc.AuditCreateError):
             audit_alembic.Auditor.create(
@@ -525,6 +2267,19 @@ def test_duplicate_column_names(self):
                 extra_columns=[(Column('foo'), 'bar')],
             )
 
+    def test_bad_sink_policy(self):
+        with pytest.raises(exc.AuditConstructError):
+            sinks.ThreadedSink(None, policy='spam')
+        with pytest.raises(exc.AuditConstructError):
+            sinks.ThreadedSink(None, policy='spill')
+
+    def test_bad_memoize_scope(self):
+        with pytest.raises(exc.AuditConstructError):
+            audit_alembic.memoize(lambda **kw: None, 'forever')
+        with pytest.raises(exc.AuditConstructError):
+            audit_alembic.Auditor.create(
+                'a', extra_columns=[(Column('c'), lambda **kw: 1, -1)])
+
     def test_bad_migration_type(self):
         class BadMigrationInfo(object):
             is_migration = False